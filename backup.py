@@ -0,0 +1,220 @@
+import argparse
+import datetime
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from models import DB_PATH
+
+# 在线备份数据库（不依赖Qt）：使用SQLite的备份API每次复制STEP_PAGES页，
+# 程序可以同时读写数据库，不需要先关闭程序，也不会复制出写了一半的文件
+#   1.在源数据库上保持一个读事务，备份的是开始时的一致快照；WAL模式下写入照常进行，
+#     备份也不会因为其它连接的写入而从头开始
+#   2.先写到.part文件，检查完整性（PRAGMA integrity_check）之后才改名为正式的备份
+#   3.每个数据库只保留最新的keep个备份
+# 备份保存在数据库旁边的backups/目录中，文件名为 <数据库名>-<日期>-<时间>.sqlite3
+#
+# 用法：
+#   python backup.py [create] [--dir backups] [--keep 10] [--quick]
+#   python backup.py list
+#   python backup.py verify backups/db-20240101-120000.sqlite3
+#   python backup.py restore backups/db-20240101-120000.sqlite3    （需要先关闭程序）
+
+# 每一步复制的页数（默认页大小4KB时为4MB）
+STEP_PAGES = 1024
+# 保留的备份个数
+KEEP = 10
+PART_SUFFIX = '.part'
+
+
+class BackupError(Exception):
+    pass
+
+
+class BackupCancelled(BackupError):
+    pass
+
+
+def backup_dir(db_path=DB_PATH):
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), 'backups')
+
+
+def backup_stem(db_path):
+    return os.path.splitext(os.path.basename(db_path))[0]
+
+
+# 目录中db_path的备份，从旧到新（同一秒内的多个备份带有-1、-2后缀）
+def list_backups(directory=None, db_path=DB_PATH):
+    directory = directory or backup_dir(db_path)
+    pattern = re.compile(r'^{}-(\d{{8}}-\d{{6}})(?:-(\d+))?\.sqlite3$'.format(re.escape(backup_stem(db_path))))
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    backups = []
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            backups.append((match.group(1), int(match.group(2) or 0), os.path.join(directory, name)))
+    return [path for _, _, path in sorted(backups)]
+
+
+# 新备份的路径，同一秒内已经有备份时加上序号
+def new_backup_path(directory, db_path, now=None):
+    now = now or datetime.datetime.now()
+    base = os.path.join(directory, '{}-{}'.format(backup_stem(db_path), now.strftime('%Y%m%d-%H%M%S')))
+    path = base + '.sqlite3'
+    number = 0
+    while os.path.exists(path) or os.path.exists(path + PART_SUFFIX):
+        number += 1
+        path = '{}-{}.sqlite3'.format(base, number)
+    return path
+
+
+# 检查数据库文件，返回发现的问题（没有问题时为空列表）
+# quick为True时使用quick_check（不检查索引和表的内容是否一致，大数据库快很多）
+def integrity_check(path, quick=False):
+    if not os.path.exists(path):
+        return ['文件不存在: ' + path]
+    try:
+        connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    except sqlite3.Error as e:
+        return [str(e)]
+    try:
+        rows = connection.execute('PRAGMA quick_check' if quick else 'PRAGMA integrity_check').fetchall()
+    except sqlite3.Error as e:
+        return [str(e)]
+    finally:
+        connection.close()
+    problems = [row[0] for row in rows]
+    return [] if problems == ['ok'] else problems
+
+
+# 用备份API把source复制到target，每一步后调用progress(已复制的页数, 总页数)
+# cancelled()返回True时停止并抛出BackupCancelled；pause是每一步之间等待的秒数（减少对磁盘的占用）
+def copy_database(source, target, pages=STEP_PAGES, progress=None, cancelled=None, pause=0):
+    src = sqlite3.connect(source, isolation_level=None)
+    dst = sqlite3.connect(target, isolation_level=None)
+    try:
+        src.execute('PRAGMA busy_timeout=5000')
+        src.execute('BEGIN')
+        src.execute('SELECT count(*) FROM sqlite_master').fetchone()
+
+        def step(status, remaining, total):
+            if progress is not None:
+                progress(total - remaining, total)
+            if cancelled is not None and cancelled():
+                raise BackupCancelled('备份已取消')
+            if pause:
+                time.sleep(pause)
+
+        src.backup(dst, pages=pages, progress=step)
+        src.execute('COMMIT')
+        # 备份保留了源数据库的WAL模式，改回普通模式，备份只有一个文件
+        dst.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        dst.close()
+        src.close()
+
+
+def remove_file(path):
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+# 备份数据库，返回备份文件的路径；失败（包括完整性检查不通过）时不会留下文件
+def backup(db_path=DB_PATH, directory=None, keep=KEEP, quick=False, pages=STEP_PAGES,
+           progress=None, cancelled=None, pause=0):
+    if not os.path.exists(db_path):
+        raise BackupError('数据库不存在: ' + db_path)
+    directory = directory or backup_dir(db_path)
+    os.makedirs(directory, exist_ok=True)
+    path = new_backup_path(directory, db_path)
+    part = path + PART_SUFFIX
+    try:
+        copy_database(db_path, part, pages, progress, cancelled, pause)
+        problems = integrity_check(part, quick)
+        if problems:
+            raise BackupError('备份没有通过完整性检查: ' + '; '.join(problems[:5]))
+        os.replace(part, path)
+    except BaseException:
+        remove_file(part)
+        raise
+    rotate(directory, db_path, keep)
+    return path
+
+
+# 只保留最新的keep个备份，返回删除的文件
+def rotate(directory=None, db_path=DB_PATH, keep=KEEP):
+    backups = list_backups(directory, db_path)
+    removed = backups[:max(len(backups) - keep, 0)] if keep > 0 else []
+    for path in removed:
+        remove_file(path)
+    return removed
+
+
+# 用备份替换数据库的内容（先检查备份是否完整），需要先关闭程序
+def restore(path, db_path=DB_PATH, pages=STEP_PAGES, progress=None):
+    problems = integrity_check(path)
+    if problems:
+        raise BackupError('备份没有通过完整性检查: ' + '; '.join(problems[:5]))
+    src = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    dst = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        dst.execute('PRAGMA busy_timeout=5000')
+        src.backup(dst, pages=pages, progress=lambda status, remaining, total:
+                   progress(total - remaining, total) if progress is not None else None)
+    finally:
+        dst.close()
+        src.close()
+
+
+def print_progress(done, total):
+    sys.stderr.write('\r{}/{} 页'.format(done, total))
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='在线备份数据库')
+    parser.add_argument('command', nargs='?', default='create', choices=['create', 'list', 'verify', 'restore'])
+    parser.add_argument('file', nargs='?', help='verify/restore的备份文件')
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--dir', help='备份目录，默认为数据库旁边的backups/')
+    parser.add_argument('--keep', type=int, default=KEEP, help='保留的备份个数')
+    parser.add_argument('--quick', action='store_true', help='使用quick_check检查备份')
+    parser.add_argument('--pages', type=int, default=STEP_PAGES, help='每一步复制的页数')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'create':
+            start = time.perf_counter()
+            path = backup(args.db, args.dir, args.keep, args.quick, args.pages, print_progress)
+            sys.stderr.write('\n')
+            print('{} ({:.1f}MB, {:.1f}秒)'.format(path, os.path.getsize(path) / 1024 / 1024,
+                                                  time.perf_counter() - start))
+        elif args.command == 'list':
+            for path in list_backups(args.dir, args.db):
+                print('{}  {:.1f}MB'.format(path, os.path.getsize(path) / 1024 / 1024))
+        elif not args.file:
+            parser.error('{}需要指定备份文件'.format(args.command))
+        elif args.command == 'verify':
+            problems = integrity_check(args.file, args.quick)
+            print('ok' if not problems else '\n'.join(problems))
+            return 1 if problems else 0
+        else:
+            restore(args.file, args.db, args.pages, print_progress)
+            sys.stderr.write('\n')
+            print('已从{}恢复到{}'.format(args.file, args.db))
+    except BackupError as e:
+        sys.stderr.write('{}\n'.format(e))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,377 @@
+import argparse
+import gc
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# 无界面的基准测试：在Qt offscreen平台下用生成的测试数据测量界面操作的耗时
+# 每次运行都在临时目录中生成数据库和图片，缩略图缓存从空开始
+#
+# 用法：
+#   python benchmark.py                       运行并和benchmarks/baseline.json比较
+#   python benchmark.py --save-baseline       运行并保存为新的基线
+#   python benchmark.py --places 2000 --items 50 --resolution 4000x3000
+#   python benchmark.py --soak 2000            反复打开/关闭对话框，检查内存是否保持不变
+#   python benchmark.py --places 2000 --items 50 --runs 3   10万件物品时检查命令行查找（where.py）的预算
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(REPO_DIR, 'benchmarks', 'baseline.json')
+
+
+# 收集每项测量的耗时（毫秒）
+# 以及每个界面第一次打开时在GUI线程中执行的SQL语句数
+class Results:
+    def __init__(self):
+        self.samples = {}
+        self.queries = {}
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds * 1000)
+
+    def summary(self):
+        summary = {}
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            summary[name] = {
+                'runs': len(samples),
+                'median_ms': round(statistics.median(ordered), 3),
+                'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+                'min_ms': round(ordered[0], 3),
+            }
+        return summary
+
+
+# 处理事件直到predicate()为真，返回是否成功
+def wait_until(app, predicate, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            return False
+        app.processEvents()
+        time.sleep(0.0005)
+    return True
+
+
+def run_benchmarks(app, runs, results):
+    from PyQt5.QtCore import QObject, QEvent, QThreadPool
+
+    import main
+    from image_loader import image_loader
+    from models import session, Place, Item
+    from persistence import writer
+    from repository import repository, count_queries
+
+    # 记录控件是否已经绘制
+    class PaintWatcher(QObject):
+        def __init__(self, widget):
+            super().__init__()
+            self.painted = False
+            widget.installEventFilter(self)
+
+        def eventFilter(self, obj, event):
+            if event.type() == QEvent.Paint:
+                self.painted = True
+            return False
+
+    # 启动到第一次绘制场景列表（第一次运行时缓存为空）
+    for run in range(runs):
+        with count_queries() as counter:
+            start = time.perf_counter()
+            window = main.Main()
+            window.resize(600, 900)
+            placelist = window.findChild(main.PlaceListWidget)
+            watcher = PaintWatcher(placelist.view.viewport())
+            window.show()
+            wait_until(app, lambda: watcher.painted)
+            results.add('startup_first_paint' if run else 'startup_first_paint_cold', time.perf_counter() - start)
+            # 场景在第一次绘制之后才读取，再等到第一页场景绘制出来
+            model = placelist.view.model()
+            wait_until(app, lambda: model.rowCount() > 0)
+            watcher.painted = False
+            wait_until(app, lambda: watcher.painted)
+            results.add('startup_places_shown', time.perf_counter() - start)
+        results.queries.setdefault('startup', counter.count)
+        if run < runs - 1:
+            window.close()
+            window.deleteLater()
+
+    # 刷新场景列表（添加场景后，缓存已经失效）
+    for _ in range(runs):
+        repository().clear()
+        watcher.painted = False
+        with count_queries() as counter:
+            start = time.perf_counter()
+            placelist.flush()
+            wait_until(app, lambda: watcher.painted)
+            results.add('place_grid_flush', time.perf_counter() - start)
+        results.queries.setdefault('place_grid_flush', counter.count)
+
+    # 打开场景详情对话框（第一次打开时读取物品）
+    place = session.query(Place).first()
+    for _ in range(runs):
+        with count_queries() as counter:
+            start = time.perf_counter()
+            dialog = main.AddItemDialog(window, place)
+            dialog.show()
+            app.processEvents()
+            results.add('add_item_dialog_open', time.perf_counter() - start)
+        results.queries.setdefault('add_item_dialog_open', counter.count)
+        dialog.done(0)
+        dialog.deleteLater()
+        app.processEvents()
+
+    # 全局搜索：逐个输入字符，测量每次查询到结果显示的时间（不含去抖动的等待）
+    searchwidget = window.findChild(main.SearchWidget)
+    pipeline = searchwidget.pipeline
+    done = []
+    pipeline.results_ready.connect(lambda text, results: done.append(text))
+    query = session.query(Item.name).first()[0]
+    for _ in range(runs):
+        pipeline.last_text = None
+        for length in range(1, len(query) + 1):
+            pipeline.text = query[:length]
+            del done[:]
+            start = time.perf_counter()
+            pipeline.run()
+            wait_until(app, lambda: done)
+            results.add('search_keystroke', time.perf_counter() - start)
+
+    # 提交延迟：修改物品到后台写入完成
+    committed = []
+    writer().committed.connect(committed.append)
+    item = session.query(Item).first()
+    for run in range(runs * 5):
+        del committed[:]
+        start = time.perf_counter()
+        writer().update(item, name='{}{}'.format(item.name.rstrip('0123456789'), run))
+        wait_until(app, lambda: committed)
+        results.add('commit_latency', time.perf_counter() - start)
+
+    window.close()
+    # 和main.py退出时一样，等待后台的解码、查询和写入结束
+    image_loader().shutdown()
+    QThreadPool.globalInstance().waitForDone()
+    writer().close()
+    app.processEvents()
+
+
+# 命令行查找：在新进程中运行where.py（包括解释器启动），短查询扫描名字的索引，3个字及以上用全文索引；
+# 没有结果和结果很少的短查询要扫描全部名字，不能提前结束
+CLI_QUERIES = [('where_lookup', '打火机1'), ('where_lookup_short', '手机'),
+               ('where_lookup_short_none', 'zz'), ('where_lookup_short_sparse', '筒7')]
+
+
+def run_cli_benchmarks(runs, results):
+    import where
+    command = [sys.executable, os.path.join(REPO_DIR, 'where.py')]
+    for name, text in CLI_QUERIES:
+        for _ in range(runs * 3):
+            start = time.perf_counter()
+            # 没有找到时返回1
+            if subprocess.run(command + [text, '--json'], stdout=subprocess.DEVNULL).returncode not in (0, 1):
+                raise RuntimeError('where.py失败: ' + text)
+            results.add(name, time.perf_counter() - start)
+    return {name: where.BUDGET_MS for name, text in CLI_QUERIES}
+
+
+# 耐久测试：反复打开/关闭场景详情、物品编辑、选择场景、选择位置四个对话框，
+# 预热之后QObject个数不应增加，Python分配的内存增长不超过limit_bytes
+def run_soak(app, cycles, limit_bytes, out=sys.stdout):
+    from PyQt5.QtCore import QEvent, QThreadPool, QTimer
+
+    import main
+    from image_loader import image_loader
+    from memory import MemoryMonitor
+    from models import session, Place
+    from persistence import writer
+
+    window = main.Main()
+    window.resize(600, 900)
+    window.show()
+    app.processEvents()
+    placelist = window.findChild(main.PlaceListWidget)
+    place = session.query(Place).first()
+
+    # 模拟用户操作：每个对话框第一次出现时打开下一层对话框，之后关闭它
+    def first_item(dialog):
+        dialog.image_label.edit_item(dialog.items[0])
+
+    actions = {
+        main.AddItemDialog: first_item,
+        main.EditItem: lambda dialog: dialog.move(),
+        main.MovePlaceListDialog: lambda dialog: dialog.move_to(place),
+    }
+    running = [True]
+
+    def tick():
+        if not running[0]:
+            return
+        # 先安排下一次，动作中会进入嵌套的事件循环
+        QTimer.singleShot(1, tick)
+        dialog = app.activeModalWidget()
+        if dialog is None:
+            return
+        action = actions.get(type(dialog))
+        if action is not None and not dialog.property('soak_visited'):
+            dialog.setProperty('soak_visited', True)
+            action(dialog)
+        else:
+            dialog.done(0)
+
+    def cycle():
+        placelist.open_place(place)
+        # 不在app.exec_()中运行，需要手动处理deleteLater
+        app.sendPostedEvents(None, QEvent.DeferredDelete)
+        app.processEvents()
+
+    QTimer.singleShot(0, tick)
+    monitor = MemoryMonitor(frames=1)
+    warmup = min(50, max(cycles // 10, 1))
+    for _ in range(warmup):
+        cycle()
+    # 对话框和其中的控件互相引用，删除后要等到分代回收时才释放；
+    # 每次测量前先回收，否则结果取决于测量时离上一次完整回收有多久，而不是真正保留下来的内存
+    gc.collect()
+    monitor.start()
+    start = time.perf_counter()
+    out.write('{:>8}{:>14}{:>10}\n'.format('cycles', 'memory(KB)', 'QObject'))
+    base_memory, _, base_objects = monitor.sample()
+    samples = []
+    for number in range(1, cycles + 1):
+        cycle()
+        if number % max(cycles // 10, 1) == 0 or number == cycles:
+            gc.collect()
+            memory, _, objects = monitor.sample()
+            samples.append((number, memory - base_memory, objects - base_objects))
+            out.write('{:>8}{:>+14.1f}{:>+10}\n'.format(number, (memory - base_memory) / 1024,
+                                                       objects - base_objects))
+    running[0] = False
+    elapsed = time.perf_counter() - start
+    out.write('{}次，每次{:.1f}ms\n'.format(cycles, elapsed * 1000 / cycles))
+
+    _, memory_growth, object_growth = samples[-1]
+    ok = object_growth <= 0 and memory_growth <= limit_bytes
+    if not ok:
+        monitor.report(out=out)
+    window.close()
+    image_loader().shutdown()
+    QThreadPool.globalInstance().waitForDone()
+    writer().close()
+    app.processEvents()
+    return ok
+
+
+# 和基线比较，中位数变慢超过threshold的记为退化
+# 有预算的项（如冷启动到第一次绘制、命令行查找）超过预算的毫秒数时也记为退化，不论基线是多少
+def compare(summary, baseline, threshold, budgets=None, out=sys.stdout):
+    regressions = []
+    for name, budget in sorted((budgets or {}).items()):
+        result = summary.get(name)
+        if result is not None and result['median_ms'] > budget:
+            out.write('{} {:.2f}ms 超过预算 {}ms\n'.format(name, result['median_ms'], budget))
+            regressions.append(name)
+    out.write('{:<28}{:>12}{:>12}{:>12}\n'.format('benchmark', 'median(ms)', 'baseline', 'change'))
+    for name, result in sorted(summary.items()):
+        base = baseline.get(name)
+        if base is None:
+            out.write('{:<28}{:>12.2f}{:>12}{:>12}\n'.format(name, result['median_ms'], '-', '-'))
+            continue
+        change = result['median_ms'] / base['median_ms'] - 1 if base['median_ms'] else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        out.write('{:<28}{:>12.2f}{:>12.2f}{:>+11.0%}{}\n'.format(
+            name, result['median_ms'], base['median_ms'], change, flag))
+    return regressions
+
+
+# SQL语句数是确定的，比基线多就记为退化
+def compare_queries(queries, baseline, out=sys.stdout):
+    regressions = []
+    out.write('{:<28}{:>12}{:>12}\n'.format('queries', 'count', 'baseline'))
+    for name, count in sorted(queries.items()):
+        base = baseline.get(name)
+        flag = ''
+        if base is not None and count > base:
+            flag = '  REGRESSION'
+            regressions.append(name + '_queries')
+        out.write('{:<28}{:>12}{:>12}{}\n'.format(name, count, '-' if base is None else base, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='无界面基准测试')
+    parser.add_argument('--places', type=int, default=200)
+    parser.add_argument('--items', type=int, default=50, help='每个场景的物品数')
+    parser.add_argument('--resolution', default='2000x1500')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.25, help='中位数变慢超过该比例视为退化')
+    parser.add_argument('--startup-budget', type=float, default=None,
+                        help='冷启动到第一次绘制的预算（毫秒），默认使用startup.BUDGET_MS')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--output', help='把结果保存为JSON')
+    parser.add_argument('--soak', type=int, metavar='CYCLES', help='只运行耐久测试，打开/关闭对话框CYCLES次')
+    parser.add_argument('--soak-limit', type=int, default=1024, help='耐久测试允许的内存增长（KB）')
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline)
+    # 必须在导入Qt和models之前设置
+    workdir = tempfile.mkdtemp(prefix='where-bench-')
+    os.environ['WHERE_DB'] = os.path.join(workdir, 'bench.sqlite3')
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(workdir)
+
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication([])
+
+    import seed
+    seed.seed(args.places, args.items, seed.parse_resolution(args.resolution),
+              image_dir=os.path.join(workdir, 'images'))
+
+    if args.soak:
+        return 0 if run_soak(app, args.soak, args.soak_limit * 1024) else 1
+
+    results = Results()
+    run_benchmarks(app, args.runs, results)
+    budgets = run_cli_benchmarks(args.runs, results)
+    summary = {
+        'params': {'places': args.places, 'items': args.items, 'resolution': args.resolution,
+                   'runs': args.runs},
+        'results': results.summary(),
+        'queries': results.queries,
+    }
+
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('params') != summary['params']:
+            sys.stdout.write('注意：基线使用的参数不同 {}\n'.format(baseline.get('params')))
+    import startup
+    budgets['startup_first_paint_cold'] = (args.startup_budget if args.startup_budget is not None
+                                           else startup.BUDGET_MS)
+    regressions = compare(summary['results'], baseline.get('results', {}), args.threshold, budgets)
+    regressions += compare_queries(summary['queries'], baseline.get('queries', {}))
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        return 0
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+from sqlalchemy import func, select
+
+from models import get_engine, Place, Item, place_paths, COORD_SCALE
+
+# 批量导入/导出场景和物品
+# 文件格式（按扩展名区分）：
+#   .jsonl  每行一个JSON对象，{"type": "place", "id", "name", "image", "parent_id"}
+#           或 {"type": "item", "id", "name", "description", "place_id", "x", "y"}
+#   .csv    一个文件，列为 FIELDS，type列区分场景和物品
+# 场景必须出现在它的子场景和引用它的物品之前（导出时按层级排序）；导入时场景会分配新的id，
+# 子场景的parent_id和物品的place_id随之转换，文件中没有出现的id按数据库中已有的场景处理
+# 新的id由SQLite在写入事务中分配（不预先计算），程序运行时导入也不会和界面添加的场景/物品冲突
+# 格式错误的行（不是整数的id/坐标、不是JSON的行）给出警告后跳过，坐标限制在0~COORD_SCALE之内
+#
+# 用法：
+#   python bulk.py export inventory.jsonl
+#   python bulk.py import inventory.jsonl [--chunk-size 5000] [--strict]
+
+FIELDS = ['type', 'id', 'name', 'image', 'description', 'place_id', 'x', 'y', 'parent_id']
+
+# 文件中已经读到、还没有写入的场景
+PENDING = object()
+
+places = Place.__table__
+items = Item.__table__
+
+
+def file_format(path, fmt=None):
+    if fmt:
+        return fmt
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+# 逐行读取文件，不会一次性读入内存
+def read_rows(stream, fmt):
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield {key: value for key, value in row.items() if value not in (None, '')}
+    else:
+        for line in stream:
+            line = line.strip()
+            if line:
+                # 不是JSON的行作为错误交给调用者，之后的行继续读取
+                try:
+                    row = json.loads(line)
+                    if not isinstance(row, dict):
+                        raise ValueError('不是JSON对象')
+                except ValueError as e:
+                    row = {'type': None, 'error': str(e)}
+                yield row
+
+
+def write_rows(stream, fmt, rows):
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    else:
+        for row in rows:
+            stream.write(json.dumps(row, ensure_ascii=False))
+            stream.write('\n')
+
+
+def optional_int(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+# 坐标（相对于图片，0~COORD_SCALE），没有时为0
+def coordinate(value):
+    return min(max(optional_int(value) or 0, 0), COORD_SCALE)
+
+
+# 导入过程中的统计和进度
+class Progress:
+    def __init__(self, out=sys.stderr):
+        self.out = out
+        self.start = time.perf_counter()
+        self.places = 0
+        self.items = 0
+        self.skipped = 0
+        self.missing_images = 0
+
+    @property
+    def rows(self):
+        return self.places + self.items
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.start
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def report(self, final=False):
+        elapsed = time.perf_counter() - self.start
+        self.out.write('{}{} 个场景, {} 个物品, 跳过 {} 行, {:.1f}秒, {:.0f} 行/秒\n'.format(
+            '完成: ' if final else '', self.places, self.items, self.skipped, elapsed, self.rate()))
+
+    def warn(self, line, message):
+        self.out.write('第{}行: {}\n'.format(line, message))
+
+
+# 流式导入：每chunk_size行提交一次，物品用Core批量插入
+# strict为True时图片不存在的场景（以及其中的物品）会被跳过，否则只给出警告
+def import_file(path, fmt=None, chunk_size=5000, strict=False, progress=None):
+    fmt = file_format(path, fmt)
+    progress = progress or Progress()
+    with get_engine().connect() as connection:
+        existing_places = {row[0] for row in connection.execute(select([places.c.id]))}
+        # 文件中的场景id -> 数据库中的场景id（None表示被跳过，PENDING表示还没有写入）
+        place_ids = {}
+        place_rows = []
+        item_rows = []
+
+        # 文件中的场景id是否对应一个（将要）存在的场景
+        def known_place(source):
+            if source in place_ids:
+                return place_ids[source] is not None
+            return source in existing_places
+
+        # 文件中的场景id对应的数据库中的场景id，在写入时调用（之前的场景已经写入）
+        def map_place(source):
+            if source is None:
+                return None
+            return place_ids[source] if source in place_ids else source
+
+        # 场景逐个插入，由SQLite分配id（子场景和物品要引用它，同一批中的也可以）
+        def flush():
+            if not place_rows and not item_rows:
+                return
+            with connection.begin():
+                for source, parent, values in place_rows:
+                    result = connection.execute(places.insert(), dict(values, parent_id=map_place(parent)))
+                    if source is not None:
+                        place_ids[source] = result.inserted_primary_key[0]
+                if item_rows:
+                    connection.execute(items.insert(), [dict(values, place_id=map_place(source))
+                                                        for source, values in item_rows])
+            progress.places += len(place_rows)
+            progress.items += len(item_rows)
+            del place_rows[:]
+            del item_rows[:]
+            progress.report()
+
+        with open(path, encoding='utf-8', newline='') as stream:
+            for line, row in enumerate(read_rows(stream, fmt), 1):
+                try:
+                    kind = row.get('type')
+                    if 'error' in row:
+                        raise ValueError(row['error'])
+                    if kind == 'place':
+                        source = optional_int(row.get('id'))
+                        parent = optional_int(row.get('parent_id'))
+                        image = row.get('image')
+                        if not image or not os.path.exists(image):
+                            progress.missing_images += 1
+                            progress.warn(line, '图片不存在: {}'.format(image))
+                            if strict:
+                                place_ids[source] = None
+                                progress.skipped += 1
+                                continue
+                        if parent is not None and not known_place(parent):
+                            progress.warn(line, '父场景不存在: {}，作为顶层场景导入'.format(parent))
+                            parent = None
+                        if source is not None:
+                            place_ids[source] = PENDING
+                        place_rows.append((source, parent, {'name': row.get('name'), 'image': image}))
+                    elif kind == 'item':
+                        source = optional_int(row.get('place_id'))
+                        values = {'name': row.get('name'), 'description': row.get('description', ''),
+                                  'x': coordinate(row.get('x')), 'y': coordinate(row.get('y'))}
+                        if not known_place(source):
+                            progress.warn(line, '场景不存在: {}'.format(source))
+                            progress.skipped += 1
+                            continue
+                        item_rows.append((source, values))
+                    else:
+                        progress.warn(line, '未知的类型: {}'.format(kind))
+                        progress.skipped += 1
+                        continue
+                except (ValueError, TypeError) as e:
+                    progress.warn(line, '格式错误: {}'.format(e))
+                    progress.skipped += 1
+                    continue
+                if len(place_rows) + len(item_rows) >= chunk_size:
+                    flush()
+            flush()
+    progress.report(final=True)
+    return progress
+
+
+# 流式导出：先按层级（祖先个数）导出所有场景，父场景在子场景之前，再导出所有物品
+def export_rows():
+    with get_engine().connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+        depths = (select([place_paths.c.descendant_id, func.max(place_paths.c.depth).label('depth')])
+                  .group_by(place_paths.c.descendant_id).alias('depths'))
+        query = (select([places]).select_from(places.outerjoin(depths, depths.c.descendant_id == places.c.id))
+                 .order_by(depths.c.depth, places.c.id))
+        for row in connection.execute(query):
+            yield {'type': 'place', 'id': row.id, 'name': row.name, 'image': row.image, 'parent_id': row.parent_id}
+        for row in connection.execute(select([items]).order_by(items.c.id)):
+            yield {'type': 'item', 'id': row.id, 'name': row.name, 'description': row.description,
+                   'place_id': row.place_id, 'x': row.x, 'y': row.y}
+
+
+def export_file(path, fmt=None, out=sys.stderr):
+    fmt = file_format(path, fmt)
+    start = time.perf_counter()
+    count = 0
+
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    with open(path, 'w', encoding='utf-8', newline='') as stream:
+        write_rows(stream, fmt, counted(export_rows()))
+    elapsed = time.perf_counter() - start
+    out.write('完成: 导出 {} 行, {:.1f}秒, {:.0f} 行/秒\n'.format(
+        count, elapsed, count / elapsed if elapsed > 0 else 0.0))
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='批量导入/导出场景和物品')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parser_import = subparsers.add_parser('import', help='从CSV/JSON Lines文件导入')
+    parser_import.add_argument('path')
+    parser_import.add_argument('--format', choices=['csv', 'jsonl'])
+    parser_import.add_argument('--chunk-size', type=int, default=5000)
+    parser_import.add_argument('--strict', action='store_true', help='跳过图片不存在的场景')
+
+    parser_export = subparsers.add_parser('export', help='导出到CSV/JSON Lines文件')
+    parser_export.add_argument('path')
+    parser_export.add_argument('--format', choices=['csv', 'jsonl'])
+
+    args = parser.parse_args(argv)
+    if args.command == 'import':
+        import_file(args.path, args.format, args.chunk_size, args.strict)
+    else:
+        export_file(args.path, args.format)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+from PyQt5.QtCore import QObject, pyqtSignal
+
+import profiling
+from models import Item
+from persistence import writer
+
+
+# 数据变化的通知：后台写入提交后，把session事件记录的每个变化（models.Change）
+# 按类型发出对应的信号，各个界面只处理自己关心的变化，不需要整体刷新
+# committed在各个变化之前发出，携带整个CommitResult（用于更新缓存）
+class ChangeBus(QObject):
+    committed = pyqtSignal(object)
+    item_added = pyqtSignal(object)
+    item_updated = pyqtSignal(object)
+    item_moved = pyqtSignal(object)
+    item_deleted = pyqtSignal(object)
+    place_added = pyqtSignal(object)
+    place_updated = pyqtSignal(object)
+    place_deleted = pyqtSignal(object)
+
+    @profiling.timed('publish')
+    def publish(self, result):
+        self.committed.emit(result)
+        for change in result.changes:
+            entity = 'item' if change.cls is Item else 'place'
+            signal = getattr(self, '{}_{}'.format(entity, change.kind), None)
+            if signal is not None:
+                signal.emit(change)
+
+
+# 全局共享的通知，连接到后台写入器，需要在QApplication创建之后才能使用
+_bus = None
+
+
+def bus():
+    global _bus
+    if _bus is None:
+        _bus = ChangeBus()
+        writer().committed.connect(_bus.publish)
+    return _bus
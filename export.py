@@ -0,0 +1,394 @@
+import argparse
+import datetime
+import hashlib
+import html
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PyQt5.QtCore import QRect, QRectF, QSize, Qt
+from PyQt5.QtGui import QGuiApplication, QImage, QImageReader, QPainter, QColor, QFont, QFontMetrics, \
+    QPdfWriter, QPageLayout, QPageSize, QPen
+from sqlalchemy import select
+
+from markers import MARKER_SIZE
+from media import replace_atomically
+from models import get_engine, Place, Item, place_paths_of, COORD_SCALE
+
+# 导出带物品标记的场景图（不需要界面，可以打印或分享）：
+#   1.每个场景画成一张PNG：场景路径作为标题，物品和界面中一样画成黄色方块并标上名字，
+#     名字放不下（和其它名字、标记重叠）的物品画成带编号的圆，名字列在图片下方
+#   2.places.pdf每页一个场景（由PNG组成）；index.html包含目录、每个场景的图片和物品列表
+#   3.增量导出：每个场景的指纹（图片文件、场景路径、物品的名字和坐标、绘制参数）保存在manifest.json中，
+#     再次导出时只重新绘制指纹变化的场景，删除已经不存在的场景的图片
+#   4.多个进程并行绘制（和media.py一样），PDF只在有场景重新绘制或删除时由PNG重新组合
+#
+# 用法：
+#   python export.py [export] [--formats pdf,html] [--width 1600] [--workers 4] [--force]
+
+EXPORT_DIR = 'export'
+MANIFEST = 'manifest.json'
+# 除了每个场景的PNG之外可以生成的文件
+FORMATS = ('pdf', 'html')
+# PNG的宽度（像素），图片按比例缩放到这个宽度
+WIDTH = 1600
+# 绘制方式改变时加1，之前导出的场景全部重新绘制
+RENDER_VERSION = 1
+TITLE_HEIGHT = 40
+FONT_SIZE = 14
+PADDING = 3
+# 标签中最多显示的宽度，更长的名字显示省略号
+LABEL_WIDTH = 200
+LEGEND_COLUMN = 240
+# 标签重叠检测的格子大小
+GRID_SIZE = 64
+# PDF的分辨率（每英寸点数）
+PDF_RESOLUTION = 150
+
+# 子进程中（或导出PDF时）创建的QGuiApplication，绘制文字需要它
+_app = None
+
+
+def ensure_app():
+    global _app
+    if QGuiApplication.instance() is None:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        _app = QGuiApplication([])
+
+
+def png_path(out_dir, place_id):
+    return os.path.join(out_dir, 'places', '{}.png'.format(place_id))
+
+
+# 场景的指纹：图片文件的路径、大小和修改时间，场景路径，物品，绘制参数；任何一项改变都需要重新绘制
+def fingerprint(image, names, items, options):
+    try:
+        stat = os.stat(image or '')
+        image_state = [stat.st_size, stat.st_mtime_ns]
+    except OSError:
+        image_state = None
+    data = [RENDER_VERSION, options, names, image, image_state, items]
+    return hashlib.sha1(json.dumps(data, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+# 按格子记录已经占用的矩形，检查重叠时只比较附近的矩形
+class RectGrid:
+    def __init__(self, size=GRID_SIZE):
+        self.size = size
+        self.cells = {}
+
+    def cells_of(self, rect):
+        size = self.size
+        for column in range(rect.left() // size, rect.right() // size + 1):
+            for row in range(rect.top() // size, rect.bottom() // size + 1):
+                yield column, row
+
+    def collides(self, rect):
+        return any(other.intersects(rect) for cell in self.cells_of(rect) for other in self.cells.get(cell, ()))
+
+    def add(self, rect):
+        for cell in self.cells_of(rect):
+            self.cells.setdefault(cell, []).append(rect)
+
+
+# 读取图片并缩放到width宽（大图在解码时直接缩小），读不到时返回灰色的占位图
+def load_image(path, width):
+    reader = QImageReader(path or '')
+    reader.setAutoTransform(True)
+    size = reader.size()
+    if size.isValid() and not size.isEmpty():
+        if size.width() > width:
+            reader.setScaledSize(QSize(width, max(1, round(size.height() * width / size.width()))))
+        image = reader.read()
+        if not image.isNull():
+            if image.width() != width:
+                image = image.scaledToWidth(width, Qt.SmoothTransformation)
+            return image
+    image = QImage(width, width * 3 // 4, QImage.Format_RGB32)
+    image.fill(QColor(Qt.lightGray))
+    return image
+
+
+# 为每个物品的名字找一个位置（标记的右、左、下、上），不和其它标记、名字重叠，也不超出图片
+# 返回(有名字的[(物品, 标记矩形, 名字, 名字矩形)], 放不下名字的[(物品, 标记矩形)])
+def place_labels(items, width, height, metrics, marker):
+    grid = RectGrid()
+    markers = []
+    for item in items:
+        rect = QRect(round(item[3] * width / COORD_SCALE), round(item[4] * height / COORD_SCALE), marker, marker)
+        markers.append((item, rect))
+        grid.add(rect)
+    labeled = []
+    numbered = []
+    bounds = QRect(0, 0, width, height)
+    for item, rect in sorted(markers, key=lambda entry: (entry[1].y(), entry[1].x(), entry[0][0])):
+        text = metrics.elidedText(item[1] or '', Qt.ElideRight, LABEL_WIDTH)
+        w = metrics.horizontalAdvance(text) + 2 * PADDING
+        h = metrics.height() + 2 * PADDING
+        cx, cy = rect.center().x(), rect.center().y()
+        for x, y in ((rect.right() + 3, cy - h // 2), (rect.left() - 3 - w, cy - h // 2),
+                     (cx - w // 2, rect.bottom() + 3), (cx - w // 2, rect.top() - 3 - h)):
+            label = QRect(x, y, w, h)
+            if bounds.contains(label) and not grid.collides(label):
+                grid.add(label)
+                labeled.append((item, rect, text, label))
+                break
+        else:
+            numbered.append((item, rect))
+    return labeled, numbered
+
+
+# 绘制一个场景并保存为PNG，task中是场景的标题、图片、物品[(id, 名字, 介绍, x, y)]、宽度和保存路径
+def render_place(task):
+    ensure_app()
+    width = task['width']
+    picture = load_image(task['image'], width)
+    height = picture.height()
+    font = QFont()
+    font.setPixelSize(FONT_SIZE)
+    metrics = QFontMetrics(font)
+    marker = MARKER_SIZE * max(1, round(width / 800))
+    labeled, numbered = place_labels(task['items'], width, height, metrics, marker)
+    line = metrics.height() + 2 * PADDING
+    columns = max(1, width // LEGEND_COLUMN)
+    legend = math.ceil(len(numbered) / columns) * line + 2 * PADDING if numbered else 0
+
+    canvas = QImage(width, TITLE_HEIGHT + height + legend, QImage.Format_RGB32)
+    canvas.fill(QColor(Qt.white))
+    painter = QPainter(canvas)
+    painter.setRenderHint(QPainter.Antialiasing)
+    painter.setFont(font)
+    title = '{}（{}件物品）'.format(task['title'], len(task['items']))
+    painter.drawText(QRect(2 * PADDING, 0, width - 4 * PADDING, TITLE_HEIGHT), Qt.AlignLeft | Qt.AlignVCenter,
+                     metrics.elidedText(title, Qt.ElideRight, width - 4 * PADDING))
+    painter.translate(0, TITLE_HEIGHT)
+    painter.drawImage(0, 0, picture)
+    painter.setPen(QPen(Qt.black))
+    for item, rect, text, label in labeled:
+        painter.fillRect(rect, QColor('yellow'))
+        painter.drawRect(rect)
+        painter.fillRect(label, QColor(255, 255, 255, 220))
+        painter.drawRect(label)
+        painter.drawText(label, Qt.AlignCenter, text)
+    small = QFont(font)
+    small.setPixelSize(max(8, marker - 2))
+    for number, (item, rect) in enumerate(numbered, 1):
+        circle = rect.adjusted(-marker // 2, -marker // 2, marker // 2, marker // 2)
+        painter.setBrush(QColor('orange'))
+        painter.drawEllipse(circle)
+        painter.setFont(small)
+        painter.drawText(circle, Qt.AlignCenter, str(number))
+    painter.setFont(font)
+    painter.translate(0, height)
+    for number, (item, _) in enumerate(numbered):
+        column, row = number % columns, number // columns
+        painter.drawText(QRect(column * LEGEND_COLUMN + 2 * PADDING, PADDING + row * line, LEGEND_COLUMN - 4 * PADDING,
+                               line), Qt.AlignLeft | Qt.AlignVCenter,
+                         metrics.elidedText('{}. {}'.format(number + 1, item[1] or ''), Qt.ElideRight,
+                                            LEGEND_COLUMN - 4 * PADDING))
+    painter.end()
+
+    def save(temp):
+        if not canvas.save(temp, 'PNG'):
+            raise ValueError('无法保存图片: {}'.format(task['path']))
+    os.makedirs(os.path.dirname(task['path']), exist_ok=True)
+    replace_atomically(save, task['path'])
+
+
+# 在子进程中执行，返回(场景id, 指纹, 错误信息)
+def _render_one(task):
+    try:
+        render_place(task)
+        return task['id'], task['fingerprint'], None
+    except (OSError, ValueError) as e:
+        return task['id'], None, str(e)
+
+
+# 读出所有场景（按层级排列：父场景在前，子场景紧跟在父场景后面）和它们的物品
+def load_places():
+    places = Place.__table__
+    items = Item.__table__
+    with get_engine().connect() as connection:
+        rows = connection.execute(select([places.c.id, places.c.name, places.c.image])).fetchall()
+        paths = place_paths_of(connection, [row.id for row in rows])
+        place_items = {row.id: [] for row in rows}
+        query = (select([items.c.id, items.c.name, items.c.description, items.c.x, items.c.y, items.c.place_id])
+                 .order_by(items.c.place_id, items.c.id))
+        for row in connection.execute(query):
+            if row.place_id in place_items:
+                place_items[row.place_id].append([row.id, row.name, row.description, row.x, row.y])
+    result = [{'id': row.id, 'image': row.image, 'path': paths[row.id] or [(row.id, row.name)],
+               'items': place_items[row.id]} for row in rows]
+    result.sort(key=lambda place: [(name or '', place_id) for place_id, name in place['path']])
+    return result
+
+
+def read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(out_dir, manifest):
+    def write(temp):
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+    replace_atomically(write, os.path.join(out_dir, MANIFEST))
+
+
+# 每页一个场景，页面方向和图片一致，图片按比例缩放到页面中
+def write_pdf(out_dir, places, path):
+    ensure_app()
+
+    def write(temp):
+        pdf = QPdfWriter(temp)
+        pdf.setResolution(PDF_RESOLUTION)
+        pdf.setPageSize(QPageSize(QPageSize.A4))
+        pdf.setTitle('场景图')
+        painter = None
+        for place in places:
+            image = QImage(png_path(out_dir, place['id']))
+            if image.isNull():
+                continue
+            pdf.setPageOrientation(QPageLayout.Landscape if image.width() > image.height() else QPageLayout.Portrait)
+            if painter is None:
+                painter = QPainter(pdf)
+            else:
+                pdf.newPage()
+            page = painter.viewport()
+            scale = min(page.width() / image.width(), page.height() / image.height())
+            target = QRectF(0, 0, image.width() * scale, image.height() * scale)
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+            painter.drawImage(target, image)
+        if painter is None:
+            painter = QPainter(pdf)
+        painter.end()
+    replace_atomically(write, path)
+
+
+def write_html(out_dir, places, path):
+    escape = html.escape
+    parts = ['<!DOCTYPE html>\n<html lang="zh">\n<head>\n<meta charset="utf-8">\n<title>场景图</title>\n<style>\n'
+             'body { font-family: sans-serif; margin: 2em; }\n'
+             'nav li { list-style: none; }\n'
+             'section { margin-top: 3em; page-break-before: always; }\n'
+             'img { max-width: 100%; border: 1px solid #ccc; }\n'
+             'table { border-collapse: collapse; margin-top: 1em; }\n'
+             'td, th { border: 1px solid #ccc; padding: 2px 8px; text-align: left; }\n'
+             '</style>\n</head>\n<body>\n<h1>场景图</h1>\n',
+             '<p>导出于 {}，共{}个场景</p>\n<nav>\n<ul>\n'.format(
+                 datetime.datetime.now().strftime('%Y-%m-%d %H:%M'), len(places))]
+    for place in places:
+        parts.append('<li style="margin-left: {}em"><a href="#place-{}">{}</a>（{}）</li>\n'.format(
+            2 * (len(place['path']) - 1), place['id'], escape(place['path'][-1][1] or ''), len(place['items'])))
+    parts.append('</ul>\n</nav>\n')
+    for place in places:
+        title = ' &gt; '.join(escape(name or '') for _, name in place['path'])
+        parts.append('<section id="place-{0}">\n<h2>{1}</h2>\n<img src="places/{0}.png" loading="lazy" alt="{1}">\n'
+                     .format(place['id'], title))
+        if place['items']:
+            parts.append('<table>\n<tr><th>物品</th><th>介绍</th><th>位置（左, 上）</th></tr>\n')
+            for item_id, name, description, x, y in place['items']:
+                parts.append('<tr><td>{}</td><td>{}</td><td>{:.0%}, {:.0%}</td></tr>\n'.format(
+                    escape(name or ''), escape(description or ''), x / COORD_SCALE, y / COORD_SCALE))
+            parts.append('</table>\n')
+        parts.append('</section>\n')
+    parts.append('</body>\n</html>\n')
+
+    def write(temp):
+        with open(temp, 'w', encoding='utf-8') as f:
+            f.write(''.join(parts))
+    replace_atomically(write, path)
+
+
+# 导出到out_dir，返回(重新绘制的场景数, 没有变化的场景数, 删除的场景数, 失败的场景数)
+# force为True时全部重新绘制，manifest.json只用来删除已经不存在的场景的图片
+def export(out_dir=EXPORT_DIR, formats=FORMATS, width=WIDTH, workers=None, force=False, out=sys.stderr):
+    start = time.perf_counter()
+    os.makedirs(os.path.join(out_dir, 'places'), exist_ok=True)
+    options = {'width': width}
+    previous = read_manifest(out_dir).get('places', {})
+    manifest = {} if force else previous
+    places = load_places()
+
+    tasks = []
+    rendered = {}
+    for place in places:
+        names = [name for _, name in place['path']]
+        items = [[item_id, name, x, y] for item_id, name, _, x, y in place['items']]
+        key = fingerprint(place['image'], names, items, options)
+        path = png_path(out_dir, place['id'])
+        if manifest.get(str(place['id'])) == key and os.path.exists(path):
+            rendered[str(place['id'])] = key
+            continue
+        tasks.append({'id': place['id'], 'title': ' > '.join(name or '' for name in names), 'image': place['image'],
+                      'items': place['items'], 'width': width, 'path': path, 'fingerprint': key})
+    unchanged = len(rendered)
+
+    # 已经不存在的场景的图片
+    removed = 0
+    existing = {str(place['id']) for place in places}
+    for place_id in previous:
+        if place_id not in existing:
+            try:
+                os.remove(png_path(out_dir, place_id))
+            except FileNotFoundError:
+                pass
+            removed += 1
+
+    # 只有一个场景要绘制时不启动子进程
+    # 子进程用spawn启动：已经创建了QGuiApplication（导出过PDF或在界面中调用）的进程fork之后，
+    # 子进程中绘制文字会卡在继承来的字体库的锁上
+    if len(tasks) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            chunk = max(1, len(tasks) // ((workers or os.cpu_count() or 1) * 4))
+            results = list(pool.map(_render_one, tasks, chunksize=chunk))
+    else:
+        results = [_render_one(task) for task in tasks]
+    failed = 0
+    for place_id, key, error in results:
+        if error is not None:
+            failed += 1
+            out.write('跳过场景 {}: {}\n'.format(place_id, error))
+        else:
+            rendered[str(place_id)] = key
+    write_manifest(out_dir, {'version': RENDER_VERSION, 'options': options, 'places': rendered})
+
+    changed = len(tasks) - failed + removed
+    if 'pdf' in formats:
+        pdf = os.path.join(out_dir, 'places.pdf')
+        if changed or not os.path.exists(pdf):
+            write_pdf(out_dir, places, pdf)
+    if 'html' in formats:
+        # 物品的介绍等不影响图片的内容也在HTML中，每次都重新生成（不需要读取图片，很快）
+        write_html(out_dir, places, os.path.join(out_dir, 'index.html'))
+    out.write('完成: 绘制 {} 个场景, 没有变化 {} 个, 删除 {} 个, 失败 {} 个, {:.1f}秒\n'.format(
+        len(tasks) - failed, unchanged, removed, failed, time.perf_counter() - start))
+    return len(tasks) - failed, unchanged, removed, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='导出带物品标记的场景图（PNG/PDF/HTML）')
+    parser.add_argument('out_dir', nargs='?', default=EXPORT_DIR)
+    parser.add_argument('--formats', default=','.join(FORMATS),
+                        help='除了每个场景的PNG之外还生成的文件（pdf,html），空字符串表示只生成PNG')
+    parser.add_argument('--width', type=int, default=WIDTH, help='图片的宽度（像素）')
+    parser.add_argument('--workers', type=int, default=None, help='进程数，默认为CPU个数')
+    parser.add_argument('--force', action='store_true', help='忽略上次导出的记录，全部重新绘制')
+    args = parser.parse_args(argv)
+    formats = [name for name in args.formats.split(',') if name]
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        parser.error('不支持的格式: {}'.format(', '.join(sorted(unknown))))
+    _, _, _, failed = export(args.out_dir, formats, args.width, args.workers, args.force)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+from PyQt5 import sip
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal, Qt
+from PyQt5.QtGui import QImage, QPixmap, QColor
+
+import profiling
+from thumbnails import thumbnail_cache
+
+
+# 工作线程通过这个对象把解码结果发回GUI线程（跨线程的信号会自动排队）
+class _Signals(QObject):
+    done = pyqtSignal(str, QImage, bool)
+    # (任务, 结果, 错误信息)
+    job_done = pyqtSignal(object, object, str)
+
+
+# 在线程池中执行的解码任务，同一个键只会有一个任务
+class _DecodeTask(QRunnable):
+    def __init__(self, signals, key, path, width, height):
+        super().__init__()
+        # 由Python管理生命周期，取消时可以安全地调用tryTake
+        self.setAutoDelete(False)
+        self.signals = signals
+        self.key = key
+        self.path = path
+        self.width = width
+        self.height = height
+        self.cancelled = False
+
+    def run(self):
+        if self.cancelled:
+            self.signals.done.emit(self.key, QImage(), True)
+            return
+        with profiling.action('decode', 'image', path=self.path, size='{}x{}'.format(self.width, self.height)):
+            image = thumbnail_cache.load_image(self.path, self.width, self.height, self.key)
+        self.signals.done.emit(self.key, image, False)
+
+
+# 在线程池中执行的其它图片处理（如导入图片存储），fn抛出OSError/ValueError时把错误信息发回
+class _JobTask(QRunnable):
+    def __init__(self, signals, fn, owner, callback):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.signals = signals
+        self.fn = fn
+        self.owner = owner
+        self.callback = callback
+        self.cancelled = False
+
+    def run(self):
+        if self.cancelled:
+            return
+        try:
+            result, error = self.fn(), ''
+        except (OSError, ValueError) as e:
+            result, error = None, str(e) or type(e).__name__
+        self.signals.job_done.emit(self, result, error)
+
+
+# 一次图片请求：加载完成后回调callback(pixmap)
+class ImageRequest:
+    def __init__(self, key, owner, callback):
+        self.key = key
+        self.owner = owner
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+# 异步图片加载器：1.先同步显示占位图（或内存缓存中已有的图片）
+#                2.在线程池中只解码到目标尺寸，完成后替换成真正的图片
+#                3.请求可以按owner（通常是对话框）批量取消
+class ImageLoader(QObject):
+    def __init__(self, max_threads=None):
+        super().__init__()
+        self.pool = QThreadPool()
+        if max_threads:
+            self.pool.setMaxThreadCount(max_threads)
+        self.signals = _Signals()
+        self.signals.done.connect(self.on_done)
+        self.signals.job_done.connect(self.on_job_done)
+        self._jobs = set()
+        # key -> 正在执行/排队的任务
+        self._tasks = {}
+        # key -> 等待该键的请求列表
+        self._requests = {}
+        self._placeholders = {}
+
+    # 纯色占位图，每种尺寸只生成一次
+    def placeholder(self, width, height):
+        pixmap = self._placeholders.get((width, height))
+        if pixmap is None:
+            pixmap = QPixmap(width, height)
+            pixmap.fill(QColor(Qt.lightGray))
+            self._placeholders[(width, height)] = pixmap
+        return pixmap
+
+    # 为target（QLabel）加载图片
+    def load(self, target, path, width, height, owner=None):
+        def deliver(pixmap):
+            if not sip.isdeleted(target):
+                target.setPixmap(pixmap)
+
+        target.setPixmap(self.fetch(path, width, height, owner, deliver))
+
+    # 立即返回可以显示的图片（缓存中的图片或占位图）
+    # 如果返回的是占位图，后台解码完成后调用callback(pixmap)
+    def fetch(self, path, width, height, owner=None, callback=None):
+        key = thumbnail_cache.key(path, width, height)
+        pixmap = thumbnail_cache.lookup(key)
+        if pixmap is not None:
+            return pixmap
+        if key is None or callback is None:
+            return self.placeholder(width, height)
+
+        request = ImageRequest(key, owner, callback)
+        self._requests.setdefault(key, []).append(request)
+        task = self._tasks.get(key)
+        if task is None:
+            task = _DecodeTask(self.signals, key, path, width, height)
+            self._tasks[key] = task
+            self.pool.start(task)
+        else:
+            task.cancelled = False
+        return self.placeholder(width, height)
+
+    # 解码完成（GUI线程）
+    def on_done(self, key, image, cancelled):
+        task = self._tasks.pop(key, None)
+        requests = [request for request in self._requests.pop(key, [])
+                    if not request.cancelled]
+        # 任务被取消后又有新的请求到来，重新排队
+        if cancelled and requests and task is not None:
+            task = _DecodeTask(self.signals, key, task.path, task.width, task.height)
+            self._tasks[key] = task
+            self._requests[key] = requests
+            self.pool.start(task)
+            return
+        if image.isNull():
+            return
+        pixmap = QPixmap.fromImage(image)
+        thumbnail_cache.remember(key, pixmap)
+        for request in requests:
+            request.callback(pixmap)
+
+    # 在线程池中执行fn()（不能在GUI线程中做的文件处理），完成后在GUI线程中调用callback(结果, 错误信息)，
+    # 出错时结果为None；owner被取消后不再回调
+    def run(self, fn, callback, owner=None):
+        task = _JobTask(self.signals, fn, owner, callback)
+        self._jobs.add(task)
+        self.pool.start(task)
+        return task
+
+    def on_job_done(self, task, result, error):
+        self._jobs.discard(task)
+        if not task.cancelled:
+            task.callback(result, error)
+
+    # 取消属于owner的所有请求；没有请求等待的任务如果还没开始就从队列中移除
+    def cancel(self, owner):
+        for task in list(self._jobs):
+            if task.owner is owner:
+                task.cancelled = True
+                if self.pool.tryTake(task):
+                    self._jobs.discard(task)
+        for key in list(self._requests):
+            requests = self._requests[key]
+            for request in requests:
+                if request.owner is owner:
+                    request.cancel()
+            if all(request.cancelled for request in requests):
+                self.cancel_task(key)
+
+    def cancel_task(self, key):
+        task = self._tasks.get(key)
+        if task is None:
+            return
+        task.cancelled = True
+        if self.pool.tryTake(task):
+            del self._tasks[key]
+            del self._requests[key]
+
+    # 丢弃排队中的任务并等待正在执行的任务结束（退出程序时使用）
+    def shutdown(self, msecs=-1):
+        self.pool.clear()
+        return self.pool.waitForDone(msecs)
+
+
+# 全局共享的图片加载器，需要在QApplication创建之后才能使用
+_image_loader = None
+
+
+def image_loader():
+    global _image_loader
+    if _image_loader is None:
+        _image_loader = ImageLoader()
+    return _image_loader
@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import quote
+
+from models import COORD_SCALE
+
+# 本地查询服务的负载测试：多个并发客户端（每个保持一个keep-alive连接）持续发送请求，
+# 统计吞吐量和延迟分布（p50/p95/p99）
+# 没有指定--url时会在空闲端口上启动server.py
+#
+# 用法：
+#   python loadtest.py [--clients 64] [--duration 10] [--writes 0.05] [--gui-writes]
+
+QUERIES = ['手机', '钱包', '毛巾', '港币', '书包', '打火机', '物品', '房间']
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, readers):
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+                                '--port', str(port), '--readers', str(readers)])
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError('server.py启动失败')
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server.py没有在30秒内启动')
+
+
+async def request(reader, writer, method, path, body=None):
+    data = json.dumps(body).encode('utf-8') if body is not None else b''
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n\r\n'.format(
+        method, path, len(data)).encode('latin-1') + data)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, kind, seconds, ok):
+        self.latencies.setdefault(kind, []).append(seconds)
+        if not ok:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def client(host, port, deadline, stats, writes, place_ids, item_ids):
+    reader, writer = await asyncio.open_connection(host, port)
+    rng = random.Random()
+    try:
+        while time.monotonic() < deadline:
+            roll = rng.random()
+            if roll < writes and item_ids:
+                kind, method, body = 'move', 'POST', {'place_id': rng.choice(place_ids),
+                                                       'x': rng.randrange(COORD_SCALE), 'y': rng.randrange(COORD_SCALE)}
+                path = '/items/{}/move'.format(rng.choice(item_ids))
+            elif roll < 0.7:
+                kind, method, body = 'search', 'GET', None
+                path = '/search?q={}&limit=50'.format(quote(rng.choice(QUERIES)))
+            elif roll < 0.85:
+                kind, method, body = 'places', 'GET', None
+                path = '/places?offset={}&limit=50'.format(rng.randrange(max(len(place_ids) - 50, 1)))
+            else:
+                kind, method, body = 'place_items', 'GET', None
+                path = '/places/{}/items'.format(rng.choice(place_ids))
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, method, path, body)
+            stats.add(kind, time.perf_counter() - start, status == 200)
+    finally:
+        writer.close()
+
+
+# 模拟界面同时写数据库：用ORM session不断修改物品的描述
+def gui_writer(stop, counters):
+    from models import Session, Item
+    session = Session()
+    ids = [row[0] for row in session.query(Item.id).limit(1000)]
+    while not stop.is_set() and ids:
+        try:
+            item = session.query(Item).get(random.choice(ids))
+            item.description = 'loadtest {}'.format(time.time())
+            session.commit()
+            counters['ok'] += 1
+        except Exception as e:
+            session.rollback()
+            counters['failed'] += 1
+            counters['error'] = str(e)
+        time.sleep(0.002)
+    session.close()
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run(host, port, clients, duration, writes):
+    reader, writer = await asyncio.open_connection(host, port)
+    _, listing = await request(reader, writer, 'GET', '/places?limit=1000')
+    place_ids = [place['id'] for place in listing['places']]
+    item_ids = []
+    for place_id in place_ids[:20]:
+        _, data = await request(reader, writer, 'GET', '/places/{}/items'.format(place_id))
+        item_ids.extend(item['id'] for item in data['items'])
+    writer.close()
+
+    stats = Stats()
+    start = time.monotonic()
+    await asyncio.gather(*[client(host, port, start + duration, stats, writes, place_ids, item_ids)
+                           for _ in range(clients)])
+    return stats, time.monotonic() - start
+
+
+def report(stats, elapsed, out=sys.stdout):
+    total = sum(len(latencies) for latencies in stats.latencies.values())
+    out.write('{} 个请求, {:.1f}秒, {:.0f} 请求/秒\n'.format(total, elapsed, total / elapsed))
+    out.write('{:<14}{:>8}{:>8}{:>10}{:>10}{:>10}{:>10}\n'.format(
+        'request', 'count', 'errors', 'p50(ms)', 'p95(ms)', 'p99(ms)', 'max(ms)'))
+    everything = []
+    for kind, latencies in sorted(stats.latencies.items()):
+        everything.extend(latencies)
+        ordered = sorted(latencies)
+        out.write('{:<14}{:>8}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}\n'.format(
+            kind, len(ordered), stats.errors.get(kind, 0), percentile(ordered, 0.5) * 1000,
+            percentile(ordered, 0.95) * 1000, percentile(ordered, 0.99) * 1000, ordered[-1] * 1000))
+    ordered = sorted(everything)
+    out.write('{:<14}{:>8}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}\n'.format(
+        'all', len(ordered), sum(stats.errors.values()), percentile(ordered, 0.5) * 1000,
+        percentile(ordered, 0.95) * 1000, percentile(ordered, 0.99) * 1000, ordered[-1] * 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='本地查询服务的负载测试')
+    parser.add_argument('--url', help='已经运行的服务，如 http://127.0.0.1:8765')
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--writes', type=float, default=0.05, help='移动物品请求的比例')
+    parser.add_argument('--readers', type=int, default=8, help='启动服务时的读取线程数')
+    parser.add_argument('--gui-writes', action='store_true', help='同时模拟界面写数据库')
+    args = parser.parse_args(argv)
+
+    process = None
+    if args.url:
+        host, _, port = args.url.split('//')[-1].rstrip('/').partition(':')
+        port = int(port or 80)
+    else:
+        host, port = '127.0.0.1', free_port()
+        process = start_server(port, args.readers)
+
+    stop = threading.Event()
+    counters = {'ok': 0, 'failed': 0}
+    thread = None
+    if args.gui_writes:
+        thread = threading.Thread(target=gui_writer, args=(stop, counters), daemon=True)
+        thread.start()
+    try:
+        stats, elapsed = asyncio.run(run(host, port, args.clients, args.duration, args.writes))
+    finally:
+        stop.set()
+        if thread is not None:
+            thread.join()
+        if process is not None:
+            process.terminate()
+            process.wait()
+    report(stats, elapsed)
+    if thread is not None:
+        sys.stdout.write('界面写入: 成功 {}, 失败 {}{}\n'.format(
+            counters['ok'], counters['failed'],
+            ', 最后的错误: ' + counters['error'] if counters['failed'] else ''))
+    return 1 if stats.errors or counters['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
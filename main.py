@@ -1,107 +1,95 @@
+# 最先导入startup，启动计时从这里开始
+import startup
 import sys
+import threading
+from functools import partial
 
-from PyQt5.QtCore import Qt
+from PyQt5 import sip
+from PyQt5.QtCore import Qt, QEvent, QPoint, QRect, QRectF, QSize, QTimer, pyqtSignal
 from PyQt5.QtCore import QDir
-from PyQt5.QtGui import QPixmap, QPalette, QImage, QPainter, QBrush, QColor
-from PyQt5.QtWidgets import QWidget, QLabel, QVBoxLayout, QApplication, QGridLayout, QScrollArea, QPushButton, QDialog, \
-    QLineEdit, QFileDialog, QMessageBox, QDialogButtonBox, QListWidget, QListWidgetItem, QTextEdit, QHBoxLayout
-from models import Place, session, Item
-
-
-# 场景组件：1.渲染场景的名字，图片，包含物品个数
-#          2.对鼠标点击作出反应，弹出该场景的详细内容
-class PlaceWidget(QWidget):
-    def __init__(self, place, parent):
+from PyQt5.QtGui import QPixmap, QPalette, QImage, QPainter, QBrush, QColor, QImageReader
+from PyQt5.QtWidgets import QWidget, QLabel, QVBoxLayout, QApplication, QPushButton, QDialog, \
+    QLineEdit, QFileDialog, QMessageBox, QDialogButtonBox, QListView, QTextEdit, QHBoxLayout, QToolTip, \
+    QSizePolicy, QRubberBand, QMenu
+import backup
+from events import bus
+from models import Place, session, Item, get_engine, COORD_SCALE, is_ancestor
+from image_loader import image_loader
+from markers import MarkerIndex, MARKER_SIZE
+from media import ingest
+from memory import MemoryMonitor
+from persistence import writer
+from place_view import PlaceGridView, PlaceListModel, PlaceRole
+import profiling
+from repository import repository
+from search import SearchPipeline, SearchResultModel, ResultRole, search_records, replace_record, record_matches
+from tiles import load_pyramid
+
+startup.mark('import')
+
+# 全局搜索最多返回的结果数（结果在列表中分页显示）
+SEARCH_LIMIT = 1000
+
+
+# 场景内搜索只匹配物品名字
+def name_matches(item, text):
+    return text in item.name
+
+
+# 以模态方式运行对话框，结束后释放
+# 对话框的父对象是长期存在的控件，不释放的话每次打开的对话框（连同图片）都会一直保留
+# 开启profiling时记录从显示到第一次处理完绘制等事件的时间（创建的时间由__init__记录）
+def exec_dialog(dialog):
+    started = profiling.now()
+    if started is not None:
+        name = type(dialog).__name__ + '.show'
+        QTimer.singleShot(0, lambda: profiling.span(name, started, 'dialog'))
+    try:
+        return dialog.exec_()
+    finally:
+        dialog.deleteLater()
+
+
+# 场景列表：包含所有的顶层场景（子场景在打开所在的场景后显示），物品个数包括子场景中的物品
+# 场景由PlaceGridView按需绘制，只有可见的格子才会读取图片，滚动时分页读取场景
+# 创建时不访问数据库，窗口显示之后由Main调用flush()读取
+class PlaceListWidget(QWidget):
+    def __init__(self):
         super().__init__()
-        self.parent = parent
-        self.place = place
-        # 场景图片
-        label_image = QLabel(self)
-        pixmap = QPixmap(place.image).scaled(200, 200)
-        label_image.setPixmap(pixmap)
-        # 场景名字
-        label_name = QLabel(self)
-        label_name.setText(place.name)
-        # 包含物品个数
-        self.label_count = QLabel(self)
-        self.label_count.setText("{}个物品".format(len(place.items)))
-
-        # 将上面三个内容垂直布局
+        self.view = PlaceGridView(self, load=False, scope=None)
+        self.view.place_clicked.connect(self.open_place)
+        # "添加场景"按钮
+        self.add_widget = AddPlaceWidget(self)
+
         vbox = QVBoxLayout()
-        vbox.addWidget(label_image)
-        vbox.addWidget(label_name)
-        vbox.addWidget(self.label_count)
+        vbox.addWidget(self.view)
+        vbox.addWidget(self.add_widget)
         self.setLayout(vbox)
 
-    # 对鼠标点击事件作出反应，弹出详细信息对话框
-    def mousePressEvent(self, event):
-        dialog = AddItemDialog(self, self.place)
-        dialog.exec_()
-        self.parent.flush_count()
+    # 对场景点击作出反应，弹出详细信息对话框
+    # 场景和物品个数的变化由PlaceListModel通过events.bus()逐个更新
+    def open_place(self, place):
+        dialog = AddItemDialog(self, place)
+        exec_dialog(dialog)
 
-    # 刷新物品数目
+    # 重新读取整个场景列表
+    @profiling.timed
     def flush(self):
-        self.label_count.setText("{}个物品".format(len(self.place.items)))
-
-
-# 场景列表：包含所有的场景
-class PlaceListWidget(QWidget):
-    def __init__(self):
-        super().__init__()
-
-        self.set_grid()
-
-    # 将所有场景进行网格布局
-    def set_grid(self):
-        grid = QGridLayout()
-        places = session.query(Place)
-        # 每行放置2个，计算需要的行数，最后需要有一个"添加"按钮
-        # 所以总数是场景个数+1
-        row_count = (places.count() + 1) // 2 + 1
-        # 实例化所有场景组件
-        self.widgets = [PlaceWidget(place, self) for place in places]
-        # 将"添加场景"按钮加到场景列表中
-        self.widgets.append(AddPlaceWidget(self))
-        # 每个场景组件的具体位置
-        positions = [(i, j) for i in range(row_count) for j in range(2)]
-        positions = positions[:places.count() + 1]
-        # 将所有场景组件加到网格布局中
-        for position, widget in zip(positions, self.widgets):
-            grid.addWidget(widget, *position)
-        # 设置布局
-        self.setLayout(grid)
-
-    # 刷新场景列表（添加/删除场景后）
-    def flush(self):
-        self.layout().setEnabled(False)
-        QWidget().setLayout(self.layout())
-        self.set_grid()
-        self.repaint()
-
-    # 刷新所有场景组件中的物品计数（用于添加/移动/删除物品）
-    def flush_count(self):
-        for widget in self.widgets:
-            widget.flush()
+        self.view.model().reload()
 
 
 # 添加新场景组件
 # 其实就是一个按钮，会对鼠标点击作出反应，弹出对话框
-# 下面内容和PlaceWidget类似，不再赘述
+# parent_place不为None时添加的是它的子场景
 class AddPlaceWidget(QWidget):
-    def __init__(self, widget_list):
+    def __init__(self, widget_list, parent_place=None, text='新增'):
         super().__init__()
         self.widget_list = widget_list
-        add_button = QPushButton('新增', self)
-        add_button.setFixedSize(200, 200)
-        label_name = QLabel(self)
-        label_name.setText('')
-        label_count = QLabel(self)
-        label_count.setText('')
+        self.parent_place = parent_place
+        add_button = QPushButton(text, self)
 
         vbox = QVBoxLayout()
         vbox.addWidget(add_button)
-        vbox.addWidget(label_name)
-        vbox.addWidget(label_count)
         self.setLayout(vbox)
 
         # 将鼠标点击事件关联到add_place方法
@@ -111,25 +99,26 @@ class AddPlaceWidget(QWidget):
     def add_place(self):
         # 弹出对话框添加场景
         dialog = AddPlaceDialog(self)
-        result = dialog.exec_()
+        result = exec_dialog(dialog)
         # 将结果保存到数据库并刷新场景列表
         if result:
+            # 写入完成后场景列表会自动刷新
             place = Place(name=dialog.name, image=dialog.image)
-            session.add(place)
-            session.commit()
-            self.widget_list.flush()
-
-    # 接口兼容
-    def flush(self):
-        pass
+            if self.parent_place is None:
+                writer().add(place)
+            else:
+                writer().add(place, parent=self.parent_place)
 
 
 # 添加新场景对话框
 # 用于添加新场景
 class AddPlaceDialog(QDialog):
+    @profiling.timed(category='dialog')
     def __init__(self, parent):
         super(AddPlaceDialog, self).__init__(parent)
         self.parent = parent
+        # 对话框关闭时取消尚未完成的图片解码
+        self.finished.connect(lambda: image_loader().cancel(self))
 
         # 选择照片
         self.button = QPushButton('选择照片')
@@ -147,6 +136,9 @@ class AddPlaceDialog(QDialog):
         self.button_box = QDialogButtonBox(QDialogButtonBox.Ok |
                                            QDialogButtonBox.Cancel)
 
+        # 图片导入存储完成之前不能确定
+        self.ok_button = self.button_box.button(QDialogButtonBox.Ok)
+        self.ok_button.setEnabled(False)
         # 确定后的行为（执行submit方法）
         self.button_box.accepted.connect(self.submit)
         # 取消后的行为（返回）
@@ -163,25 +155,40 @@ class AddPlaceDialog(QDialog):
 
         self.image = None
         self.name = None
+        # 正在导入存储的图片（后台线程），完成后self.image是存储中的路径
+        self.ingesting = None
 
     # 添加照片的具体方法
     def open(self):
         # 弹出选择对话框
         fileName, _ = QFileDialog.getOpenFileName(self, "Open File",
                                                   QDir.currentPath())
-        # 判断用户选择的照片是否合法并作出提示
+        # 判断用户选择的照片是否合法并作出提示（只读取文件头，不解码）
         if fileName:
-            image = QImage(fileName)
-            if image.isNull():
+            if not QImageReader(fileName).canRead():
                 QMessageBox.information(self, "",
                                         "无法加载图片:%s." % fileName)
                 return
-            else:
-                self.image = fileName
+            self.image = None
 
-            # 设置显示照片预览
-            self.image_label.setPixmap(QPixmap.fromImage(image).scaled(200, 200))
+            # 设置显示照片预览（后台解码）
+            image_loader().load(self.image_label, fileName, 200, 200, owner=self)
             self.scaleFactor = 1.0
+            # 把图片复制到存储中并生成缩略图和瓦片（大图要几秒，在线程池中执行），场景保存存储中的路径
+            self.ingesting = fileName
+            self.ok_button.setEnabled(False)
+            image_loader().run(partial(ingest, fileName), partial(self.on_ingested, fileName), owner=self)
+
+    def on_ingested(self, fileName, stored, error):
+        # 导入期间又选择了其它图片
+        if fileName != self.ingesting:
+            return
+        self.ingesting = None
+        if error:
+            QMessageBox.information(self, "", "无法保存图片:%s." % error)
+            return
+        self.image = stored
+        self.ok_button.setEnabled(True)
 
     # 提交对话框
     def submit(self):
@@ -190,75 +197,434 @@ class AddPlaceDialog(QDialog):
             QMessageBox.information(self, "",
                                     "必须指定图片和名称！")
             return
-        else:
-            self.accept()
+        self.accept()
+
+
+# 场景图片最多放大到原图的2倍
+MAX_SCALE = 2.0
+# 滚轮每一格缩放的倍数
+ZOOM_STEP = 2 ** 0.5
 
 
 # 用于显示一个场景中的所有物品位置
-# 可以对鼠标点击作出反应，在点击处添加物品
-class ImageLabel(QLabel):
-    def __init__(self, parent, place):
+# 可以对鼠标点击作出反应，在点击处添加物品；滚轮缩放，按住左键拖动平移
+# selectable为True时按住Shift拖动框选多个物品，一起移动或删除
+# 图片有瓦片金字塔（tiles.py）时按缩放比例选择一层，只读取可见的瓦片；没有时显示整张图片
+# 物品坐标是相对于图片的位置（models.COORD_SCALE），标记的窗口坐标在缩放/平移后重新计算
+# 物品标记在paintEvent中一次绘制，点击通过网格索引查找物品，重叠的标记合并显示为数字
+class ImageLabel(QWidget):
+    def __init__(self, parent, place, selectable=True):
         super().__init__(parent)
         self.parent = parent
-        # 设置显示区域大小
-        self.setFixedSize(400, 400)
-        self.setPixmap(QPixmap(place.image).scaled(400, 400))
-        self.item_buttons = []
+        self.place = place
+        self.selectable = selectable
+        # 默认显示区域大小，对话框变大时随之变大
+        self.setMinimumSize(400, 400)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.pyramid = load_pyramid(place.image)
+        if self.pyramid is not None:
+            self.image_size = (self.pyramid.width, self.pyramid.height)
+        else:
+            # 只读取文件头中的尺寸
+            size = QImageReader(place.image or '').size()
+            self.image_size = (size.width(), size.height()) if not size.isEmpty() else (400, 400)
+        # 缩放倍数（1为整张图片适应窗口）和窗口中心对应的图片位置（0~1）
+        self.zoom = 1.0
+        self.center = (0.5, 0.5)
+        # 正在后台读取的瓦片，避免重复请求
+        self._pending = set()
+        # 按下鼠标的位置和当时的中心，移动超过拖动距离后开始平移
+        self._press = None
+        self._press_center = None
+        self._dragging = False
+        # 框选：显示的矩形在第一次使用时创建，之后重复使用
+        self._band = None
+        self._band_origin = None
+        # 框选中的物品id
+        self.chosen = set()
+        # 物品坐标 -> 窗口坐标的换算：(图片左边, 图片上边, x的比例, y的比例)
+        self._transform = (0, 0, 1, 1)
+        self.update_transform()
+        self.markers = MarkerIndex()
+        # 物品id -> 物品
+        self.marker_items = {}
+        # 当前选中（绿色）的物品id
+        self.selected = None
+        # 正在移动、暂时不显示的物品id
+        self.hidden = set()
         # 绘制所有已经存在的物品
         self.drawItems()
 
-    # 鼠标点击事件：弹出添加物品的对话框
+    # 整张图片适应窗口时的比例（窗口像素/原图像素）
+    def fit_scale(self):
+        width, height = self.image_size
+        return min(self.width() / width, self.height() / height)
+
+    def scale(self):
+        return self.fit_scale() * self.zoom
+
+    def max_zoom(self):
+        return max(1.0, MAX_SCALE / self.fit_scale())
+
+    # 图片左上角在窗口中的位置
+    def origin(self):
+        width, height = self.image_size
+        scale = self.scale()
+        return (self.width() / 2 - self.center[0] * width * scale,
+                self.height() / 2 - self.center[1] * height * scale)
+
+    def image_rect(self):
+        x, y = self.origin()
+        width, height = self.image_size
+        scale = self.scale()
+        return QRectF(x, y, width * scale, height * scale)
+
+    # 窗口坐标 -> 图片中的相对位置（0~1，可能在图片之外）
+    def image_point(self, pos):
+        x, y = self.origin()
+        width, height = self.image_size
+        scale = self.scale()
+        return (pos.x() - x) / (width * scale), (pos.y() - y) / (height * scale)
+
+    # 窗口坐标 -> 物品坐标（限制在图片范围内）
+    def item_position(self, pos):
+        u, v = self.image_point(pos)
+        return (min(max(int(round(u * COORD_SCALE)), 0), COORD_SCALE),
+                min(max(int(round(v * COORD_SCALE)), 0), COORD_SCALE))
+
+    # 物品坐标 -> 窗口坐标
+    def to_screen(self, x, y):
+        left, top, sx, sy = self._transform
+        return int(left + x * sx + 0.5), int(top + y * sy + 0.5)
+
+    def update_transform(self):
+        rect = self.image_rect()
+        self._transform = (rect.x(), rect.y(), rect.width() / COORD_SCALE, rect.height() / COORD_SCALE)
+
+    # 修改缩放和中心：图片比窗口小的方向居中，否则不能拖出图片的边界
+    def set_view(self, zoom, center):
+        self.zoom = min(max(zoom, 1.0), self.max_zoom())
+        width, height = self.image_size
+        scale = self.scale()
+
+        def clamp(value, extent, view):
+            if extent <= view:
+                return 0.5
+            half = view / 2 / extent
+            return min(max(value, half), 1 - half)
+
+        self.center = (clamp(center[0], width * scale, self.width()),
+                       clamp(center[1], height * scale, self.height()))
+        self.update_transform()
+        # 不再可见的瓦片不需要继续读取，仍然可见的在绘制时重新请求
+        image_loader().cancel(self.parent)
+        self._pending.clear()
+        self.layout_markers()
+        self.update()
+
+    def resizeEvent(self, event):
+        self.set_view(self.zoom, self.center)
+
+    # 以鼠标所在的位置为中心缩放
+    def wheelEvent(self, event):
+        steps = event.angleDelta().y() / 120
+        if not steps:
+            return
+        u, v = self.image_point(event.pos())
+        zoom = min(max(self.zoom * ZOOM_STEP ** steps, 1.0), self.max_zoom())
+        width, height = self.image_size
+        scale = self.fit_scale() * zoom
+        self.set_view(zoom, (u - (event.pos().x() - self.width() / 2) / (width * scale),
+                             v - (event.pos().y() - self.height() / 2) / (height * scale)))
+
+    def mousePressEvent(self, event):
+        if self.selectable and event.button() == Qt.LeftButton and event.modifiers() & Qt.ShiftModifier:
+            self._band_origin = event.pos()
+            if self._band is None:
+                self._band = QRubberBand(QRubberBand.Rectangle, self)
+            self._band.setGeometry(QRect(event.pos(), QSize()))
+            self._band.show()
+            return
+        self._press = event.pos()
+        self._press_center = self.center
+        self._dragging = False
+
+    def mouseMoveEvent(self, event):
+        if self._band_origin is not None:
+            self._band.setGeometry(QRect(self._band_origin, event.pos()).normalized())
+            return
+        if self._press is None or not event.buttons() & Qt.LeftButton:
+            return
+        delta = event.pos() - self._press
+        if not self._dragging and delta.manhattanLength() < QApplication.startDragDistance():
+            return
+        self._dragging = True
+        width, height = self.image_size
+        scale = self.scale()
+        self.set_view(self.zoom, (self._press_center[0] - delta.x() / (width * scale),
+                                  self._press_center[1] - delta.y() / (height * scale)))
+
+    # 拖动结束不算点击
     def mouseReleaseEvent(self, event):
+        if self._band_origin is not None:
+            self._band.hide()
+            rect = QRect(self._band_origin, event.pos()).normalized()
+            self._band_origin = None
+            self.choose_in(rect, event.globalPos())
+            return
+        dragging = self._dragging
+        self._press = None
+        self._dragging = False
+        if not dragging:
+            self.click(event)
+
+    # 鼠标点击：点击物品则弹出物品的详细信息，否则弹出添加物品的对话框
+    def click(self, event):
+        item_id = self.marker_at(event.x(), event.y())
+        if item_id is not None:
+            self.edit_item(self.marker_items[item_id])
+            return
         dialog = EditItem(self.parent, event=event)
-        result = dialog.exec_()
-        # 更新场景信息（如物品数量）
-        session.add(self.parent.place)
-        session.commit()
+        result = exec_dialog(dialog)
+
+    # 框选结束：标出矩形中的物品，弹出菜单选择移动或删除（由父对话框执行）
+    def choose_in(self, rect, global_pos):
+        ids = [item_id for item_id in self.markers.in_rect(rect.x(), rect.y(), rect.width(), rect.height())
+               if item_id not in self.hidden]
+        if not ids:
+            return
+        self.chosen = set(ids)
+        self.update()
+        items = [self.marker_items[item_id] for item_id in ids]
+        menu = QMenu(self)
+        move = menu.addAction("移动{}个物品".format(len(items)))
+        delete = menu.addAction("删除{}个物品".format(len(items)))
+        action = menu.exec_(global_pos)
+        menu.deleteLater()
+        self.chosen = set()
+        self.update()
+        if action is move:
+            self.parent.move_items(items)
+        elif action is delete:
+            self.parent.delete_items(items)
+
+    # 对物品点击的响应是创建一个新的对话框
+    # 在该对话框中可以编辑信息/移动/删除
+    def edit_item(self, item):
+        dialog = EditItem(self.parent, item)
+        result = exec_dialog(dialog)
+
+    # 鼠标停留在物品上时显示物品名字
+    def event(self, event):
+        if event.type() == QEvent.ToolTip:
+            item_id = self.marker_at(event.pos().x(), event.pos().y())
+            if item_id is None:
+                QToolTip.hideText()
+                event.ignore()
+            else:
+                QToolTip.showText(event.globalPos(), self.marker_items[item_id].name, self)
+            return True
+        return super().event(event)
+
+    def marker_at(self, x, y):
+        item_id = self.markers.hit(x, y)
+        if item_id is None or item_id in self.hidden:
+            return None
+        return item_id
 
     # 重新绘制所有物品
+    @profiling.timed
     def flush(self):
+        self.markers.clear()
+        self.marker_items = {}
         self.drawItems()
+        self.update()
+
+    # 缩放/平移后重新计算所有标记的窗口坐标
+    def layout_markers(self):
+        left, top, sx, sy = self._transform
+        self.markers.reset((item.id, int(left + item.x * sx + 0.5), int(top + item.y * sy + 0.5))
+                           for item in self.marker_items.values())
 
     # 绘制物品
     def drawItems(self):
         for item in self.parent.items:
-            self.add_button(item)
-
-    # 添加新的物品，每个物品用一个按钮表示，点击该按钮
-    # 会弹出物品的详细信息
-    def add_button(self, item):
-        button = self.create_button(item)
-        button.setVisible(True)
-        self.item_buttons.append(button)
-
-    def create_button(self, item):
-        button = QPushButton('', self)
-        # 设置物品按钮的颜色大小
-        button.setStyleSheet("background-color: yellow")
-        button.setGeometry(item.x, item.y, 10, 10)
-        # 按钮提示信息显示物品名字
-        button.setToolTip(item.name)
-        # 按钮和物品进行关联，简化编程实现
-        button.item = item
-        item.button = button
-        # 对物品点击进行响应
-        button.clicked.connect(self.make_edit_item(button))
-        return button
+            self.add_marker(item)
 
-    # 对物品点击的响应是创建一个新的对话框
-    # 在该对话框中可以编辑信息/移动/删除
-    def make_edit_item(self, button):
-        def edit_item():
-            dialog = EditItem(self.parent, button.item)
-            result = dialog.exec_()
+    # 添加新的物品
+    def add_marker(self, item):
+        self.markers.add(item.id, *self.to_screen(item.x, item.y))
+        self.marker_items[item.id] = item
+        self.update_marker_rect(item.id)
+
+    def remove_marker(self, item):
+        if item.id not in self.markers:
+            return
+        self.update_marker_rect(item.id)
+        self.markers.remove(item.id)
+        self.marker_items.pop(item.id, None)
+        self.hidden.discard(item.id)
+        if self.selected == item.id:
+            self.selected = None
+
+    # 物品位置改变
+    def move_marker(self, item):
+        if item.id not in self.markers:
+            self.add_marker(item)
+            return
+        self.update_marker_rect(item.id)
+        self.markers.move(item.id, *self.to_screen(item.x, item.y))
+        self.update_marker_rect(item.id)
+
+    # 批量移除/移动/隐藏（框选的物品），最后只重绘一次
+    def remove_markers(self, items):
+        for item in items:
+            self.markers.remove(item.id)
+            self.marker_items.pop(item.id, None)
+            self.hidden.discard(item.id)
+            if self.selected == item.id:
+                self.selected = None
+        self.update()
+
+    def move_markers(self, items):
+        for item in items:
+            self.marker_items[item.id] = item
+            self.markers.add(item.id, *self.to_screen(item.x, item.y))
+        self.update()
+
+    def set_hidden_many(self, items, hidden):
+        ids = {item.id for item in items}
+        if hidden:
+            self.hidden.update(ids)
+        else:
+            self.hidden.difference_update(ids)
+        self.update()
 
-        return edit_item
+    def set_hidden(self, item, hidden):
+        if hidden:
+            self.hidden.add(item.id)
+        else:
+            self.hidden.discard(item.id)
+        self.update_marker_rect(item.id)
+
+    # 选中物品（以绿色标记出来），只重绘新旧两个标记所在的区域
+    # 放大后物品不在可见范围内时移动到物品的位置
+    def select(self, item):
+        old = self.selected
+        self.selected = item.id if item is not None else None
+        for item_id in (old, self.selected):
+            if item_id is not None:
+                self.update_marker_rect(item_id)
+        if self.selected in self.markers and not self.rect().contains(*self.markers.position(self.selected)):
+            self.set_view(self.zoom, (item.x / COORD_SCALE, item.y / COORD_SCALE))
+
+    # 标记所在的格子可能合并显示，重绘整个格子及其周围
+    def update_marker_rect(self, item_id):
+        if item_id not in self.markers:
+            return
+        x, y = self.markers.position(item_id)
+        size = self.markers.cell_size
+        self.update(QRect(x - size, y - size, 3 * size, 3 * size))
+
+    @profiling.timed(category='paint')
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        rect = event.rect()
+        if self.pyramid is not None:
+            self.draw_tiles(painter, rect)
+        else:
+            self.draw_image(painter)
+        selected = None
+        yellow = QColor('yellow')
+        cyan = QColor('cyan')
+        for _, members in self.markers.cells_in(rect.x(), rect.y(), rect.width(), rect.height()):
+            members = [item_id for item_id in members if item_id not in self.hidden]
+            if self.selected in members:
+                selected = self.selected
+            if len(members) == 1:
+                x, y = self.markers.position(members[0])
+                painter.fillRect(x, y, MARKER_SIZE, MARKER_SIZE, cyan if members[0] in self.chosen else yellow)
+            elif members:
+                self.draw_cluster(painter, members)
+        # 选中的物品画在最上面
+        if selected is not None:
+            x, y = self.markers.position(selected)
+            painter.fillRect(x, y, MARKER_SIZE, MARKER_SIZE, QColor('green'))
+        painter.end()
+
+    # 多个物品挤在同一个格子中：在中心画一个圆并显示个数
+    def draw_cluster(self, painter, members):
+        positions = [self.markers.position(item_id) for item_id in members]
+        cx = sum(x for x, _ in positions) // len(positions) + MARKER_SIZE // 2
+        cy = sum(y for _, y in positions) // len(positions) + MARKER_SIZE // 2
+        radius = MARKER_SIZE - 1
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QColor('orange'))
+        painter.drawEllipse(QPoint(cx, cy), radius, radius)
+        painter.setPen(Qt.black)
+        painter.drawText(QRect(cx - radius, cy - radius, 2 * radius, 2 * radius),
+                         Qt.AlignCenter, str(len(members)))
+
+    # 没有瓦片的图片：和以前一样读取400x400的整张图片（可以使用预先生成的尺寸），按图片比例显示
+    def draw_image(self, painter):
+        pixmap = self.fetch(self.place.image, 400, 400, None)
+        if pixmap is None:
+            pixmap = image_loader().placeholder(400, 400)
+        painter.drawPixmap(self.image_rect(), pixmap, QRectF(pixmap.rect()))
+
+    # 先画只有一个瓦片的最粗糙的一层，还没有读到的瓦片处显示它放大后的样子，
+    # 再画当前缩放比例对应的一层中与重绘区域相交的瓦片
+    def draw_tiles(self, painter, rect):
+        pyramid = self.pyramid
+        coarse = pyramid.levels - 1
+        if not self.draw_tile(painter, coarse, 0, 0):
+            painter.fillRect(self.image_rect(), QColor(Qt.lightGray))
+        scale = self.scale()
+        level = pyramid.level_for(scale)
+        if level == coarse:
+            return
+        x, y = self.origin()
+        for column, row in pyramid.tiles_in(level, (rect.x() - x) / scale, (rect.y() - y) / scale,
+                                            rect.width() / scale, rect.height() / scale):
+            self.draw_tile(painter, level, column, row)
+
+    def draw_tile(self, painter, level, column, row):
+        x, y, width, height = self.pyramid.tile_rect(level, column, row)
+        pixmap = self.fetch(self.pyramid.tile_path(level, column, row), width, height, (level, column, row))
+        if pixmap is None:
+            return False
+        # 第level层的一个像素在窗口中的大小
+        factor = self.scale() * 2 ** level
+        left, top = self.origin()
+        painter.drawPixmap(QRectF(left + x * factor, top + y * factor, width * factor, height * factor),
+                           pixmap, QRectF(0, 0, width, height))
+        return True
+
+    # 内存中已有的图片，没有则在后台读取（完成后重绘）并返回None
+    def fetch(self, path, width, height, key):
+        callback = None
+        if key not in self._pending:
+            callback = partial(self.on_loaded, key)
+        pixmap = image_loader().fetch(path, width, height, owner=self.parent, callback=callback)
+        if pixmap is image_loader().placeholder(width, height):
+            if callback is not None:
+                self._pending.add(key)
+            return None
+        return pixmap
+
+    def on_loaded(self, key, pixmap):
+        if sip.isdeleted(self):
+            return
+        self._pending.discard(key)
+        self.update()
 
 
 # 添加物品/物品编辑对话框
 class EditItem(QDialog):
     # 如果item为None则为添加新的物品
     # item不为None则是编辑已经存在的物品
+    @profiling.timed(category='dialog')
     def __init__(self, parent, item=None, event=None):
         super().__init__(parent)
 
@@ -312,37 +678,34 @@ class EditItem(QDialog):
     def delete(self):
         if not self.item:
             return
-        self.item.button.setVisible(False)
+        self.parent.image_label.remove_marker(self.item)
         self.parent.items.remove(self.item)
-        # 刷新显示
-        self.parent.flush()
-        # 更新数据库
-        session.delete(self.item)
-        session.commit()
+        # 只更新列表中的这一行
+        self.parent.apply_item(self.item)
+        # 更新数据库（后台写入）
+        writer().delete(self.item)
         self.accept()
 
     # 移动操作
     def move(self):
-        self.item.button.setVisible(False)
-        a = self.item
+        image_label = self.parent.image_label
+        image_label.set_hidden(self.item, True)
         # 在对话中选择移动的目的地和位置
-        dialog = MovePlaceListDialog(self, self.item)
-        result = dialog.exec_()
+        dialog = MovePlaceListDialog(self, [self.item])
+        result = exec_dialog(dialog)
 
         # 移动成功则对当前显示进行刷新
         if result:
-            print(a == self.item)
-            self.item.button.setVisible(False)
-
             if self.parent.place == self.item.place:
-                self.parent.flush()
-                self.parent.image_label.flush()
+                image_label.move_marker(self.item)
+                image_label.set_hidden(self.item, False)
             else:
+                image_label.remove_marker(self.item)
                 self.parent.items.remove(self.item)
-                self.parent.flush()
+                self.parent.apply_item(self.item)
             self.accept()
         else:
-            self.item.button.setVisible(True)
+            image_label.set_hidden(self.item, False)
 
     def submit(self):
         if not self.line_edit.text():
@@ -350,64 +713,55 @@ class EditItem(QDialog):
                                     "必须指定名称！")
             return
         else:
+            name = self.line_edit.text()
+            description = self.textedit.toPlainText()
+            # 修改立即反映到界面，数据库由后台写入
             if self.item is None:
-                self.item = Item(name='', description='',
-                                 x=self.event.x(), y=self.event.y(),
-                                 place=self.parent.place)
-            self.item.name = self.line_edit.text()
-            self.item.description = self.textedit.toPlainText()
-            session.add(self.item)
-            session.commit()
-            print(self.item, self.parent.items)
+                x, y = self.parent.image_label.item_position(self.event.pos())
+                self.item = writer().add(Item(name=name, description=description, x=x, y=y),
+                                         place=self.parent.place)
+            else:
+                writer().update(self.item, name=name, description=description)
             if self.item not in self.parent.items:
                 self.parent.items.append(self.item)
-                self.parent.image_label.add_button(self.item)
-            self.parent.flush()
+                self.parent.image_label.add_marker(self.item)
+            self.parent.apply_item(self.item)
             self.accept()
 
 
-# 移动到的场景
-class MovePlaceWidget(PlaceWidget):
-    def __init__(self, place, item, parent):
-        super().__init__(place, parent)
-        self.parent = parent
-        self.place = place
-        self.item = item
-
-    def mousePressEvent(self, event):
-        dialog = MoveItemDialog(self, self.place, self.item)
-        result = dialog.exec_()
-        if result:
-            self.parent.accept()
-        self.flush()
-
-
 # 移动到的具体位置
 class MoveItemDialog(QDialog):
-    def __init__(self, parent, place, item):
+    @profiling.timed(category='dialog')
+    def __init__(self, parent, place, moving):
         super().__init__(parent)
+        # 对话框关闭时取消尚未完成的图片解码
+        self.finished.connect(lambda: image_loader().cancel(self))
         self.parent = parent
-        self.item = item
+        # 要移动的物品（一个或框选的多个）
+        self.moving = moving
         self.place = place
-        self.items = list(place.items)
+        self.items = repository().place_items(place)
         self.text_label = QLabel(self)
         self.text_label.setText("请点击要将item移动到的位置")
-        self.image_label = ImageLabel(self, place)
-        self.image_label.mouseReleaseEvent = self.mouseReleaseEvent_new
+        self.image_label = ImageLabel(self, place, selectable=False)
+        # 点击（不是拖动）图片时移动到点击的位置
+        self.image_label.click = self.move_to
 
         vbox = QVBoxLayout()
         vbox.addWidget(self.text_label)
         vbox.addWidget(self.image_label)
         self.setLayout(vbox)
 
-    def mouseReleaseEvent_new(self, event):
-        self.item.place = self.place
-        # self.item.button.hide()
-        self.item.x = event.x()
-        self.item.y = event.y()
-        # self.image_label.add_button(self.item)
-        session.add(self.item)
-        session.commit()
+    # 多个物品保持相对位置，以它们的中心对准点击处；所有物品在一个事务中写入
+    def move_to(self, event):
+        x, y = self.image_label.item_position(event.pos())
+        cx = sum(item.x for item in self.moving) / len(self.moving)
+        cy = sum(item.y for item in self.moving) / len(self.moving)
+
+        def clamp(value):
+            return min(max(int(round(value)), 0), COORD_SCALE)
+        writer().update_many([(item, {'place': self.place, 'x': clamp(x + item.x - cx), 'y': clamp(y + item.y - cy)})
+                              for item in self.moving])
         QMessageBox.information(self, "",
                                 "移动成功！")
         self.accept()
@@ -416,114 +770,234 @@ class MoveItemDialog(QDialog):
         pass
 
 
-# 所有可移动到的场景列表
+# 所有可移动到的场景列表，和场景列表使用同样的视图
 class MovePlaceListDialog(QDialog):
-    def __init__(self, parent, item):
+    @profiling.timed(category='dialog')
+    def __init__(self, parent, items):
         super().__init__(parent)
-        self.item = item
+        self.items = items
 
         label = QLabel("请选择要移动到的地方")
-        grid = self.get_grid()
-        widget = QWidget(self)
-        widget.setLayout(grid)
-        scrollArea = QScrollArea(self)
-        scrollArea.setWidget(widget)
+        self.view = PlaceGridView(self, show_paths=True)
+        self.view.place_clicked.connect(self.move_to)
+        # 对话框关闭时取消尚未完成的图片解码，断开事件总线
+        self.finished.connect(self.view.model().release)
         vbox = QVBoxLayout()
         vbox.addWidget(label)
-        vbox.addWidget(scrollArea)
+        vbox.addWidget(self.view)
         self.setLayout(vbox)
 
-    def get_grid(self):
-        grid = QGridLayout()
-        places = session.query(Place)
-        row_count = (places.count()) // 2 + 1
-        widgets = [MovePlaceWidget(place, self.item, self) for place in places]
-        positions = [(i, j) for i in range(row_count) for j in range(2)]
-        positions = positions[:places.count()]
-        for position, widget in zip(positions, widgets):
-            grid.addWidget(widget, *position)
-        return grid
+    # 选择场景后再选择具体位置
+    def move_to(self, place):
+        dialog = MoveItemDialog(self, place, self.items)
+        result = exec_dialog(dialog)
+        if result:
+            self.accept()
+
+
+# 移动场景（连同所有子场景和其中的物品）：选择新的父场景或者移到顶层
+# 只修改这个场景的parent_id，闭包表由数据库中的触发器在同一个事务中更新
+class MovePlaceDialog(QDialog):
+    @profiling.timed(category='dialog')
+    def __init__(self, parent, place):
+        super().__init__(parent)
+        self.place = place
+
+        label = QLabel("请选择要移动到哪个场景里面")
+        top_button = QPushButton("移到顶层", self)
+        top_button.clicked.connect(lambda: self.move_to(None))
+        self.view = PlaceGridView(self, show_paths=True)
+        self.view.place_clicked.connect(self.move_to)
+        # 对话框关闭时取消尚未完成的图片解码，断开事件总线
+        self.finished.connect(self.view.model().release)
+        vbox = QVBoxLayout()
+        vbox.addWidget(label)
+        vbox.addWidget(top_button)
+        vbox.addWidget(self.view)
+        self.setLayout(vbox)
 
-    def flush_count(self):
-        for widget in self.widgets:
-            widget.flush()
+    # target为None时移到顶层
+    def move_to(self, target):
+        if target is not None and is_ancestor(session, self.place.id, target.id):
+            QMessageBox.information(self, "", "不能移动到它自己或者它的子场景里面！")
+            return
+        if (target.id if target is not None else None) != self.place.parent_id:
+            writer().update(self.place, parent=target)
+        self.accept()
 
 
 # 添加新的物品
+# 场景有子场景时显示子场景列表，搜索范围包括所有子场景中的物品
 class AddItemDialog(QDialog):
+    @profiling.timed(category='dialog')
     def __init__(self, parent, place, item=None):
         super().__init__(parent)
+        # 对话框关闭时取消尚未完成的图片解码
+        self.finished.connect(lambda: image_loader().cancel(self))
         self.place = place
-        self.items = list(place.items)
+        self.items = repository().place_items(place)
+        # 路径和子场景个数一次查询读出
+        repository().load_family(place.id)
+        self.setWindowTitle(repository().path_text(place.id))
         self.image_label = ImageLabel(self, place)
-        # 在当前场景搜索
+        # 子场景，点击后打开
+        self.children_model = PlaceListModel(self, load=False, scope=place.id)
+        self.children_model.rowsInserted.connect(self.update_search_scope)
+        self.finished.connect(self.children_model.release)
+        self.children_view = QListView(self)
+        self.children_view.setModel(self.children_model)
+        self.children_view.setFlow(QListView.LeftToRight)
+        self.children_view.setIconSize(QSize(48, 48))
+        self.children_view.setFixedHeight(80)
+        self.children_view.clicked.connect(self.open_child)
+        self.add_child = AddPlaceWidget(self, parent_place=place, text='添加子场景')
+        move_button = QPushButton('移动场景', self)
+        move_button.clicked.connect(self.move_place)
+        # 在当前场景搜索（物品已经在内存中，在GUI线程中过滤）
         self.search_line = QLineEdit(self)
         self.search_line.setPlaceholderText('搜索')
+        self.pipeline = SearchPipeline(self, local=self.filter_items, matches=name_matches)
+        self.pipeline.results_ready.connect(self.show_results)
         self.search_line.textChanged.connect(self.search)
-        self.listwidget = QListWidget(self)
-        self.populate_list(self.listwidget, None)
-        self.listwidget.itemClicked.connect(self.on_listwidget_clicked)
-        self.listwidget.itemDoubleClicked.connect(
-            self.on_listwidget_doubleClicked
-        )
-
+        self.finished.connect(self.pipeline.cancel)
+        self.result_model = SearchResultModel(self, formatter=self.format_result)
+        self.result_model.set_results(self.items)
+        self.listview = QListView(self)
+        self.listview.setModel(self.result_model)
+        self.listview.clicked.connect(self.on_result_clicked)
+        self.listview.doubleClicked.connect(self.on_result_doubleClicked)
+        # 子树搜索的结果在数据写入后重新查询，场景移动后更新标题；关闭时断开
+        bus().committed.connect(self.on_committed)
+        self.finished.connect(self.release)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.add_child)
+        buttons.addWidget(move_button)
         vbox = QVBoxLayout()
         vbox.addWidget(self.image_label)
+        vbox.addWidget(self.children_view)
+        vbox.addLayout(buttons)
         vbox.addWidget(self.search_line)
-        vbox.addWidget(self.listwidget)
+        vbox.addWidget(self.listview)
         self.setLayout(vbox)
 
+        self.children_view.hide()
+        if repository().place_count(place.id):
+            self.children_model.reload()
+            self.update_search_scope()
+
         if item:
-            for item0 in self.items:
-                if item0.id == item.id:
-                    item0.button.setStyleSheet("background-color: green")
-                    break
-            for i in range(self.listwidget.count()):
-                if self.listwidget.item(i).item.id == item.id:
-                    self.listwidget.setCurrentRow(i)
-                    break
-
-    # 每当搜索框中内容改变时候就刷新物品列表
+            self.image_label.select(item)
+            row = self.result_model.row_of(item.id)
+            if row is not None:
+                self.listview.setCurrentIndex(self.result_model.index(row))
+
+    # 每当搜索框中内容改变时候就刷新物品列表（去抖动后执行）
     # 搜索框为空则显示全部
     def search(self):
-        text = self.search_line.text().strip()
+        self.pipeline.set_text(self.search_line.text())
+
+    def filter_items(self, text):
         if not text:
-            self.flush()
-        else:
-            results = []
-            for item in self.items:
-                if text in item.name:
-                    results.append(item)
-            self.flush(results)
-
-    # 刷新列表
-    def flush(self, items=None):
-        self.listwidget.clear()
-        self.populate_list(self.listwidget, items)
-        self.repaint()
-
-    # 填充列表
-    def populate_list(self, listwidget, items):
-        if items is None:
-            items = self.items
-        for item in items:
-            list_item = QListWidgetItem(item.name)
-            list_item.item = item
-            listwidget.addItem(list_item)
+            return list(self.items)
+        return [item for item in self.items if name_matches(item, text)]
 
-    # 列表中的项目被点击时在场景图片中以绿色标记出物品
-    def on_listwidget_clicked(self, listitem):
-        for button in self.image_label.item_buttons:
-            button.setStyleSheet("background-color: yellow")
-        print(listitem.item.button)
-        button = QPushButton("", self.image_label)
+    # 子树搜索没有输入时只显示当前场景的物品
+    def show_results(self, text, items):
+        self.result_model.set_results(items if text else list(self.items))
 
-        listitem.item.button.setStyleSheet("background-color: green")
+    # 有子场景后改为在数据库中搜索整个子树（一条按闭包表筛选的查询）
+    def update_search_scope(self):
+        self.children_view.show()
+        if self.pipeline.local is None:
+            return
+        place_id = self.place.id
+        self.pipeline.local = None
+        self.pipeline.matches = record_matches
+        self.pipeline.limit = SEARCH_LIMIT
+        self.pipeline.query = lambda connection, text: search_records(connection, text, SEARCH_LIMIT, place_id)
+        self.pipeline.refresh()
+
+    # 子场景中的物品后面显示所在的场景
+    def format_result(self, record):
+        if record.place_id == self.place.id:
+            return record.name
+        return record.name + "({})".format(record.place_name)
+
+    def release(self):
+        bus().committed.disconnect(self.on_committed)
+
+    def on_committed(self, result):
+        # 新物品换了主键：标记和搜索结果按新的主键重建
+        if result.remapped:
+            self.image_label.flush()
+            self.pipeline.refresh()
+        if result.touches(Place):
+            self.setWindowTitle(repository().path_text(self.place.id))
+        if self.pipeline.local is None and self.pipeline.text:
+            self.pipeline.refresh()
+
+    def open_child(self, index):
+        dialog = AddItemDialog(self, index.data(PlaceRole))
+        exec_dialog(dialog)
+
+    def move_place(self):
+        dialog = MovePlaceDialog(self, self.place)
+        exec_dialog(dialog)
+
+    # 物品被添加/修改/移动/删除后只更新列表中对应的一行
+    def apply_item(self, item):
+        record = item if item in self.items and name_matches(item, self.pipeline.text) else None
+        self.pipeline.patch(item.id, record)
+        self.result_model.patch(item.id, record)
+
+    # 框选的多个物品：确认后在一个事务中删除
+    def delete_items(self, items):
+        if QMessageBox.question(self, "", "删除选中的{}个物品？".format(len(items))) != QMessageBox.Yes:
+            return
+        ids = {item.id for item in items}
+        self.image_label.remove_markers(items)
+        self.items = [item for item in self.items if item.id not in ids]
+        writer().delete_many(items)
+        self.pipeline.refresh()
+
+    # 框选的多个物品：选择场景和位置后在一个事务中移动
+    def move_items(self, items):
+        self.image_label.set_hidden_many(items, True)
+        dialog = MovePlaceListDialog(self, items)
+        result = exec_dialog(dialog)
+        self.image_label.set_hidden_many(items, False)
+        if not result:
+            return
+        staying = [item for item in items if item.place == self.place]
+        self.image_label.move_markers(staying)
+        self.image_label.remove_markers([item for item in items if item.place != self.place])
+        self.items = [item for item in self.items if item.place == self.place]
+        self.pipeline.refresh()
+
+    # 结果中的一行对应的物品（子树搜索的结果是ItemRecord）
+    def result_item(self, index):
+        record = index.data(ResultRole)
+        return record if isinstance(record, Item) else repository().item(record.id)
+
+    # 列表中的项目被点击时在场景图片中以绿色标记出物品，子场景中的物品打开所在的场景
+    def on_result_clicked(self, index):
+        item = self.result_item(index)
+        if item is None:
+            return
+        if item.place_id != self.place.id:
+            dialog = AddItemDialog(self, item.place, item)
+            exec_dialog(dialog)
+            return
+        self.image_label.select(item)
 
     # 双击则弹出详细信息对话框
-    def on_listwidget_doubleClicked(self, listitem):
-        dialog = EditItem(self, listitem.item)
-        result = dialog.exec_()
+    def on_result_doubleClicked(self, index):
+        item = self.result_item(index)
+        if item is None or item.place_id != self.place.id:
+            return
+        dialog = EditItem(self, item)
+        result = exec_dialog(dialog)
 
 
 # 搜索框，全局搜索物品
@@ -531,76 +1005,243 @@ class SearchWidget(QWidget):
     def __init__(self, placelist):
         super().__init__()
         self.placelist = placelist
-        self.items = list(session.query(Item))
+        # 当前的搜索结果（物品id、名字和所在场景的名字）
+        self.items = []
+        # 结果中的物品id，批量修改时不在结果中的变化直接跳过
+        self.result_ids = set()
 
         self.search_line = QLineEdit(self)
         self.search_line.setPlaceholderText('搜索')
+        # 在工作线程中查询全文索引，连同场景名字一次读出
+        self.pipeline = SearchPipeline(
+            self, query=lambda connection, text: search_records(connection, text, SEARCH_LIMIT),
+            limit=SEARCH_LIMIT)
+        self.pipeline.results_ready.connect(self.show_results)
         self.search_line.textChanged.connect(self.search)
-        self.listwidget = QListWidget(self)
-        self.listwidget.itemClicked.connect(self.on_listwidget_clicked)
-        self.listwidget.itemDoubleClicked.connect(
-            self.on_listwidget_doubleClicked
-        )
+        self.result_model = SearchResultModel(
+            self, formatter=lambda record: record.name + "({})".format(record.place_name))
+        self.listview = QListView(self)
+        self.listview.setModel(self.result_model)
+        self.listview.clicked.connect(self.on_result_clicked)
+        self.listview.doubleClicked.connect(self.on_result_doubleClicked)
 
         vbox = QVBoxLayout()
         vbox.addWidget(self.search_line)
-        vbox.addWidget(self.listwidget)
+        vbox.addWidget(self.listview)
         self.setLayout(vbox)
 
+        # 只处理影响搜索结果的变化
+        changes = bus()
+        changes.item_added.connect(self.on_item_changed)
+        changes.item_updated.connect(self.on_item_changed)
+        changes.item_moved.connect(self.on_item_moved)
+        changes.item_deleted.connect(self.on_item_deleted)
+        changes.place_updated.connect(self.on_place_updated)
+
     def search(self):
-        text = self.search_line.text().strip()
-        results = []
-        if not text:
-            pass
-        else:
-            for item in self.items:
-                if text in item.name:
-                    results.append(item)
-        self.flush(results)
+        self.pipeline.set_text(self.search_line.text())
 
-    def flush(self, items):
-        self.listwidget.clear()
-        self.populate_list(self.listwidget, items)
-        self.repaint()
+    def show_results(self, text, records):
+        self.result_model.set_results(records)
+        # 和模型共用一个列表，patch()之后仍然是当前的结果
+        self.items = self.result_model.results
+        self.result_ids = {record.id for record in records}
 
-    def populate_list(self, listwidget, items):
-        for item in items:
-            list_item = QListWidgetItem(item.name + "({})".format(item.place.name))
-            list_item.item = item
-            listwidget.addItem(list_item)
+    # 重新执行当前的搜索
+    @profiling.timed
+    def flush(self):
+        self.pipeline.refresh()
 
-    def on_listwidget_clicked(self, listitem):
-        dialog = AddItemDialog(self, listitem.item.place, listitem.item)
-        dialog.exec_()
-        self.placelist.flush_count()
+    # 新物品或名字/介绍被修改的物品可能开始（或不再）匹配当前的搜索，需要重新搜索
+    def on_item_changed(self, change):
+        if self.pipeline.text and ('name' in change.values or 'description' in change.values):
+            self.flush()
 
-    def on_listwidget_doubleClicked(self, listitem):
-        dialog = EditItem(self, listitem.item)
-        result = dialog.exec_()
+    # 物品移动后只修改结果中的场景名字
+    def on_item_moved(self, change):
+        record = self.record(change.id) if change.id in self.result_ids else None
+        if record is not None:
+            place = repository().place(change.place_id)
+            self.patch(replace_record(record, place_id=change.place_id,
+                                      place_name=place.name if place is not None else ''))
+        self.on_item_changed(change)
+
+    def on_item_deleted(self, change):
+        if change.id not in self.result_ids:
+            return
+        self.result_ids.discard(change.id)
+        self.pipeline.patch(change.id)
+        self.result_model.patch(change.id)
+
+    def on_place_updated(self, change):
+        if 'name' not in change.values:
+            return
+        for record in list(self.items):
+            if record.place_id == change.id:
+                self.patch(replace_record(record, place_name=change.values['name']))
+
+    def record(self, item_id):
+        for record in self.items:
+            if record.id == item_id:
+                return record
+        return None
+
+    def patch(self, record):
+        self.pipeline.patch(record.id, record)
+        self.result_model.patch(record.id, record)
+
+    def on_result_clicked(self, index):
+        item = repository().item(index.data(ResultRole).id)
+        if item is None:
+            return
+        dialog = AddItemDialog(self, item.place, item)
+        exec_dialog(dialog)
+
+    def on_result_doubleClicked(self, index):
+        item = repository().item(index.data(ResultRole).id)
+        if item is None:
+            return
+        dialog = EditItem(self, item)
+        result = exec_dialog(dialog)
+
+
+# 备份数据库按钮：在后台线程中用SQLite的备份API分步复制，编辑不受影响，按钮上显示进度
+class BackupButton(QPushButton):
+    progressed = pyqtSignal(int, int)
+    done = pyqtSignal(str, str)
+
+    def __init__(self, parent=None):
+        super().__init__('备份数据库', parent)
+        # 工作线程通过信号把进度和结果发回GUI线程
+        self.progressed.connect(self.on_progress)
+        self.done.connect(self.on_done)
+        self.clicked.connect(self.start)
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.setEnabled(False)
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='backup', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            path = backup.backup(progress=self.progressed.emit, cancelled=self.stopping.is_set)
+            self.done.emit(path, '')
+        except Exception as e:
+            self.done.emit('', str(e))
+
+    def on_progress(self, done, total):
+        self.setText('备份中 {}%'.format(done * 100 // max(total, 1)))
+
+    def on_done(self, path, error):
+        self.thread = None
+        self.setEnabled(True)
+        self.setText('备份数据库')
+        if self.stopping.is_set():
+            return
+        if error:
+            QMessageBox.warning(self, "", "备份失败：%s" % error)
+        else:
+            QMessageBox.information(self, "", "已备份到%s" % path)
+
+    # 退出时取消正在进行的备份（不会留下写了一半的文件）
+    def stop(self):
+        thread = self.thread
+        if thread is not None:
+            self.stopping.set()
+            thread.join()
 
 
 # 初始界面
 class Main(QWidget):
     def __init__(self):
         super().__init__()
+        # 数据变化时先更新缓存，再由各个界面更新（bus先发出committed再发出各个变化）
+        bus().committed.connect(repository().invalidate)
         placelist = PlaceListWidget()
         searchwidget = SearchWidget(placelist)
 
-        # scrollArea0.setBackgroundRole(QPalette.Dark)
-
-        scrollArea = QScrollArea()
-        # scrollArea.setBackgroundRole(QPalette.Dark)
-        scrollArea.setWidget(placelist)
+        self.backup_button = BackupButton(self)
 
         vbox = QVBoxLayout()
         vbox.addWidget(searchwidget)
-        vbox.addWidget(scrollArea)
+        vbox.addWidget(placelist)
+        vbox.addWidget(self.backup_button)
         self.setLayout(vbox)
 
+        # 写入失败时提示并丢弃内存中未保存的修改
+        writer().failed.connect(self.on_write_failed)
+
+        self.placelist = placelist
+        self.loaded = False
+        startup.mark('window')
+
+    # 第一次绘制之后才读取场景，窗口不需要等待数据库
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.loaded:
+            self.loaded = True
+            startup.mark('first_paint')
+            QTimer.singleShot(0, self.load)
+
+    def load(self):
+        self.placelist.flush()
+        startup.mark('places_loaded')
+        if '--startup-report' in sys.argv:
+            startup.report()
+
+    def on_write_failed(self, message):
+        session.expire_all()
+        repository().clear()
+        QMessageBox.warning(self, "", "保存失败：%s" % message)
+
+
+# 打开数据库（连接参数、结构迁移），在后台线程中执行
+def open_database():
+    get_engine()
+    startup.mark('database_open')
+
+
+# --profile [trace.json]：开启性能记录，返回trace文件的路径，没有这个参数时返回None
+def profile_argument(argv):
+    if '--profile' not in argv:
+        return None
+    index = argv.index('--profile')
+    if index + 1 < len(argv) and not argv[index + 1].startswith('--'):
+        return argv[index + 1]
+    return 'trace.json'
+
 
 if __name__ == '__main__':
+    # 在打开数据库之前开启，记录所有的SQL
+    trace_path = profile_argument(sys.argv)
+    if trace_path is not None:
+        profiling.enable()
+    # 创建窗口的同时打开数据库
+    threading.Thread(target=open_database, name='open-database', daemon=True).start()
     app = QApplication([])
+    startup.mark('application')
+    monitor = None
+    if '--memory' in sys.argv:
+        monitor = MemoryMonitor()
+        monitor.start()
+        monitor.watch()
     main = Main()
     main.show()
 
-    sys.exit(app.exec_())
+    result = app.exec_()
+    if monitor is not None:
+        monitor.report()
+    main.backup_button.stop()
+    image_loader().shutdown()
+    # 把还没有写入的修改写完再退出
+    writer().close()
+    if trace_path is not None:
+        profiling.profiler().report()
+        profiling.profiler().export(trace_path)
+        sys.stderr.write('trace已保存到{}\n'.format(trace_path))
+    sys.exit(result)
@@ -0,0 +1,145 @@
+from array import array
+
+# 物品标记的大小（和原来的按钮一样是10x10，左上角在物品坐标处）
+MARKER_SIZE = 10
+# 网格索引的格子大小，同一个格子里有多个标记时合并显示
+CELL_SIZE = 16
+
+
+# 物品标记的空间索引：1.坐标保存在紧凑的数组中
+#                    2.按CELL_SIZE划分网格，点击测试只检查附近的格子
+#                    3.删除时用最后一个元素填补空位，添加/删除/移动都是O(1)
+class MarkerIndex:
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.ids = array('i')
+        self.xs = array('i')
+        self.ys = array('i')
+        # 物品id -> 数组中的位置
+        self.slots = {}
+        # (列, 行) -> 该格子中的物品id集合
+        self.cells = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, item_id):
+        return item_id in self.slots
+
+    def clear(self):
+        self.__init__(self.cell_size)
+
+    # 用新的坐标重建整个索引（缩放/平移后），比逐个移动快
+    def reset(self, positions):
+        self.clear()
+        ids, xs, ys, slots, cells = self.ids, self.xs, self.ys, self.slots, self.cells
+        size = self.cell_size
+        for item_id, x, y in positions:
+            slots[item_id] = len(ids)
+            ids.append(item_id)
+            xs.append(x)
+            ys.append(y)
+            cell = (x // size, y // size)
+            members = cells.get(cell)
+            if members is None:
+                cells[cell] = {item_id}
+            else:
+                members.add(item_id)
+
+    def cell_of(self, x, y):
+        return x // self.cell_size, y // self.cell_size
+
+    def position(self, item_id):
+        slot = self.slots[item_id]
+        return self.xs[slot], self.ys[slot]
+
+    def add(self, item_id, x, y):
+        if item_id in self.slots:
+            self.move(item_id, x, y)
+            return
+        self.slots[item_id] = len(self.ids)
+        self.ids.append(item_id)
+        self.xs.append(x)
+        self.ys.append(y)
+        self.cells.setdefault(self.cell_of(x, y), set()).add(item_id)
+
+    def remove(self, item_id):
+        slot = self.slots.pop(item_id, None)
+        if slot is None:
+            return
+        self.discard_cell(item_id, self.xs[slot], self.ys[slot])
+        last = len(self.ids) - 1
+        if slot != last:
+            moved = self.ids[last]
+            self.ids[slot] = moved
+            self.xs[slot] = self.xs[last]
+            self.ys[slot] = self.ys[last]
+            self.slots[moved] = slot
+        self.ids.pop()
+        self.xs.pop()
+        self.ys.pop()
+
+    def move(self, item_id, x, y):
+        slot = self.slots[item_id]
+        self.discard_cell(item_id, self.xs[slot], self.ys[slot])
+        self.xs[slot] = x
+        self.ys[slot] = y
+        self.cells.setdefault(self.cell_of(x, y), set()).add(item_id)
+
+    def discard_cell(self, item_id, x, y):
+        cell = self.cell_of(x, y)
+        members = self.cells.get(cell)
+        if members is not None:
+            members.discard(item_id)
+            if not members:
+                del self.cells[cell]
+
+    # 与矩形(x, y, width, height)相交的格子及其中的物品
+    def cells_in(self, x, y, width, height):
+        left, top = self.cell_of(x - MARKER_SIZE, y - MARKER_SIZE)
+        right, bottom = self.cell_of(x + width, y + height)
+        # 矩形很大时直接遍历所有非空格子
+        if (right - left + 1) * (bottom - top + 1) > len(self.cells):
+            for (column, row), members in self.cells.items():
+                if left <= column <= right and top <= row <= bottom:
+                    yield (column, row), members
+            return
+        for column in range(left, right + 1):
+            for row in range(top, bottom + 1):
+                members = self.cells.get((column, row))
+                if members:
+                    yield (column, row), members
+
+    # 标记左上角在矩形(x, y, width, height)内的物品（框选）
+    def in_rect(self, x, y, width, height):
+        found = []
+        for _, members in self.cells_in(x, y, width, height):
+            for item_id in members:
+                mx, my = self.position(item_id)
+                if x <= mx <= x + width and y <= my <= y + height:
+                    found.append(item_id)
+        return found
+
+    # 找到离(x, y)最近、且点击位置落在其标记范围内的物品，没有则返回None
+    def hit(self, x, y, tolerance=2):
+        best = None
+        best_distance = None
+        for _, members in self.cells_in(x - tolerance, y - tolerance, 2 * tolerance, 2 * tolerance):
+            for item_id in members:
+                mx, my = self.position(item_id)
+                if not (mx - tolerance <= x <= mx + MARKER_SIZE + tolerance and
+                        my - tolerance <= y <= my + MARKER_SIZE + tolerance):
+                    continue
+                distance = self.distance(item_id, x, y)
+                if best is None or distance < best_distance:
+                    best, best_distance = item_id, distance
+        if best is None:
+            # 点击在合并显示的标记上，选择格子中最近的物品
+            members = self.cells.get(self.cell_of(x, y), ())
+            if len(members) > 1:
+                best = min(members, key=lambda item_id: self.distance(item_id, x, y))
+        return best
+
+    def distance(self, item_id, x, y):
+        mx, my = self.position(item_id)
+        return (mx + MARKER_SIZE / 2 - x) ** 2 + (my + MARKER_SIZE / 2 - y) ** 2
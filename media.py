@@ -0,0 +1,186 @@
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PyQt5.QtCore import QSize, Qt
+from PyQt5.QtGui import QImage, QImageReader
+
+from tiles import TilePyramid, tiles_dir, load_pyramid
+
+# 场景图片的存储：1.添加场景时把原图复制到MEDIA_DIR中，文件名是内容的sha256，相同的图片只保存一份
+#                2.同时生成界面使用的两种尺寸（场景列表200x200，场景详情400x400）
+#                3.Place.image保存存储中的相对路径，原图被移动或删除后不受影响
+#                4.生成缩放浏览用的瓦片金字塔（见tiles.py）
+#
+# 用法（把已有场景的图片导入存储并生成缺少的瓦片，多个进程并行处理）：
+#   python media.py [--workers 4]
+
+MEDIA_DIR = 'media'
+# 和place_view.IMAGE_SIZE、ImageLabel的显示尺寸一致
+RENDITION_SIZES = (200, 400)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# 原图在存储中的路径：media/ab/abcdef....jpg
+def stored_path(digest, extension, media_dir=MEDIA_DIR):
+    return os.path.join(media_dir, digest[:2], digest + extension.lower())
+
+
+def rendition_path(stored, size):
+    return '{}_{}.jpg'.format(os.path.splitext(stored)[0], size)
+
+
+# 路径是否已经在存储中（Place.image中保存的是相对路径）
+def is_stored(path, media_dir=MEDIA_DIR):
+    if not path:
+        return False
+    parts = os.path.normpath(path).split(os.sep)
+    return len(parts) == 3 and parts[0] == os.path.normpath(media_dir)
+
+
+# 显示width x height时可以直接读取的预先生成的图片，没有则返回None
+def rendition_for(path, width, height):
+    if width != height or width not in RENDITION_SIZES or not is_stored(path):
+        return None
+    rendition = rendition_path(path, width)
+    if not os.path.exists(rendition):
+        return None
+    return rendition
+
+
+# 写入临时文件后再改名，其它进程不会读到写了一半的文件
+def replace_atomically(write, path):
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        write(temp)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+# 生成缺少的尺寸：只解码一次到最大的尺寸，其它尺寸由它缩小
+def make_renditions(stored):
+    missing = [size for size in sorted(RENDITION_SIZES, reverse=True)
+               if not os.path.exists(rendition_path(stored, size))]
+    if not missing:
+        return True
+    reader = QImageReader(stored)
+    reader.setScaledSize(QSize(missing[0], missing[0]))
+    image = reader.read()
+    if image.isNull():
+        return False
+    for size in missing:
+        if image.width() != size or image.height() != size:
+            image = image.scaled(size, size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+
+        def save(temp, image=image):
+            if not image.save(temp, 'JPG', 90):
+                raise OSError('无法保存图片: {}'.format(temp))
+        replace_atomically(save, rendition_path(stored, size))
+    return True
+
+
+# 生成瓦片金字塔：原图只解码一次，每一层由上一层缩小一半得到，
+# 每张瓦片和最后的pyramid.json都先写临时文件再改名，中途退出的金字塔下次重新生成
+def make_tiles(stored):
+    if load_pyramid(stored) is not None:
+        return True
+    image = QImage(stored)
+    if image.isNull():
+        return False
+    pyramid = TilePyramid(tiles_dir(stored), image.width(), image.height())
+    for level in range(pyramid.levels):
+        if level > 0:
+            width, height = pyramid.level_size(level)
+            image = image.scaled(width, height, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        os.makedirs(os.path.dirname(pyramid.tile_path(level, 0, 0)), exist_ok=True)
+        for column, row in pyramid.tiles(level):
+            tile = image.copy(*pyramid.tile_rect(level, column, row))
+
+            def save(temp, tile=tile):
+                if not tile.save(temp, 'JPG', 85):
+                    raise OSError('无法保存图片: {}'.format(temp))
+            replace_atomically(save, pyramid.tile_path(level, column, row))
+    replace_atomically(pyramid.save, pyramid.info_path())
+    return True
+
+
+# 把图片导入存储，返回存储中的相对路径；已经导入过（内容相同）的图片不会再复制
+def ingest(path, media_dir=MEDIA_DIR):
+    if is_stored(path, media_dir) and os.path.exists(path):
+        stored = path
+    else:
+        stored = stored_path(file_hash(path), os.path.splitext(path)[1], media_dir)
+        if not os.path.exists(stored):
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            replace_atomically(lambda temp: shutil.copyfile(path, temp), stored)
+    if not make_renditions(stored) or not make_tiles(stored):
+        raise ValueError('无法读取图片: {}'.format(path))
+    return stored
+
+
+# 在子进程中执行，返回(原路径, 存储路径, 错误信息)
+def _ingest_one(path, media_dir):
+    try:
+        return path, ingest(path, media_dir), None
+    except (OSError, ValueError) as e:
+        return path, None, str(e)
+
+
+# 批量导入已有场景的图片：不同的文件在多个进程中并行处理，最后在一个事务中更新场景
+# 已经在存储中、但还没有瓦片的图片（之前的版本导入的）也会重新处理，补上瓦片
+def ingest_places(workers=None, media_dir=MEDIA_DIR, out=sys.stderr):
+    from sqlalchemy import select
+    from models import get_engine, Place
+
+    places = Place.__table__
+    engine = get_engine()
+    with engine.connect() as connection:
+        rows = connection.execute(select([places.c.id, places.c.image])).fetchall()
+    paths = sorted({row.image for row in rows if row.image and
+                    (not is_stored(row.image, media_dir) or load_pyramid(row.image) is None)})
+
+    start = time.perf_counter()
+    stored = {}
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for path, result, error in pool.map(_ingest_one, paths, [media_dir] * len(paths)):
+            if error is not None:
+                failed += 1
+                out.write('跳过 {}: {}\n'.format(path, error))
+            else:
+                stored[path] = result
+
+    updated = 0
+    with engine.begin() as connection:
+        for row in rows:
+            if row.image in stored and stored[row.image] != row.image:
+                connection.execute(places.update().where(places.c.id == row.id)
+                                   .values(image=stored[row.image]))
+                updated += 1
+    out.write('完成: {} 个图片, 更新 {} 个场景, 失败 {} 个, {:.1f}秒\n'.format(
+        len(stored), updated, failed, time.perf_counter() - start))
+    return updated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='把已有场景的图片导入存储并生成缩略图和瓦片')
+    parser.add_argument('--workers', type=int, default=None, help='进程数，默认为CPU个数')
+    args = parser.parse_args(argv)
+    ingest_places(args.workers)
+
+
+if __name__ == '__main__':
+    main()
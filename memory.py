@@ -0,0 +1,77 @@
+import sys
+import tracemalloc
+from collections import Counter
+
+from PyQt5.QtCore import QObject, QTimer
+from PyQt5.QtWidgets import QApplication
+
+# 内存检查：tracemalloc记录Python分配的内存，同时统计还存在的QObject（按类名）
+# 用 python main.py --memory 运行，定期输出一行统计，退出时输出增长最多的分配位置
+
+
+# 所有顶层控件及其子对象，按类名计数（没有父对象的非控件QObject不在其中）
+def live_qobjects():
+    counts = Counter()
+    app = QApplication.instance()
+    if app is None:
+        return counts
+    for widget in app.topLevelWidgets():
+        # 有父对象的对话框也是顶层窗口，已经作为子对象统计
+        if widget.parent() is not None:
+            continue
+        counts[type(widget).__name__] += 1
+        for child in widget.findChildren(QObject):
+            counts[type(child).__name__] += 1
+    return counts
+
+
+class MemoryMonitor:
+    def __init__(self, frames=10):
+        self.frames = frames
+        self.baseline = None
+        self.baseline_objects = Counter()
+        self._timer = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.reset()
+
+    # 以当前状态作为比较的起点（如预热之后）
+    def reset(self):
+        self.baseline = tracemalloc.take_snapshot()
+        self.baseline_objects = live_qobjects()
+
+    # (当前分配的字节数, 峰值, QObject个数)
+    def sample(self):
+        current, peak = tracemalloc.get_traced_memory()
+        return current, peak, sum(live_qobjects().values())
+
+    def write_sample(self, out=sys.stderr):
+        current, peak, objects = self.sample()
+        out.write('内存 {:.1f}MB (峰值 {:.1f}MB), QObject {}\n'.format(
+            current / 1024 / 1024, peak / 1024 / 1024, objects))
+
+    # 每隔interval毫秒输出一行统计
+    def watch(self, interval=10000, out=sys.stderr):
+        self._timer = QTimer()
+        self._timer.timeout.connect(lambda: self.write_sample(out))
+        self._timer.start(interval)
+
+    # 和起点相比增长最多的分配位置及QObject
+    def report(self, limit=10, out=sys.stderr):
+        self.write_sample(out)
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        ])
+        out.write('增长最多的分配位置:\n')
+        for stat in snapshot.compare_to(self.baseline, 'lineno')[:limit]:
+            out.write('  {}\n'.format(stat))
+        growth = live_qobjects()
+        growth.subtract(self.baseline_objects)
+        growth = [(name, count) for name, count in growth.most_common(limit) if count > 0]
+        if growth:
+            out.write('增加的QObject:\n')
+            for name, count in growth:
+                out.write('  {:<28}{:>+8}\n'.format(name, count))
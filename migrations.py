@@ -0,0 +1,369 @@
+import sqlite3
+
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+# 数据库结构的版本记录在 PRAGMA user_version 中，
+# 打开数据库时依次执行比当前版本新的迁移，每个迁移在一个事务中完成，已有数据不会丢失
+
+# 连接参数：WAL模式下读写互不阻塞，NORMAL同步级别在WAL模式下仍然保证数据库不会损坏
+PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    # 用内存映射读取数据库文件（256MB）
+    'PRAGMA mmap_size=268435456',
+    # 页缓存大小，负数表示KB（64MB）
+    'PRAGMA cache_size=-65536',
+    'PRAGMA temp_store=MEMORY',
+    # 另一个连接正在写入时最多等待5秒
+    'PRAGMA busy_timeout=5000',
+]
+
+
+# 设置新连接的参数，用于engine的connect事件
+def configure_connection(dbapi_connection, connection_record=None):
+    cursor = dbapi_connection.cursor()
+    for pragma in PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def table_exists(connection, name):
+    return connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name=?", (name,)).fetchone() is not None
+
+
+def column_exists(connection, table, name):
+    return any(row[1] == name for row in connection.execute('PRAGMA table_info({})'.format(table)))
+
+
+# 版本1：建立models.py中定义的表（已经存在的旧数据库跳过）
+def create_tables(connection, metadata, dialect):
+    for table in metadata.sorted_tables:
+        if not table_exists(connection, table.name):
+            connection.execute(str(CreateTable(table).compile(dialect=dialect)))
+
+
+# 版本2：物品按场景和名字查询的索引（和models.py中index=True的定义一致）
+# 之后的版本才加上的列（如places.parent_id）跳过，它们的索引由加上列的迁移建立
+def create_indexes(connection, metadata, dialect):
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            if not all(column_exists(connection, table.name, column.name) for column in index.columns):
+                continue
+            sql = str(CreateIndex(index).compile(dialect=dialect))
+            connection.execute(sql.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1))
+
+
+# 物品全文索引：对name和description建立FTS5索引，使用trigram分词，
+# 中文子串（如"港币"）也可以匹配；由触发器和items表保持同步
+SEARCH_INDEX_SQL = [
+    """CREATE VIRTUAL TABLE items_fts USING fts5(
+        name, description, content='items', content_rowid='id', tokenize='trigram')""",
+    """CREATE TRIGGER items_fts_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER items_fts_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END""",
+    """CREATE TRIGGER items_fts_update AFTER UPDATE OF name, description ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO items_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END""",
+    "INSERT INTO items_fts(items_fts) VALUES ('rebuild')",
+]
+
+
+# 版本3：全文索引，SQLite不支持FTS5/trigram时跳过（搜索退回到LIKE）
+def create_search_index(connection, metadata, dialect):
+    if table_exists(connection, 'items_fts'):
+        return
+    connection.execute('SAVEPOINT search_index')
+    try:
+        for sql in SEARCH_INDEX_SQL:
+            connection.execute(sql)
+    except sqlite3.OperationalError:
+        connection.execute('ROLLBACK TO search_index')
+    connection.execute('RELEASE search_index')
+
+
+# 版本4：物品坐标改为相对于图片的位置（0~65536，和models.COORD_SCALE一致），
+# 以前的坐标是在400x400的显示区域中点击的像素位置（图片被拉伸到400x400）
+# 数值写在这里而不是引用常量：迁移执行的内容不能随之后的修改改变
+# 执行两次会把坐标再放大一次，所以在同一个事务中检查版本号（完成时和UPDATE一起提交）
+def normalize_coordinates(connection, metadata, dialect):
+    if schema_version(connection) >= 4:
+        return
+    connection.execute("""UPDATE items SET
+        x = MIN(MAX(CAST(ROUND(x * 65536.0 / 400) AS INTEGER), 0), 65536),
+        y = MIN(MAX(CAST(ROUND(y * 65536.0 / 400) AS INTEGER), 0), 65536)
+        WHERE x IS NOT NULL AND y IS NOT NULL""")
+
+
+# 物品位置的R*Tree索引：三个维度是场景id、x、y（都是整数，使用rtree_i32），
+# 按场景和矩形查询时只读取与之相交的节点；由触发器和items表保持同步
+SPATIAL_INDEX_SQL = [
+    "CREATE VIRTUAL TABLE items_rtree USING rtree_i32(id, min_place, max_place, min_x, max_x, min_y, max_y)",
+    """CREATE TRIGGER items_rtree_insert AFTER INSERT ON items
+        WHEN new.place_id IS NOT NULL AND new.x IS NOT NULL AND new.y IS NOT NULL BEGIN
+        INSERT INTO items_rtree VALUES (new.id, new.place_id, new.place_id, new.x, new.x, new.y, new.y);
+    END""",
+    """CREATE TRIGGER items_rtree_delete AFTER DELETE ON items BEGIN
+        DELETE FROM items_rtree WHERE id = old.id;
+    END""",
+    """CREATE TRIGGER items_rtree_update AFTER UPDATE OF place_id, x, y ON items BEGIN
+        DELETE FROM items_rtree WHERE id = old.id;
+        INSERT INTO items_rtree SELECT new.id, new.place_id, new.place_id, new.x, new.x, new.y, new.y
+            WHERE new.place_id IS NOT NULL AND new.x IS NOT NULL AND new.y IS NOT NULL;
+    END""",
+    """INSERT INTO items_rtree SELECT id, place_id, place_id, x, x, y, y FROM items
+        WHERE place_id IS NOT NULL AND x IS NOT NULL AND y IS NOT NULL""",
+]
+
+
+# 版本5：物品位置的空间索引，SQLite没有编译R*Tree时跳过（查询退回到按场景的索引）
+def create_spatial_index(connection, metadata, dialect):
+    if table_exists(connection, 'items_rtree'):
+        return
+    connection.execute('SAVEPOINT spatial_index')
+    try:
+        for sql in SPATIAL_INDEX_SQL:
+            connection.execute(sql)
+    except sqlite3.OperationalError:
+        connection.execute('ROLLBACK TO spatial_index')
+    connection.execute('RELEASE spatial_index')
+
+
+# 场景层级：places.parent_id和闭包表place_paths（每个场景和它的每个祖先一行，包括自己）
+# 触发器在同一个事务中维护闭包表：
+#   插入场景：自己一行，再复制父场景的所有祖先
+#   修改parent_id：先拒绝会形成环的修改，再删除子树和原来祖先之间的行，加上子树和新祖先之间的行，
+#                  整个子树的移动只是一条UPDATE
+#   删除场景：子场景移到它的父场景下面，再删除它自己的行
+PLACE_HIERARCHY_SQL = [
+    "CREATE INDEX IF NOT EXISTS ix_places_parent_id ON places (parent_id)",
+    """CREATE TABLE IF NOT EXISTS place_paths (
+        ancestor_id INTEGER NOT NULL,
+        descendant_id INTEGER NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (ancestor_id, descendant_id)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS ix_place_paths_descendant ON place_paths (descendant_id, depth)",
+    """CREATE TRIGGER place_paths_insert AFTER INSERT ON places BEGIN
+        INSERT INTO place_paths VALUES (new.id, new.id, 0);
+        INSERT INTO place_paths SELECT ancestor_id, new.id, depth + 1 FROM place_paths
+            WHERE descendant_id = new.parent_id;
+    END""",
+    """CREATE TRIGGER place_paths_cycle BEFORE UPDATE OF parent_id ON places
+        WHEN new.parent_id IS NOT NULL BEGIN
+        SELECT RAISE(ABORT, 'place cannot be moved into its own subtree') FROM place_paths
+            WHERE ancestor_id = new.id AND descendant_id = new.parent_id;
+    END""",
+    """CREATE TRIGGER place_paths_move AFTER UPDATE OF parent_id ON places
+        WHEN old.parent_id IS NOT new.parent_id BEGIN
+        DELETE FROM place_paths
+            WHERE descendant_id IN (SELECT descendant_id FROM place_paths WHERE ancestor_id = new.id)
+              AND ancestor_id NOT IN (SELECT descendant_id FROM place_paths WHERE ancestor_id = new.id);
+        INSERT INTO place_paths
+            SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+            FROM place_paths AS above, place_paths AS below
+            WHERE above.descendant_id = new.parent_id AND below.ancestor_id = new.id;
+    END""",
+    """CREATE TRIGGER place_paths_delete AFTER DELETE ON places BEGIN
+        UPDATE places SET parent_id = old.parent_id WHERE parent_id = old.id;
+        DELETE FROM place_paths WHERE descendant_id = old.id OR ancestor_id = old.id;
+    END""",
+    # 已有的场景（包括已经设置了parent_id的）用递归查询填充
+    """INSERT OR IGNORE INTO place_paths
+        WITH RECURSIVE paths(ancestor_id, descendant_id, depth) AS (
+            SELECT id, id, 0 FROM places
+            UNION ALL
+            SELECT places.parent_id, paths.descendant_id, paths.depth + 1
+            FROM paths JOIN places ON places.id = paths.ancestor_id
+            WHERE places.parent_id IS NOT NULL
+        )
+        SELECT ancestor_id, descendant_id, depth FROM paths""",
+]
+
+
+# 版本6：场景层级（新数据库的parent_id和place_paths已经由版本1按models.py建立）
+def create_place_hierarchy(connection, metadata, dialect):
+    if not column_exists(connection, 'places', 'parent_id'):
+        connection.execute('ALTER TABLE places ADD COLUMN parent_id INTEGER REFERENCES places (id)')
+    for sql in PLACE_HIERARCHY_SQL:
+        connection.execute(sql)
+
+
+# 当前时间（毫秒），变化日志的时间戳
+NOW_MS = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)"
+
+# 变化日志（用于在多个数据库之间同步，见sync.py）：
+#   places、items每一行有一个随机的uid，不同数据库中的同一个场景/物品用它对应（id在每个数据库中各自分配）
+#   changes按顺序（seq）记录每次插入、修改、删除后的整行（场景、父场景用uid表示），
+#   stamp是写入时的时钟（毫秒，不会比之前的任何stamp小），origin是写入的数据库（副本）的id
+#   sync_state只有一行：本副本的id、时钟、已经导出到的seq（NULL表示还没有导出过，第一次导出的是
+#   整个数据库）、是否记录变化（第一次同步之前不记录；导入其它副本的变化时暂时关闭，由sync.py自己记录）
+#   sync_peers记录从每个其它副本导入到的seq
+# 触发器在同一个事务中写入日志，界面、批量导入、查询服务的修改都会被记录
+CHANGE_LOG_SQL = [
+    """CREATE TABLE sync_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        replica TEXT NOT NULL,
+        clock INTEGER NOT NULL,
+        exported INTEGER,
+        logging INTEGER NOT NULL
+    )""",
+    "INSERT INTO sync_state VALUES (1, lower(hex(randomblob(8))), 0, NULL, 0)",
+    """CREATE TABLE changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        entity TEXT NOT NULL,
+        uid TEXT NOT NULL,
+        op TEXT NOT NULL,
+        stamp INTEGER NOT NULL,
+        origin TEXT NOT NULL,
+        data TEXT
+    )""",
+    "CREATE INDEX ix_changes_uid ON changes (uid, seq)",
+    """CREATE TABLE sync_peers (
+        replica TEXT PRIMARY KEY,
+        last INTEGER NOT NULL
+    )""",
+    "UPDATE places SET uid = lower(hex(randomblob(16))) WHERE uid IS NULL",
+    "UPDATE items SET uid = lower(hex(randomblob(16))) WHERE uid IS NULL",
+    "CREATE UNIQUE INDEX ix_places_uid ON places (uid)",
+    "CREATE UNIQUE INDEX ix_items_uid ON items (uid)",
+    # 新插入的行在这里分配uid（同一个触发器中先分配再记录，多个触发器的执行顺序是不确定的）
+    """CREATE TRIGGER changes_places_insert AFTER INSERT ON places BEGIN
+        UPDATE places SET uid = lower(hex(randomblob(16))) WHERE id = new.id AND new.uid IS NULL;
+        UPDATE sync_state SET clock = MAX(clock + 1, {now}) WHERE logging = 1;
+        INSERT INTO changes (entity, uid, op, stamp, origin, data)
+            SELECT 'place', places.uid, 'upsert', sync_state.clock, sync_state.replica,
+                   json_object('name', places.name, 'image', places.image,
+                               'parent', (SELECT uid FROM places AS parent WHERE parent.id = places.parent_id))
+            FROM places, sync_state WHERE places.id = new.id AND sync_state.logging = 1;
+    END""".format(now=NOW_MS),
+    """CREATE TRIGGER changes_places_update AFTER UPDATE OF name, image, parent_id ON places
+        WHEN (SELECT logging FROM sync_state) = 1 BEGIN
+        UPDATE sync_state SET clock = MAX(clock + 1, {now});
+        INSERT INTO changes (entity, uid, op, stamp, origin, data)
+            SELECT 'place', new.uid, 'upsert', clock, replica,
+                   json_object('name', new.name, 'image', new.image,
+                               'parent', (SELECT uid FROM places WHERE id = new.parent_id))
+            FROM sync_state;
+    END""".format(now=NOW_MS),
+    # 删除记录当时的父场景：其它副本上同时添加到这个场景中的物品、子场景移到它下面
+    """CREATE TRIGGER changes_places_delete AFTER DELETE ON places
+        WHEN (SELECT logging FROM sync_state) = 1 BEGIN
+        UPDATE sync_state SET clock = MAX(clock + 1, {now});
+        INSERT INTO changes (entity, uid, op, stamp, origin, data)
+            SELECT 'place', old.uid, 'delete', clock, replica,
+                   json_object('parent', (SELECT uid FROM places WHERE id = old.parent_id))
+            FROM sync_state;
+    END""".format(now=NOW_MS),
+    """CREATE TRIGGER changes_items_insert AFTER INSERT ON items BEGIN
+        UPDATE items SET uid = lower(hex(randomblob(16))) WHERE id = new.id AND new.uid IS NULL;
+        UPDATE sync_state SET clock = MAX(clock + 1, {now}) WHERE logging = 1;
+        INSERT INTO changes (entity, uid, op, stamp, origin, data)
+            SELECT 'item', items.uid, 'upsert', sync_state.clock, sync_state.replica,
+                   json_object('name', items.name, 'description', items.description,
+                               'place', (SELECT uid FROM places WHERE id = items.place_id),
+                               'x', items.x, 'y', items.y)
+            FROM items, sync_state WHERE items.id = new.id AND sync_state.logging = 1;
+    END""".format(now=NOW_MS),
+    """CREATE TRIGGER changes_items_update AFTER UPDATE OF name, description, place_id, x, y ON items
+        WHEN (SELECT logging FROM sync_state) = 1 BEGIN
+        UPDATE sync_state SET clock = MAX(clock + 1, {now});
+        INSERT INTO changes (entity, uid, op, stamp, origin, data)
+            SELECT 'item', new.uid, 'upsert', clock, replica,
+                   json_object('name', new.name, 'description', new.description,
+                               'place', (SELECT uid FROM places WHERE id = new.place_id),
+                               'x', new.x, 'y', new.y)
+            FROM sync_state;
+    END""".format(now=NOW_MS),
+    """CREATE TRIGGER changes_items_delete AFTER DELETE ON items
+        WHEN (SELECT logging FROM sync_state) = 1 BEGIN
+        UPDATE sync_state SET clock = MAX(clock + 1, {now});
+        INSERT INTO changes (entity, uid, op, stamp, origin, data)
+            SELECT 'item', old.uid, 'delete', clock, replica, NULL FROM sync_state;
+    END""".format(now=NOW_MS),
+]
+
+
+# 版本7：变化日志，已有的场景和物品分配uid
+def create_change_log(connection, metadata, dialect):
+    for table in ('places', 'items'):
+        if not column_exists(connection, table, 'uid'):
+            connection.execute('ALTER TABLE {} ADD COLUMN uid TEXT'.format(table))
+    for sql in CHANGE_LOG_SQL:
+        connection.execute(sql)
+
+
+# (版本号, 迁移函数)，只能在末尾追加
+MIGRATIONS = [
+    (1, create_tables),
+    (2, create_indexes),
+    (3, create_search_index),
+    (4, normalize_coordinates),
+    (5, create_spatial_index),
+    (6, create_place_hierarchy),
+    (7, create_change_log),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(connection):
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+
+
+# 把数据库升级到最新版本，返回升级前的版本
+def migrate(engine, metadata):
+    raw = engine.raw_connection()
+    try:
+        connection = raw.connection
+        # 手动控制事务，DDL也在事务中执行
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        try:
+            version = schema_version(connection)
+            for target, migration in MIGRATIONS:
+                if target <= version:
+                    continue
+                connection.execute('BEGIN IMMEDIATE')
+                try:
+                    # 另一个进程（如同时启动的界面和server.py）可能在取得写锁之前已经完成了这一步
+                    if target <= schema_version(connection):
+                        connection.execute('COMMIT')
+                        continue
+                    migration(connection, metadata, engine.dialect)
+                    connection.execute('PRAGMA user_version=%d' % target)
+                except BaseException:
+                    connection.execute('ROLLBACK')
+                    raise
+                connection.execute('COMMIT')
+            return version
+        finally:
+            connection.isolation_level = isolation_level
+    finally:
+        raw.close()
+
+
+# 全文索引是否可用
+def has_search_index(engine):
+    return has_table(engine, 'items_fts')
+
+
+# 空间索引是否可用
+def has_spatial_index(engine):
+    return has_table(engine, 'items_rtree')
+
+
+def has_table(engine, name):
+    raw = engine.raw_connection()
+    try:
+        return table_exists(raw.connection, name)
+    finally:
+        raw.close()
@@ -1,33 +1,62 @@
 import os
+import threading
 
-from sqlalchemy import Column, Integer, String, create_engine, ForeignKey
+from sqlalchemy import Column, Integer, String, create_engine, ForeignKey, func, event, select, inspect, \
+    text as text_sql, Table, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, Session as BaseSession
+from sqlalchemy.orm.attributes import get_history
+
+from migrations import migrate, configure_connection, has_search_index, has_spatial_index
+from where import search_ids
+
+# 数据库文件，可以用环境变量WHERE_DB指定其他文件（如基准测试使用的数据库）
+DB_PATH = os.environ.get('WHERE_DB', 'db.sqlite3')
 
 Base = declarative_base()
 
 
-# 场景：包含名字和图片
+# 场景：包含名字和图片，场景可以嵌套（房间 > 柜子 > 抽屉），parent为None的是顶层场景
 class Place(Base):
     __tablename__ = 'places'
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
     image = Column(String)
+    parent_id = Column(Integer, ForeignKey('places.id'), index=True)
+    parent = relationship('Place', remote_side=[id], back_populates='children')
+    children = relationship('Place', back_populates='parent')
     items = relationship('Item', back_populates='place')
 
     def __repr__(self):
         return "<Place(name='%s', image='%s')>" % (self.name, self.image)
 
 
+# 场景层级的闭包表：每个场景和它的每个祖先（包括自己，depth为0）各有一行，
+# 子树、祖先路径都只需要一次按索引的查询，不需要逐层递归；
+# 由数据库中的触发器维护（见migrations.py），修改places.parent_id即可移动整个子树
+place_paths = Table(
+    'place_paths', Base.metadata,
+    Column('ancestor_id', Integer, primary_key=True),
+    Column('descendant_id', Integer, primary_key=True),
+    Column('depth', Integer, nullable=False),
+    Index('ix_place_paths_descendant', 'descendant_id', 'depth'),
+    sqlite_with_rowid=False)
+
+
+# 物品坐标的范围：x、y是物品在场景图片中的相对位置，0是图片的左边/上边，COORD_SCALE是右边/下边，
+# 和图片的分辨率、显示时的缩放无关（界面中的换算见main.ImageLabel）
+COORD_SCALE = 65536
+
+
 # 物品：一件物品，包含名字、介绍、坐标、所属场景
 class Item(Base):
     __tablename__ = 'items'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, index=True)
     description = Column(String)
-    place_id = Column(Integer, ForeignKey('places.id'))
+    place_id = Column(Integer, ForeignKey('places.id'), index=True)
     place = relationship('Place', back_populates='items')
     x = Column(Integer)
     y = Column(Integer)
@@ -36,13 +65,203 @@ class Item(Base):
         return "<Item(name='%s', x='%d', y='%d')>" % (self.name, self.x, self.y)
 
 
+# 统计场景中的物品个数：一次分组查询，place_ids为None时统计所有场景
+def item_counts(session, place_ids=None):
+    query = session.query(Item.place_id, func.count(Item.id)).group_by(Item.place_id)
+    if place_ids is not None:
+        place_ids = list(place_ids)
+        if not place_ids:
+            return {}
+        query = query.filter(Item.place_id.in_(place_ids))
+    counts = {place_id: 0 for place_id in place_ids or []}
+    counts.update(query)
+    return counts
+
+
+# 场景及其所有子场景中的物品个数：一次按闭包表分组的查询
+def subtree_item_counts(connection, place_ids):
+    place_ids = list(place_ids)
+    counts = {place_id: 0 for place_id in place_ids}
+    for start in range(0, len(place_ids), 500):
+        query = (select([place_paths.c.ancestor_id, func.count(Item.id)])
+                 .select_from(place_paths.join(Item.__table__, Item.place_id == place_paths.c.descendant_id))
+                 .where(place_paths.c.ancestor_id.in_(place_ids[start:start + 500]))
+                 .group_by(place_paths.c.ancestor_id))
+        counts.update(connection.execute(query).fetchall())
+    return counts
+
+
+# 场景的路径（面包屑）：场景id -> [(id, 名字), ...]，从顶层场景到它自己，一次查询
+def place_paths_of(connection, place_ids):
+    place_ids = list(place_ids)
+    paths = {place_id: [] for place_id in place_ids}
+    places = Place.__table__
+    for start in range(0, len(place_ids), 500):
+        query = (select([place_paths.c.descendant_id, places.c.id, places.c.name])
+                 .select_from(place_paths.join(places, places.c.id == place_paths.c.ancestor_id))
+                 .where(place_paths.c.descendant_id.in_(place_ids[start:start + 500]))
+                 .order_by(place_paths.c.descendant_id, place_paths.c.depth.desc()))
+        for row in connection.execute(query):
+            paths[row[0]].append((row[1], row[2]))
+    return paths
+
+
+# 场景及其所有子场景的id
+def subtree_ids(connection, place_id):
+    query = select([place_paths.c.descendant_id]).where(place_paths.c.ancestor_id == place_id)
+    return [row[0] for row in connection.execute(query)]
+
+
+# ancestor是否是place自己或者它的祖先（把ancestor移动到place下面会形成环）
+def is_ancestor(connection, ancestor_id, place_id):
+    query = select([place_paths.c.depth]).where(
+        (place_paths.c.ancestor_id == ancestor_id) & (place_paths.c.descendant_id == place_id))
+    return connection.execute(query).first() is not None
+
+
+# 记录每次flush中物品数目可能发生变化的场景（添加/移动/删除物品）
+# 界面只需要重新统计这些场景
+@event.listens_for(BaseSession, 'after_flush')
+def record_changed_places(session, flush_context):
+    changed = session.info.setdefault('changed_places', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Item):
+            continue
+        history = get_history(obj, 'place_id')
+        changed.update(history.added)
+        changed.update(history.deleted)
+        # 通过item.place移动时，原来的场景记录在关系的历史中
+        history = get_history(obj, 'place', passive=True)
+        changed.update(place.id for place in history.deleted or () if place is not None)
+        changed.add(obj.place_id)
+    changed.discard(None)
+
+
+ADDED = 'added'
+UPDATED = 'updated'
+MOVED = 'moved'
+DELETED = 'deleted'
+
+
+# 一次数据变化：kind为ADDED/UPDATED/MOVED/DELETED，values为修改后的列
+# 物品的old_place_id/place_id是变化前后所在的场景（添加时没有前者，删除时没有后者）
+class Change:
+    def __init__(self, kind, cls, id, values=None, old_place_id=None, place_id=None):
+        self.kind = kind
+        self.cls = cls
+        self.id = id
+        self.values = values or {}
+        self.old_place_id = old_place_id
+        self.place_id = place_id
+
+    def __repr__(self):
+        return "<Change(%s %s %s %r)>" % (self.kind, self.cls.__name__, self.id, self.values)
+
+
+# 对象中在这次flush中被修改的列
+def changed_columns(obj):
+    values = {}
+    for attr in inspect(obj).mapper.column_attrs:
+        if get_history(obj, attr.key).added:
+            values[attr.key] = getattr(obj, attr.key)
+    return values
+
+
+# 把每次flush写入的变化记录在session.info['changes']中，提交后由界面按变化更新
+@event.listens_for(BaseSession, 'after_flush')
+def record_changes(session, flush_context):
+    changes = session.info.setdefault('changes', [])
+    for obj in session.new:
+        values = changed_columns(obj)
+        changes.append(Change(ADDED, type(obj), obj.id, values, place_id=getattr(obj, 'place_id', None)))
+    for obj in session.dirty:
+        if not session.is_modified(obj):
+            continue
+        values = changed_columns(obj)
+        if isinstance(obj, Item) and 'place_id' in values:
+            history = get_history(obj, 'place_id')
+            old_place_id = history.deleted[0] if history.deleted else None
+            changes.append(Change(MOVED, Item, obj.id, values, old_place_id, obj.place_id))
+        else:
+            changes.append(Change(UPDATED, type(obj), obj.id, values, place_id=getattr(obj, 'place_id', None)))
+    for obj in session.deleted:
+        place_id = getattr(obj, 'place_id', None)
+        changes.append(Change(DELETED, type(obj), obj.id, old_place_id=place_id))
+
+
+# 取出并清空记录的变化
+def pop_changes(session):
+    return session.info.pop('changes', [])
+
+
+# 取出并清空数目发生变化的场景
+def pop_changed_places(session):
+    return session.info.pop('changed_places', set())
+
+
+# 搜索物品，按相关度返回物品id列表，connection可以是session或者Connection
+# 查询见where.search_ids（命令行查找使用同样的查询），within为场景id时只搜索这个场景及其子场景
+def search_items(connection, text, limit=None, within=None):
+    return search_ids(lambda sql, params: connection.execute(text_sql(sql), params),
+                      text, search_index_available(), limit, within)
+
+
+# 按id读取物品及其所在场景的名字（一次连接查询，不会逐个加载场景），保持ids的顺序
+def item_records(connection, ids):
+    ids = list(ids)
+    records = {}
+    # SQLite对参数个数有限制，分批查询
+    for start in range(0, len(ids), 500):
+        query = (select([Item.id, Item.name, Item.description, Item.place_id,
+                         Place.name.label('place_name')])
+                 .select_from(Item.__table__.join(Place.__table__))
+                 .where(Item.id.in_(ids[start:start + 500])))
+        for row in connection.execute(query):
+            records[row.id] = row
+    return [records[item_id] for item_id in ids if item_id in records]
+
+
+# 场景中位于矩形(x0, y0)-(x1, y1)内（包含边界）的物品，按id排序
+# 有空间索引时由R*Tree找出物品再按主键读取，否则用场景的索引读出场景中所有物品再比较坐标
+def items_in_rect(connection, place_id, x0, y0, x1, y1):
+    params = {'place_id': place_id, 'x0': min(x0, x1), 'x1': max(x0, x1),
+              'y0': min(y0, y1), 'y1': max(y0, y1)}
+    if spatial_index_available():
+        sql = """SELECT items.* FROM items_rtree JOIN items ON items.id = items_rtree.id
+                 WHERE items_rtree.min_place <= :place_id AND items_rtree.max_place >= :place_id
+                   AND items_rtree.min_x <= :x1 AND items_rtree.max_x >= :x0
+                   AND items_rtree.min_y <= :y1 AND items_rtree.max_y >= :y0
+                 ORDER BY items.id"""
+    else:
+        sql = """SELECT * FROM items WHERE place_id = :place_id
+                 AND x BETWEEN :x0 AND :x1 AND y BETWEEN :y0 AND :y1 ORDER BY id"""
+    return connection.execute(text_sql(sql), params).fetchall()
+
+
+# 场景中离(x, y)不超过radius的物品，由近到远排序：先按外接正方形查询，再计算距离
+def items_near(connection, place_id, x, y, radius):
+    rows = items_in_rect(connection, place_id, x - radius, y - radius, x + radius, y + radius)
+    distances = [((row.x - x) ** 2 + (row.y - y) ** 2, row.id, row) for row in rows]
+    return [row for distance, _, row in sorted(distances, key=lambda entry: entry[:2])
+            if distance <= radius * radius]
+
+
+# 创建engine：新连接设置调优参数，数据库结构升级到最新版本
+# 其它参数传给create_engine（如connect_args）
+def open_engine(path=DB_PATH, **kwargs):
+    engine = create_engine('sqlite:///' + path, **kwargs)
+    event.listen(engine, 'connect', configure_connection)
+    migrate(engine, Base.metadata)
+    return engine
+
+
 # 初始化数据库并且用测试数据填充
 def init_db():
-    if os.path.exists('db.sqlite3'):
-        os.remove('db.sqlite3')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(DB_PATH + suffix):
+            os.remove(DB_PATH + suffix)
 
-    engine = create_engine('sqlite:///db.sqlite3')
-    Base.metadata.create_all(engine)
+    engine = open_engine()
     Session = sessionmaker(engine)
     session = Session()
 
@@ -51,17 +270,58 @@ def init_db():
         image = 'images/{}.jpg'.format(str(i))
         place = Place(name=name, image=image)
         description = '这是一个手机'
-        item1 = Item(name='手机', place=place, x=100, y=100, description=description)
-        item2 = Item(name='毛巾', place=place, x=100, y=200, description=description)
-        item3 = Item(name='打火机', place=place, x=100, y=300, description=description)
-        item4 = Item(name='钱包', place=place, x=200, y=100, description=description)
-        item5 = Item(name='书包', place=place, x=200, y=200, description=description)
-        item6 = Item(name='港币', place=place, x=200, y=300, description=description)
+        # 图片宽高的1/4、1/2、3/4处
+        q = COORD_SCALE // 4
+        item1 = Item(name='手机', place=place, x=q, y=q, description=description)
+        item2 = Item(name='毛巾', place=place, x=q, y=2 * q, description=description)
+        item3 = Item(name='打火机', place=place, x=q, y=3 * q, description=description)
+        item4 = Item(name='钱包', place=place, x=2 * q, y=q, description=description)
+        item5 = Item(name='书包', place=place, x=2 * q, y=2 * q, description=description)
+        item6 = Item(name='港币', place=place, x=2 * q, y=3 * q, description=description)
         session.add_all([item1, item2, item3, item4, item5, item6])
     session.commit()
 
 
-engine = create_engine('sqlite:///db.sqlite3')
-Base.metadata.create_all(engine)
-Session = sessionmaker(engine)
-session = Session()
\ No newline at end of file
+# 数据库在第一次使用时才打开（连接参数、结构迁移），导入models不会访问数据库
+_engine = None
+_search_index = False
+_spatial_index = False
+_engine_lock = threading.Lock()
+
+
+# 共享的engine，可以在任意线程中调用，只会打开一次
+def get_engine():
+    global _engine, _search_index, _spatial_index
+    if _engine is not None:
+        return _engine
+    with _engine_lock:
+        if _engine is None:
+            engine = open_engine()
+            _search_index = has_search_index(engine)
+            _spatial_index = has_spatial_index(engine)
+            _engine = engine
+    return _engine
+
+
+# 全文索引是否可用
+def search_index_available():
+    get_engine()
+    return _search_index
+
+
+# 空间索引是否可用
+def spatial_index_available():
+    get_engine()
+    return _spatial_index
+
+
+# 创建session不会打开数据库，第一次查询时才通过get_engine()打开
+class LazySession(BaseSession):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self.bind is not None:
+            return self.bind
+        return get_engine()
+
+
+Session = sessionmaker(class_=LazySession)
+session = Session()
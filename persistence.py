@@ -0,0 +1,476 @@
+import queue
+import threading
+import time
+
+from PyQt5.QtCore import QObject, pyqtSignal
+from sqlalchemy import func, inspect
+from sqlalchemy.orm import make_transient, make_transient_to_detached
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+
+import profiling
+from models import Session, session, pop_changed_places, pop_changes
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+# 一条待写入的修改，同一个对象的多次修改会合并成一条
+class Mutation:
+    def __init__(self, kind, cls, pk, values):
+        self.kind = kind
+        self.cls = cls
+        self.pk = pk
+        self.values = dict(values)
+
+    @property
+    def key(self):
+        return self.cls, self.pk
+
+    # 合并同一个对象上后发生的修改，返回None表示两者抵消（插入后又删除）
+    def merge(self, later):
+        if later.kind == DELETE:
+            if self.kind == INSERT:
+                return None
+            return later
+        if self.kind == DELETE:
+            # 删除后不会再有修改，忽略
+            return self
+        self.values.update(later.values)
+        return self
+
+
+# 按顺序合并修改，保持每个对象第一次出现的顺序（先插入场景再插入物品）
+def coalesce(mutations):
+    merged = {}
+    for mutation in mutations:
+        current = merged.get(mutation.key)
+        if current is None:
+            merged[mutation.key] = mutation
+            continue
+        result = current.merge(mutation)
+        if result is None:
+            del merged[mutation.key]
+        else:
+            merged[mutation.key] = result
+    return list(merged.values())
+
+
+# 队列中的标记：GUI线程已经改用了这些新对象换过的主键（见WriteBehindWriter.remap），
+# 之后的修改使用新的主键，后台线程不再转换
+class Forget:
+    def __init__(self, keys):
+        self.keys = keys
+
+
+def add_to_batch(batch, mutation):
+    if isinstance(mutation, list):
+        batch.extend(mutation)
+    else:
+        batch.append(mutation)
+
+
+# 批量修改时记录关系另一端集合（如place.items）中要移除/添加的对象，最后每个集合只重建一次
+class Collections:
+    def __init__(self, writer):
+        self.writer = writer
+        # (目标对象的id(), 集合名) -> [目标对象, 移除的对象集合, 添加的对象列表]
+        self.changes = {}
+
+    def entry(self, obj, key, target):
+        backref = self.writer.backref(obj, key)
+        if target is None or not backref or backref not in inspect(target).dict:
+            return None
+        return self.changes.setdefault((id(target), backref), [target, set(), []])
+
+    def remove(self, obj, key, target):
+        entry = self.entry(obj, key, target)
+        if entry is not None:
+            entry[1].add(obj)
+
+    def add(self, obj, key, target):
+        entry = self.entry(obj, key, target)
+        if entry is not None:
+            entry[2].append(obj)
+
+    def apply(self):
+        for (_, backref), (target, removed, added) in self.changes.items():
+            collection = [obj for obj in getattr(target, backref) if obj not in removed]
+            present = set(collection)
+            collection.extend(obj for obj in added if obj not in present)
+            set_committed_value(target, backref, collection)
+
+
+# 一次提交的结果：写入的修改、物品数目发生变化的场景id、数据变化（models.Change）、
+# 换了主键的新对象{(类, 预留的主键): 写入的主键}
+class CommitResult:
+    def __init__(self, mutations, changed_places, changes=(), remapped=None):
+        self.mutations = mutations
+        self.changed_places = changed_places
+        self.changes = list(changes)
+        self.remapped = remapped or {}
+
+    # 是否写入了某个类的对象（如Place）
+    def touches(self, cls):
+        return any(mutation.cls is cls for mutation in self.mutations)
+
+
+# 对象中所有列的值
+def column_values(obj):
+    mapper = inspect(obj).mapper
+    return {attr.key: getattr(obj, attr.key) for attr in mapper.column_attrs}
+
+
+# 多对一关系的外键列：[(列名, 引用的类)]
+def foreign_keys(cls):
+    return [(local.key, prop.mapper.class_) for prop in inspect(cls).relationships
+            if prop.direction is MANYTOONE for local, _ in prop.local_remote_pairs]
+
+
+# 后台写入：1.界面上的修改立即反映到内存中的对象，但不会让GUI线程的session写数据库
+#          2.修改放入队列，由后台线程合并后在一个事务中批量提交
+#          3.提交完成/失败通过Qt信号通知界面，committed携带CommitResult
+#          4.退出时close()把队列中剩余的修改全部写完
+#          5.update_many/delete_many的修改作为一组放入队列，保证在同一个事务中提交
+#          6.新对象的主键在GUI线程中预留（之后的修改要用它），其它程序（bulk.py、sync.py、seed.py）
+#            可能同时插入了相同id的行：后台线程在写入事务中检查，已经被占用的换成当前最大id之后的值，
+#            GUI线程收到结果后改用新的主键；写入失败时从没有写入的新对象从session中移除
+class WriteBehindWriter(QObject):
+    committed = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    # 写入失败的新对象[(类, 主键)]，在failed之前发出（GUI线程先移除没有写入的新对象）
+    discarded = pyqtSignal(object)
+
+    def __init__(self, gui_session=session, session_factory=Session, delay=0.05):
+        super().__init__()
+        self.gui_session = gui_session
+        self.session_factory = session_factory
+        # 收到第一条修改后再等待delay秒，把这段时间内的修改放在同一个事务中
+        self.delay = delay
+        self.queue = queue.Queue()
+        self._next_ids = {}
+        # 后台线程：换过的主键，直到GUI线程改用新的主键（收到Forget）
+        self._remapped = {}
+        # 先于其它连接（如events.bus）执行，其它界面收到结果时对象已经是新的主键
+        self.committed.connect(self.apply_remapped)
+        self.discarded.connect(self.discard_unsaved)
+        self._thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    # 为新对象分配主键（只在GUI线程中调用）：每次和数据库中最大的id比较，跳过其它程序已经用了的id
+    # （不能只用数据库中的值：队列中还没有写入的新对象也占用了id）
+    def reserve_id(self, cls):
+        top = self.gui_session.query(func.max(inspect(cls).primary_key[0])).scalar() or 0
+        next_id = max(self._next_ids.get(cls, 0), top + 1)
+        self._next_ids[cls] = next_id + 1
+        return next_id
+
+    # 添加新对象：分配主键后作为已保存的对象放入GUI线程的session
+    # 多对一的关系（如item.place）在这里通过外键值设置，不要在构造时传入
+    def add(self, obj, **relations):
+        state = inspect(obj)
+        if state.session is not None:
+            state.session.expunge(obj)
+        mapper = state.mapper
+        pk = mapper.primary_key[0].key
+        if getattr(obj, pk) is None:
+            setattr(obj, pk, self.reserve_id(mapper.class_))
+        for key, target in relations.items():
+            self.set_relation(obj, key, target, expunged=True)
+        make_transient_to_detached(obj)
+        self.gui_session.add(obj)
+        for key, target in relations.items():
+            set_committed_value(obj, key, target)
+            self.add_to_collection(obj, key, target)
+        self.submit(Mutation(INSERT, mapper.class_, getattr(obj, pk), column_values(obj)))
+        return obj
+
+    # 修改对象，关系（如place=new_place）会同时修改外键并更新双方的集合
+    def update(self, obj, **values):
+        self.submit(self.updated(obj, values))
+
+    # 在一个事务中修改多个对象，updates是(对象, 新的值)的列表
+    # 关系另一端的集合每个只重建一次（逐个修改时每次都要复制整个集合）
+    def update_many(self, updates):
+        collections = Collections(self)
+        self.submit([self.updated(obj, values, collections) for obj, values in updates])
+        collections.apply()
+
+    # 删除对象：从GUI线程的session和所属的集合中移除
+    def delete(self, obj):
+        self.submit(self.deleted(obj))
+
+    # 在一个事务中删除多个对象
+    def delete_many(self, objs):
+        collections = Collections(self)
+        self.submit([self.deleted(obj, collections) for obj in objs])
+        collections.apply()
+
+    def updated(self, obj, values, collections=None):
+        mapper = inspect(obj).mapper
+        columns = {}
+        for key, value in values.items():
+            if key in mapper.relationships:
+                columns.update(self.set_relation(obj, key, value, collections=collections))
+            else:
+                set_committed_value(obj, key, value)
+                columns[key] = value
+        return Mutation(UPDATE, mapper.class_, inspect(obj).identity[0], columns)
+
+    def deleted(self, obj, collections=None):
+        state = inspect(obj)
+        mapper = state.mapper
+        pk = state.identity[0]
+        for key in mapper.relationships.keys():
+            prop = mapper.relationships[key]
+            if prop.direction is MANYTOONE and key in state.dict:
+                if collections is None:
+                    self.remove_from_collection(obj, key, state.dict[key])
+                else:
+                    collections.remove(obj, key, state.dict[key])
+        if state.session is not None:
+            state.session.expunge(obj)
+        return Mutation(DELETE, mapper.class_, pk, {})
+
+    # 设置多对一关系，返回需要写入的外键列
+    # collections不为None时集合的修改先记录下来，由调用者最后一起更新
+    def set_relation(self, obj, key, target, expunged=False, collections=None):
+        prop = inspect(obj).mapper.relationships[key]
+        columns = {}
+        for local, remote in prop.local_remote_pairs:
+            value = getattr(target, remote.key) if target is not None else None
+            if expunged:
+                setattr(obj, local.key, value)
+            else:
+                set_committed_value(obj, local.key, value)
+            columns[local.key] = value
+        if not expunged:
+            old = inspect(obj).dict.get(key)
+            set_committed_value(obj, key, target)
+            if collections is not None:
+                collections.remove(obj, key, old)
+                collections.add(obj, key, target)
+                return columns
+            if old is not None:
+                self.remove_from_collection(obj, key, old)
+            self.add_to_collection(obj, key, target)
+        return columns
+
+    # 维护关系另一端已经加载的集合（如place.items），没有加载的集合之后会从数据库读取
+    @staticmethod
+    def backref(obj, key):
+        return inspect(obj).mapper.relationships[key].back_populates
+
+    def add_to_collection(self, obj, key, target):
+        backref = self.backref(obj, key)
+        if target is None or not backref or backref not in inspect(target).dict:
+            return
+        collection = list(getattr(target, backref))
+        if obj not in collection:
+            collection.append(obj)
+            set_committed_value(target, backref, collection)
+
+    def remove_from_collection(self, obj, key, target):
+        backref = self.backref(obj, key)
+        if target is None or not backref or backref not in inspect(target).dict:
+            return
+        collection = [other for other in getattr(target, backref) if other is not obj]
+        set_committed_value(target, backref, collection)
+
+    # 放入队列，mutation可以是一组修改（列表），一组修改不会被拆到两个事务中
+    def submit(self, mutation):
+        self.queue.put(mutation)
+
+    # 后台线程：取出一批修改，合并后在一个事务中提交
+    def run(self):
+        stop = False
+        while not stop:
+            mutation = self.queue.get()
+            if mutation is None:
+                break
+            if isinstance(mutation, Forget):
+                self.forget(mutation)
+                continue
+            batch = []
+            add_to_batch(batch, mutation)
+            forget = None
+            deadline = time.monotonic() + self.delay
+            while True:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        mutation = self.queue.get(timeout=timeout)
+                    else:
+                        mutation = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if mutation is None:
+                    stop = True
+                    break
+                if isinstance(mutation, Forget):
+                    # 之前的修改还使用原来的主键，先写入
+                    forget = mutation
+                    break
+                add_to_batch(batch, mutation)
+            self.write(coalesce(batch))
+            if forget is not None:
+                self.forget(forget)
+
+    def forget(self, marker):
+        for key in marker.keys:
+            self._remapped.pop(key, None)
+
+    def write(self, mutations):
+        if not mutations:
+            return
+        with profiling.action('commit', 'database', mutations=len(mutations)):
+            self.commit(mutations)
+
+    def commit(self, mutations):
+        worker_session = self.session_factory()
+        # GUI线程中的新对象还是预留的主键
+        inserted = [mutation.key for mutation in mutations if mutation.kind == INSERT]
+        remapped = {}
+        try:
+            for mutation in mutations:
+                self.remap(mutation, self._remapped)
+            remapped = self.check_reserved(worker_session, mutations)
+            if remapped:
+                for mutation in mutations:
+                    self.remap(mutation, remapped)
+            # 保持引用，identity map只保存弱引用
+            loaded = self.preload(worker_session, mutations)
+            for mutation in mutations:
+                self.apply(worker_session, mutation)
+            worker_session.commit()
+        except Exception as e:
+            worker_session.rollback()
+            self.discarded.emit(inserted)
+            self.failed.emit(str(e))
+            return
+        finally:
+            worker_session.close()
+        self._remapped.update(remapped)
+        self.committed.emit(CommitResult(mutations, pop_changed_places(worker_session),
+                                         pop_changes(worker_session), remapped))
+
+    # 在写入事务中检查新对象预留的主键：不大于数据库中最大id的已经被其它程序用了，
+    # 换成比数据库和这一批中所有id都大的值，返回{(类, 预留的主键): 新的主键}
+    @staticmethod
+    def check_reserved(worker_session, mutations):
+        inserts = {}
+        for mutation in mutations:
+            if mutation.kind == INSERT:
+                inserts.setdefault(mutation.cls, []).append(mutation)
+        remapped = {}
+        for cls, group in inserts.items():
+            top = worker_session.query(func.max(inspect(cls).primary_key[0])).scalar() or 0
+            taken = [mutation for mutation in group if mutation.pk <= top]
+            next_id = max([top] + [mutation.pk for mutation in group]) + 1
+            for mutation in taken:
+                remapped[(cls, mutation.pk)] = next_id
+                next_id += 1
+        return remapped
+
+    # 把修改中的主键和外键换成新的主键
+    @staticmethod
+    def remap(mutation, remapped):
+        if not remapped:
+            return
+        pk = remapped.get(mutation.key)
+        if pk is not None:
+            mutation.pk = pk
+            if mutation.kind == INSERT:
+                mutation.values[inspect(mutation.cls).primary_key[0].key] = pk
+        for key, target in foreign_keys(mutation.cls):
+            value = remapped.get((target, mutation.values.get(key)))
+            if value is not None:
+                mutation.values[key] = value
+
+    # GUI线程：换了主键的新对象改用新的主键，引用它们的对象修改外键，再通知后台线程不再转换
+    def apply_remapped(self, result):
+        if not result.remapped:
+            return
+        identity_map = self.gui_session.identity_map
+        moved = []
+        for (cls, old), new in result.remapped.items():
+            obj = identity_map.get(identity_key(cls, old))
+            if obj is not None:
+                self.gui_session.expunge(obj)
+                moved.append((obj, new))
+        for obj, new in moved:
+            make_transient(obj)
+            setattr(obj, inspect(obj).mapper.primary_key[0].key, new)
+            make_transient_to_detached(obj)
+            self.gui_session.add(obj)
+        for obj in list(identity_map.values()):
+            for key, target in foreign_keys(type(obj)):
+                value = result.remapped.get((target, inspect(obj).dict.get(key)))
+                if value is not None:
+                    set_committed_value(obj, key, value)
+        for cls, old in result.remapped:
+            self._next_ids[cls] = max(self._next_ids.get(cls, 0), result.remapped[(cls, old)] + 1)
+        self.queue.put(Forget(list(result.remapped)))
+
+    # GUI线程：写入失败时，没有写入的新对象从session和所属的集合中移除
+    # （否则之后expire_all()会从数据库中读出其它程序写入的、主键相同的行）
+    def discard_unsaved(self, keys):
+        identity_map = self.gui_session.identity_map
+        for cls, pk in keys:
+            obj = identity_map.get(identity_key(cls, pk))
+            if obj is not None:
+                self.deleted(obj)
+
+    # 要修改/删除的对象按类用IN查询一次读出，apply()中的get()直接从identity map中取
+    @staticmethod
+    def preload(worker_session, mutations):
+        loaded = []
+        pks = {}
+        for mutation in mutations:
+            if mutation.kind != INSERT:
+                pks.setdefault(mutation.cls, []).append(mutation.pk)
+        for cls, ids in pks.items():
+            if len(ids) < 2:
+                continue
+            pk = inspect(cls).primary_key[0]
+            # SQLite对参数个数有限制，分批查询
+            for start in range(0, len(ids), 500):
+                loaded.extend(worker_session.query(cls).filter(pk.in_(ids[start:start + 500])))
+        return loaded
+
+    # 插入立即写入（后面的对象可能通过外键引用它），修改和删除在提交时一起写入
+    @staticmethod
+    def apply(worker_session, mutation):
+        if mutation.kind == INSERT:
+            worker_session.add(mutation.cls(**mutation.values))
+            worker_session.flush()
+            return
+        obj = worker_session.identity_map.get(identity_key(mutation.cls, mutation.pk))
+        if obj is None:
+            obj = worker_session.query(mutation.cls).get(mutation.pk)
+        if obj is None:
+            return
+        if mutation.kind == DELETE:
+            worker_session.delete(obj)
+        else:
+            for key, value in mutation.values.items():
+                setattr(obj, key, value)
+
+    # 写完队列中所有的修改并停止后台线程
+    def close(self, timeout=None):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(timeout)
+
+
+# 全局共享的后台写入器，需要在QApplication创建之后才能使用
+_writer = None
+
+
+def writer():
+    global _writer
+    if _writer is None:
+        _writer = WriteBehindWriter()
+    return _writer
@@ -0,0 +1,241 @@
+from functools import partial
+
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QSize, QRect, pyqtSignal
+from PyQt5.QtWidgets import QListView, QStyledItemDelegate, QStyle
+
+from events import bus
+from image_loader import image_loader
+from repository import repository, ALL_PLACES
+
+# 场景图片的显示尺寸
+IMAGE_SIZE = 200
+# 每个场景格子的大小（图片+名字+物品个数）
+CELL_WIDTH = 220
+CELL_HEIGHT = 260
+
+PlaceRole = Qt.UserRole
+CountRole = Qt.UserRole + 1
+
+
+# 场景列表模型：按页从数据库读取场景，视图滚动到末尾时再读取下一页
+# load为False时先保持为空，之后调用reload()读取（启动时在窗口显示之后才访问数据库）
+# scope为显示的范围（见repository.ALL_PLACES），show_paths为True时显示场景的完整路径
+class PlaceListModel(QAbstractListModel):
+    def __init__(self, parent=None, page_size=50, load=True, scope=ALL_PLACES, show_paths=False):
+        super().__init__(parent)
+        self.page_size = page_size
+        self.scope = scope
+        self.show_paths = show_paths
+        self.places = []
+        # 场景id -> 行号
+        self._rows = {}
+        # 场景id -> 包括子场景在内的物品个数，每读取一页统计一次
+        self.counts = {}
+        self.total = 0
+        # 正在后台加载图片的场景id，避免重复请求
+        self._pending = set()
+        # 写入提交后逐个应用变化，不重新读取整个列表；对话框中的模型关闭时由release()断开
+        changes = bus()
+        self._subscriptions = [(changes.place_added, self.on_place_added),
+                               (changes.place_updated, self.on_place_updated),
+                               (changes.place_deleted, self.on_place_deleted)]
+        for signal in (changes.item_added, changes.item_moved, changes.item_deleted):
+            self._subscriptions.append((signal, self.on_item_changed))
+        for signal, slot in self._subscriptions:
+            signal.connect(slot)
+        if load:
+            self.reload()
+
+    # 重新读取（添加/删除场景后）
+    def reload(self):
+        self.beginResetModel()
+        self.places = []
+        self._rows = {}
+        self.counts = {}
+        self._pending.clear()
+        self.total = repository().place_count(self.scope)
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.places)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return False
+        return len(self.places) < self.total
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        places = repository().places_page(len(self.places), self.page_size, self.scope)
+        if not places:
+            # 数据库中的场景比预期少，停止继续读取
+            self.total = len(self.places)
+            return
+        self.counts.update(repository().subtree_counts(place.id for place in places))
+        if self.show_paths:
+            repository().paths(place.id for place in places)
+        first = len(self.places)
+        self.beginInsertRows(QModelIndex(), first, first + len(places) - 1)
+        self.places.extend(places)
+        for row, place in enumerate(places, first):
+            self._rows[place.id] = row
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        place = self.places[index.row()]
+        if role == Qt.DisplayRole:
+            return repository().path_text(place.id) if self.show_paths else place.name
+        if role == Qt.DecorationRole:
+            return self.pixmap(place)
+        if role == PlaceRole:
+            return place
+        if role == CountRole:
+            return self.counts.get(place.id, 0)
+        return None
+
+    # 只有视图真正需要绘制时才会请求图片
+    def pixmap(self, place):
+        callback = None
+        if place.id not in self._pending:
+            callback = partial(self.on_pixmap, place.id)
+        pixmap = image_loader().fetch(place.image, IMAGE_SIZE, IMAGE_SIZE,
+                                      owner=self, callback=callback)
+        if callback is not None and pixmap is image_loader().placeholder(IMAGE_SIZE, IMAGE_SIZE):
+            self._pending.add(place.id)
+        return pixmap
+
+    def on_pixmap(self, place_id, pixmap):
+        self._pending.discard(place_id)
+        row = self._rows.get(place_id)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    # 重新统计指定场景的物品个数，只查询已经读取的场景
+    def refresh_counts(self, place_ids):
+        place_ids = [place_id for place_id in place_ids if place_id in self._rows]
+        if not place_ids:
+            return
+        self.counts.update(repository().subtree_counts(place_ids))
+        for place_id in place_ids:
+            index = self.index(self._rows[place_id])
+            self.dataChanged.emit(index, index, [CountRole])
+
+    # 新场景的id最大，排在最后：已经读取到末尾时直接添加一行，否则等滚动到末尾时读取
+    def on_place_added(self, change):
+        if change.id in self._rows:
+            return
+        if self.scope != ALL_PLACES and change.values.get('parent_id') != self.scope:
+            return
+        if len(self.places) < self.total:
+            self.total += 1
+            return
+        place = repository().place(change.id)
+        if place is None:
+            return
+        row = len(self.places)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.places.append(place)
+        self._rows[place.id] = row
+        self.counts[place.id] = 0
+        self.total += 1
+        self.endInsertRows()
+
+    # 移动到其它场景下面后范围、个数、路径都可能变化，重新读取
+    def on_place_updated(self, change):
+        if 'parent_id' in change.values:
+            self.reload()
+            return
+        if self.show_paths and self.places:
+            # 改名会影响子场景的路径
+            self.dataChanged.emit(self.index(0), self.index(len(self.places) - 1))
+            return
+        row = self._rows.get(change.id)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+    def on_place_deleted(self, change):
+        row = self._rows.get(change.id)
+        self.total = max(self.total - 1, 0)
+        if row is None:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.places[row]
+        self.counts.pop(change.id, None)
+        self._pending.discard(change.id)
+        self._rows = {place.id: row for row, place in enumerate(self.places)}
+        self.endRemoveRows()
+
+    # 物品添加/移动/删除只影响所在场景（移动时还有原来的场景）及其祖先的物品个数，个数由repository按变化修改
+    def on_item_changed(self, change):
+        if not self._rows:
+            return
+        place_ids = {change.old_place_id, change.place_id} - {None}
+        affected = set()
+        for path in repository().paths(place_ids).values():
+            affected.update(place_id for place_id, _ in path)
+        self.refresh_counts(affected)
+
+    # 取消所有未完成的图片请求
+    # 对话框关闭时：取消尚未完成的图片解码，断开和事件总线的连接
+    # （总线一直存在，不断开时每个连接在模型删除之后仍然占用内存）
+    def release(self):
+        image_loader().cancel(self)
+        self._pending.clear()
+        for signal, slot in self._subscriptions:
+            signal.disconnect(slot)
+        self._subscriptions = []
+
+
+# 绘制一个场景格子：图片、名字、物品个数
+class PlaceDelegate(QStyledItemDelegate):
+    def paint(self, painter, option, index):
+        painter.save()
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        rect = option.rect
+        left = rect.x() + (rect.width() - IMAGE_SIZE) // 2
+        pixmap = index.data(Qt.DecorationRole)
+        if pixmap is not None:
+            painter.drawPixmap(left, rect.y() + 5, pixmap)
+        line_height = option.fontMetrics.height()
+        name_rect = QRect(left, rect.y() + IMAGE_SIZE + 10, IMAGE_SIZE, line_height)
+        painter.drawText(name_rect, Qt.AlignLeft | Qt.AlignVCenter, index.data(Qt.DisplayRole))
+        count_rect = name_rect.translated(0, line_height + 5)
+        painter.drawText(count_rect, Qt.AlignLeft | Qt.AlignVCenter,
+                         "{}个物品".format(index.data(CountRole)))
+        painter.restore()
+
+    def sizeHint(self, option, index):
+        return QSize(CELL_WIDTH, CELL_HEIGHT)
+
+
+# 场景网格视图：只绘制可见的格子，点击格子时发出place_clicked信号
+class PlaceGridView(QListView):
+    place_clicked = pyqtSignal(object)
+
+    def __init__(self, parent=None, model=None, load=True, scope=ALL_PLACES, show_paths=False):
+        super().__init__(parent)
+        self.setViewMode(QListView.IconMode)
+        self.setFlow(QListView.LeftToRight)
+        self.setWrapping(True)
+        self.setResizeMode(QListView.Adjust)
+        self.setMovement(QListView.Static)
+        self.setUniformItemSizes(True)
+        self.setGridSize(QSize(CELL_WIDTH, CELL_HEIGHT))
+        self.setSelectionMode(QListView.NoSelection)
+        # 默认每行放置2个
+        self.setMinimumSize(CELL_WIDTH * 2 + 30, CELL_HEIGHT + 10)
+        self.setItemDelegate(PlaceDelegate(self))
+        self.setModel(model if model is not None else
+                      PlaceListModel(self, load=load, scope=scope, show_paths=show_paths))
+        self.clicked.connect(self.on_clicked)
+
+    def on_clicked(self, index):
+        self.place_clicked.emit(index.data(PlaceRole))
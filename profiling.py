@@ -0,0 +1,272 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 可选的性能记录（默认关闭，关闭时每个记录点只多一次判断）：
+#   1.用户操作的耗时：打开对话框、flush、搜索、提交等，用action()/timed/span()记录
+#   2.每条SQL的次数和耗时（SQLAlchemy的cursor事件），计入同一线程中正在进行的操作
+#   3.图片解码的耗时（在线程池中）
+# 用 python main.py --profile [trace.json] 运行，退出时输出汇总表，
+# 并把所有记录写成Chrome trace-event格式（在chrome://tracing或Perfetto中打开）
+# 操作嵌套时，SQL计入所有正在进行的操作（外层操作的统计包含内层的）
+
+# SQL语句在汇总中最多显示的条数
+TOP_STATEMENTS = 10
+# 最多保存的trace事件个数，超出后只更新统计，不再保存事件
+MAX_EVENTS = 1000000
+
+
+# 同名操作的统计
+class ActionStats:
+    def __init__(self, category):
+        self.category = category
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+# 一次正在进行的操作，记录其中执行的SQL
+class _Action:
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+
+
+class Profiler:
+    def __init__(self, max_events=MAX_EVENTS):
+        self.max_events = max_events
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.dropped = 0
+        # 操作名 -> ActionStats
+        self.actions = {}
+        # SQL语句 -> [次数, 总耗时]
+        self.statements = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = set()
+        self._next_id = 0
+        self._listening = False
+
+    # 监听所有engine（包括之后才创建的）执行的SQL
+    def install(self):
+        if not self._listening:
+            event.listen(Engine, 'before_cursor_execute', self.before_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_execute)
+            self._listening = True
+
+    def uninstall(self):
+        if self._listening:
+            event.remove(Engine, 'before_cursor_execute', self.before_execute)
+            event.remove(Engine, 'after_cursor_execute', self.after_execute)
+            self._listening = False
+
+    # 当前线程中正在进行的操作（由外到内）
+    def stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def begin(self, name, category='action', **args):
+        action = _Action(name, category, args)
+        self.stack().append(action)
+        return action
+
+    def end(self, action):
+        end = time.perf_counter()
+        stack = self.stack()
+        if action in stack:
+            stack.remove(action)
+        args = dict(action.args)
+        if action.sql_count:
+            args['sql'] = action.sql_count
+            args['sql_ms'] = round(action.sql_time * 1000, 3)
+        with self._lock:
+            stats = self.stats(action.name, action.category)
+            stats.add(end - action.start)
+            stats.sql_count += action.sql_count
+            stats.sql_time += action.sql_time
+            self.add_event({'name': action.name, 'cat': action.category, 'ph': 'X',
+                            'ts': self.micros(action.start), 'dur': round((end - action.start) * 1000000, 1),
+                            'args': args})
+
+    @contextmanager
+    def action(self, name, category='action', **args):
+        action = self.begin(name, category, **args)
+        try:
+            yield action
+        finally:
+            self.end(action)
+
+    # 记录已经结束的一段时间（如从输入到显示搜索结果），可以跨越事件循环，
+    # 和同一线程中的其它操作不需要嵌套，保存为异步事件
+    def span(self, name, start, end=None, category='action', **args):
+        if end is None:
+            end = time.perf_counter()
+        with self._lock:
+            self.stats(name, category).add(end - start)
+            self._next_id += 1
+            common = {'name': name, 'cat': category, 'id': self._next_id}
+            self.add_event(dict(common, ph='b', ts=self.micros(start), args=args))
+            self.add_event(dict(common, ph='e', ts=self.micros(end)))
+
+    def stats(self, name, category):
+        stats = self.actions.get(name)
+        if stats is None:
+            stats = self.actions[name] = ActionStats(category)
+        return stats
+
+    def micros(self, seconds):
+        return round((seconds - self.start) * 1000000, 1)
+
+    # 调用时需要持有_lock
+    def add_event(self, trace_event):
+        tid = threading.get_ident()
+        if tid not in self._threads:
+            self._threads.add(tid)
+            self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                                'args': {'name': threading.current_thread().name}})
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        trace_event['pid'] = self.pid
+        trace_event['tid'] = tid
+        self.events.append(trace_event)
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('profile_start')
+        if not starts:
+            return
+        start = starts.pop()
+        end = time.perf_counter()
+        seconds = end - start
+        for action in self.stack():
+            action.sql_count += 1
+            action.sql_time += seconds
+        statement = ' '.join(statement.split())
+        with self._lock:
+            entry = self.statements.setdefault(statement, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            self.add_event({'name': statement[:80], 'cat': 'sql', 'ph': 'X', 'ts': self.micros(start),
+                            'dur': round((end - start) * 1000000, 1),
+                            'args': {'statement': statement, 'executemany': executemany}})
+
+    # 写出Chrome trace-event格式的JSON
+    def export(self, path):
+        with self._lock:
+            data = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    # 输出每种操作的次数、耗时和其中的SQL，以及总耗时最多的SQL语句
+    def report(self, out=sys.stderr, top=TOP_STATEMENTS):
+        with self._lock:
+            actions = sorted(self.actions.items(), key=lambda entry: -entry[1].total)
+            statements = sorted(self.statements.items(), key=lambda entry: -entry[1][1])[:top]
+        out.write('{:<36}{:>8}{:>12}{:>10}{:>10}{:>8}{:>10}\n'.format(
+            'action', 'count', 'total(ms)', 'avg(ms)', 'max(ms)', 'sql', 'sql(ms)'))
+        for name, stats in actions:
+            out.write('{:<36}{:>8}{:>12.1f}{:>10.2f}{:>10.2f}{:>8}{:>10.1f}\n'.format(
+                name[:35], stats.count, stats.total * 1000, stats.total * 1000 / stats.count,
+                stats.max * 1000, stats.sql_count, stats.sql_time * 1000))
+        if statements:
+            out.write('{:>8}{:>12}  {}\n'.format('count', 'total(ms)', 'statement'))
+            for statement, (count, seconds) in statements:
+                out.write('{:>8}{:>12.1f}  {}\n'.format(count, seconds * 1000, statement[:100]))
+        if self.dropped:
+            out.write('超过{}个事件，{}个事件没有写入trace\n'.format(self.max_events, self.dropped))
+
+
+# 全局的记录器，没有调用enable()时为None
+_profiler = None
+
+
+def enable(max_events=MAX_EVENTS):
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(max_events)
+        _profiler.install()
+    return _profiler
+
+
+def disable():
+    global _profiler
+    if _profiler is not None:
+        _profiler.uninstall()
+        _profiler = None
+
+
+def enabled():
+    return _profiler is not None
+
+
+def profiler():
+    return _profiler
+
+
+@contextmanager
+def _nothing():
+    yield None
+
+
+# with profiling.action('名字'): ... 记录一次操作，没有开启时什么也不做
+def action(name, category='action', **args):
+    if _profiler is None:
+        return _nothing()
+    return _profiler.action(name, category, **args)
+
+
+# 记录从start（time.perf_counter()）到现在的一段时间
+def span(name, start, category='action', **args):
+    if _profiler is not None and start is not None:
+        _profiler.span(name, start, None, category, **args)
+
+
+# 开启时返回当前时间，用于之后调用span()；没有开启时返回None
+def now():
+    if _profiler is None:
+        return None
+    return time.perf_counter()
+
+
+# 装饰器：记录函数/方法的每次调用，没有给出名字时为类名.方法名
+# 用法：@profiling.timed 或 @profiling.timed('名字', category)
+def timed(name=None, category='action'):
+    if callable(name):
+        return timed()(name)
+
+    def decorate(function):
+        label = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return function(*args, **kwargs)
+            with _profiler.action(label, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,220 @@
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import event, inspect, or_, select
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import Place, Item, session, get_engine, item_counts, subtree_item_counts, place_paths_of, \
+    place_paths, ADDED, MOVED, DELETED
+
+# 界面使用的数据访问层（不依赖Qt）：
+# 1.每个界面需要的数据用固定次数的批量查询读出，关系在查询时一起加载，不会逐个懒加载
+# 2.读取结果缓存在内存中，对象本身由session的identity map保存，缓存只记录数目和id
+# 3.后台写入提交后调用invalidate()，按记录的变化修改缓存
+
+# 场景列表的范围：ALL_PLACES为所有场景，None为顶层场景，场景id为这个场景的子场景
+ALL_PLACES = 'all'
+
+
+# 统计当前线程执行的SQL语句数（其它线程中的搜索、写入不计入）
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+        self.thread = threading.get_ident()
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self.thread:
+            self.count += 1
+            self.statements.append(statement)
+
+
+@contextmanager
+def count_queries(engine=None):
+    engine = engine or get_engine()
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter)
+
+
+class Repository:
+    def __init__(self, session=session):
+        self.session = session
+        # 范围 -> 场景个数
+        self._totals = {}
+        # (范围, offset, limit) -> 场景id列表
+        self._pages = {}
+        # 场景id -> 物品个数
+        self._counts = {}
+        # 场景id -> 包括子场景在内的物品个数
+        self._subtree_counts = {}
+        # 场景id -> 路径[(id, 名字), ...]，从顶层场景到它自己
+        self._paths = {}
+
+    def places_query(self, parent_id=ALL_PLACES):
+        query = self.session.query(Place)
+        if parent_id != ALL_PLACES:
+            query = query.filter(Place.parent_id == parent_id)
+        return query
+
+    # 场景总数（parent_id见ALL_PLACES）
+    def place_count(self, parent_id=ALL_PLACES):
+        total = self._totals.get(parent_id)
+        if total is None:
+            total = self._totals[parent_id] = self.places_query(parent_id).count()
+        return total
+
+    # 按id顺序读取一页场景，同时统计这些场景（包括子场景）的物品个数
+    def places_page(self, offset, limit, parent_id=ALL_PLACES):
+        ids = self._pages.get((parent_id, offset, limit))
+        if ids is not None:
+            # 只从identity map中取，有对象已经被回收时重新查询整页
+            places = [self.session.identity_map.get(identity_key(Place, place_id)) for place_id in ids]
+            if None not in places:
+                return places
+        places = self.places_query(parent_id).order_by(Place.id).offset(offset).limit(limit).all()
+        self._pages[(parent_id, offset, limit)] = [place.id for place in places]
+        self.subtree_counts([place.id for place in places])
+        return places
+
+    # 物品个数，没有缓存的场景用一次分组查询统计
+    def item_counts(self, place_ids):
+        place_ids = list(place_ids)
+        missing = [place_id for place_id in place_ids if place_id not in self._counts]
+        if missing:
+            self._counts.update(item_counts(self.session, missing))
+        return {place_id: self._counts[place_id] for place_id in place_ids}
+
+    # 场景及其子场景中的物品个数，没有缓存的场景用一次按闭包表分组的查询统计
+    def subtree_counts(self, place_ids):
+        place_ids = list(place_ids)
+        missing = [place_id for place_id in place_ids if place_id not in self._subtree_counts]
+        if missing:
+            self._subtree_counts.update(subtree_item_counts(self.session, missing))
+        return {place_id: self._subtree_counts[place_id] for place_id in place_ids}
+
+    # 场景的路径（面包屑），没有缓存的场景一次查询
+    def paths(self, place_ids):
+        place_ids = list(place_ids)
+        missing = [place_id for place_id in place_ids if place_id not in self._paths]
+        if missing:
+            self._paths.update(place_paths_of(self.session, missing))
+        return {place_id: self._paths[place_id] for place_id in place_ids}
+
+    # 打开场景时需要的路径和子场景个数：一次查询读出所有祖先和子场景
+    def load_family(self, place_id):
+        if place_id in self._paths and place_id in self._totals:
+            return
+        ancestors = select([place_paths.c.ancestor_id]).where(place_paths.c.descendant_id == place_id)
+        places = (self.session.query(Place).filter(or_(Place.id.in_(ancestors), Place.parent_id == place_id))
+                  .order_by(Place.id).all())
+        by_id = {place.id: place for place in places}
+        path = []
+        current = by_id.get(place_id)
+        while current is not None:
+            path.append((current.id, current.name))
+            current = by_id.get(current.parent_id)
+        self._paths[place_id] = path[::-1]
+        # 子场景的个数，打开子场景列表时不需要再统计
+        self._totals[place_id] = sum(1 for place in places if place.parent_id == place_id)
+
+    # 场景自己和所有祖先的id
+    def ancestor_ids(self, place_id):
+        return [ancestor_id for ancestor_id, _ in self.paths([place_id])[place_id]]
+
+    # 显示用的路径，如"房间 > 柜子 > 抽屉"
+    def path_text(self, place_id):
+        return ' > '.join(name or '' for _, name in self.paths([place_id])[place_id])
+
+    # 场景中的所有物品：一次查询，结果作为place.items保存在对象上，
+    # 之后的添加/移动/删除由persistence直接修改这个集合，不需要重新查询
+    def place_items(self, place):
+        if 'items' not in inspect(place).dict:
+            items = self.session.query(Item).filter(Item.place_id == place.id).order_by(Item.id).all()
+            # 已经在内存中移动到其它场景、但还没有写入的物品
+            items = [item for item in items if item.place_id == place.id]
+            set_committed_value(place, 'items', items)
+            for item in items:
+                set_committed_value(item, 'place', place)
+        return list(place.items)
+
+    # 按id读取场景，已经在session中的对象不会查询数据库
+    def place(self, place_id):
+        return self.session.query(Place).get(place_id)
+
+    # 按id读取物品及其所在场景，已经在session中的对象不会查询数据库
+    def item(self, item_id):
+        item = self.session.query(Item).options(joinedload(Item.place)).get(item_id)
+        if item is not None and 'place' not in inspect(item).dict:
+            set_committed_value(item, 'place', self.session.query(Place).get(item.place_id))
+        return item
+
+    # 写入提交后调用（persistence.CommitResult）：按每个变化修改缓存，不需要重新查询
+    def invalidate(self, result):
+        # 新对象换了主键（很少发生），缓存中可能有原来的主键
+        if result.remapped:
+            self.clear()
+            return
+        for change in result.changes:
+            self.apply(change)
+
+    def apply(self, change):
+        if change.cls is Place:
+            # 添加/删除场景或修改父场景时各个范围的场景个数和分页都会变化
+            if change.kind in (ADDED, DELETED) or 'parent_id' in change.values:
+                self._totals.clear()
+                self._pages.clear()
+            if change.kind == ADDED:
+                self._counts[change.id] = 0
+                self._subtree_counts[change.id] = 0
+            elif change.kind == DELETED or 'parent_id' in change.values:
+                # 子树移动后祖先的个数和路径都会变化（很少发生，全部重新统计）
+                self._counts.pop(change.id, None)
+                self._subtree_counts.clear()
+                self._paths.clear()
+            elif 'name' in change.values:
+                self._paths.clear()
+            return
+        if change.kind in (MOVED, DELETED):
+            self.adjust_count(change.old_place_id, -1)
+        if change.kind in (ADDED, MOVED):
+            self.adjust_count(change.place_id, 1)
+
+    # 只修改已经缓存的个数
+    def adjust_count(self, place_id, delta):
+        if place_id is None:
+            return
+        if place_id in self._counts:
+            self._counts[place_id] += delta
+        path = self._paths.get(place_id)
+        if path is None:
+            # 不知道哪些场景包含这个场景，丢弃子树的个数，之后重新统计
+            self._subtree_counts.clear()
+            return
+        for ancestor_id, _ in path:
+            if ancestor_id in self._subtree_counts:
+                self._subtree_counts[ancestor_id] += delta
+
+    # 丢弃所有缓存（写入失败、session中的对象过期后）
+    def clear(self):
+        self._totals.clear()
+        self._pages.clear()
+        self._counts.clear()
+        self._subtree_counts.clear()
+        self._paths.clear()
+
+
+# 全局共享的数据访问层，使用models.session
+_repository = None
+
+
+def repository():
+    global _repository
+    if _repository is None:
+        _repository = Repository()
+    return _repository
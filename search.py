@@ -0,0 +1,274 @@
+from collections import namedtuple
+
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, QTimer, QAbstractListModel, QModelIndex, \
+    pyqtSignal
+from sqlalchemy.exc import OperationalError
+
+import profiling
+from models import get_engine, search_items, item_records
+
+ResultRole = Qt.UserRole
+
+# 可以修改的搜索结果（item_records返回的行不能修改）
+ItemRecord = namedtuple('ItemRecord', ['id', 'name', 'description', 'place_id', 'place_name'])
+
+
+def replace_record(record, **values):
+    return ItemRecord(*record)._replace(**values)
+
+
+# 子串匹配（和数据库中的LIKE一样对英文不区分大小写），用于在上一次结果中缩小范围
+def record_matches(record, text):
+    text = text.lower()
+    return text in (record.name or '').lower() or text in (getattr(record, 'description', None) or '').lower()
+
+
+# 在数据库中搜索物品并读取名字和所在场景（一次连接查询），within见models.search_items
+def search_records(connection, text, limit=None, within=None):
+    return item_records(connection, search_items(connection, text, limit, within))
+
+
+# 搜索结果列表模型：结果一次性交给模型，视图滚动时按页插入行
+class SearchResultModel(QAbstractListModel):
+    def __init__(self, parent=None, page_size=50, formatter=None):
+        super().__init__(parent)
+        self.page_size = page_size
+        self.formatter = formatter or (lambda record: record.name)
+        self.results = []
+        self.shown = 0
+
+    def set_results(self, results):
+        self.beginResetModel()
+        self.results = list(results)
+        self.shown = 0
+        self.endResetModel()
+        # 先填充第一页，其余的在滚动时读取
+        if self.canFetchMore():
+            self.fetchMore()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.shown
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return False
+        return self.shown < len(self.results)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        count = min(self.page_size, len(self.results) - self.shown)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self.shown, self.shown + count - 1)
+        self.shown += count
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        record = self.results[index.row()]
+        if role == Qt.DisplayRole:
+            return self.formatter(record)
+        if role == ResultRole:
+            return record
+        return None
+
+    # 只修改一条结果：record为None时删除，已经存在则替换，否则添加到末尾
+    def patch(self, record_id, record=None):
+        row = self.find(record_id)
+        if row is None:
+            if record is None:
+                return
+            self.results.append(record)
+            # 已经显示到末尾时才插入行，否则在滚动时读取
+            if self.shown == len(self.results) - 1:
+                self.beginInsertRows(QModelIndex(), self.shown, self.shown)
+                self.shown += 1
+                self.endInsertRows()
+        elif record is None:
+            if row < self.shown:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self.results[row]
+                self.shown -= 1
+                self.endRemoveRows()
+            else:
+                del self.results[row]
+        else:
+            self.results[row] = record
+            if row < self.shown:
+                index = self.index(row)
+                self.dataChanged.emit(index, index)
+
+    def find(self, record_id):
+        for row, record in enumerate(self.results):
+            if record.id == record_id:
+                return row
+        return None
+
+    # 找到结果所在的行（必要时继续读取后面的页）
+    def row_of(self, record_id):
+        row = self.find(record_id)
+        if row is not None:
+            while self.shown <= row:
+                self.fetchMore()
+        return row
+
+
+# 工作线程通过这个对象把搜索结果发回GUI线程
+class _Signals(QObject):
+    done = pyqtSignal(int, str, object)
+
+
+# 在工作线程中执行的数据库搜索，每个任务使用自己的连接
+class _QueryTask(QRunnable):
+    def __init__(self, signals, generation, text, query):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.signals = signals
+        self.generation = generation
+        self.text = text
+        self.query = query
+        self.cancelled = False
+        self.dbapi_connection = None
+
+    # 无论是否被取消都会发出done信号，取消时结果为None
+    def run(self):
+        results = None
+        try:
+            if not self.cancelled:
+                with get_engine().connect() as connection:
+                    self.dbapi_connection = connection.connection
+                    if not self.cancelled:
+                        with profiling.action('search query', 'search', text=self.text):
+                            results = self.query(connection, self.text)
+        except OperationalError:
+            # 查询被interrupt()中断
+            if not self.cancelled:
+                raise
+        finally:
+            self.dbapi_connection = None
+            if self.cancelled:
+                results = None
+            self.signals.done.emit(self.generation, self.text, results)
+
+    # 取消任务：正在执行的SQLite查询会被中断
+    def cancel(self):
+        self.cancelled = True
+        connection = self.dbapi_connection
+        if connection is not None:
+            try:
+                connection.interrupt()
+            except Exception:
+                pass
+
+
+# 搜索流水线：1.对输入去抖动，停止输入一段时间后才搜索
+#            2.查询只是在上一次的查询后面增加内容时，直接在上一次的完整结果中过滤
+#            3.新的查询开始时取消旧的查询，过期的结果直接丢弃
+#            4.结果通过results_ready(text, results)信号交给界面
+# query(connection, text)在工作线程中查询数据库；
+# 如果给出local(text)则在GUI线程中同步搜索（用于已经在内存中的数据）
+class SearchPipeline(QObject):
+    results_ready = pyqtSignal(str, list)
+
+    def __init__(self, parent=None, query=None, local=None, matches=record_matches,
+                 delay=150, limit=None):
+        super().__init__(parent)
+        self.query = query
+        self.local = local
+        self.matches = matches
+        self.limit = limit
+        self.text = ''
+        self.generation = 0
+        self.task = None
+        # 开始执行当前查询的时间（只在开启profiling时记录）
+        self.started = None
+        # 还在线程池中的任务，结束前需要保持引用
+        self._tasks = {}
+        # 上一次完成的查询和结果，用于缩小范围
+        self.last_text = None
+        self.last_results = []
+        self.pool = QThreadPool.globalInstance()
+        self.signals = _Signals()
+        self.signals.done.connect(self.on_done)
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.run)
+
+    # 输入变化时调用，延迟执行
+    def set_text(self, text):
+        self.text = text.strip()
+        self.timer.start()
+
+    # 立即执行当前的查询（例如数据发生变化后刷新结果）
+    def refresh(self):
+        self.timer.stop()
+        self.last_text = None
+        self.run()
+
+    def run(self):
+        self.generation += 1
+        self.started = profiling.now()
+        self.cancel_task()
+        text = self.text
+        if not text and self.local is None:
+            self.finish(text, [])
+            return
+        if self.can_narrow(text):
+            self.finish(text, [record for record in self.last_results if self.matches(record, text)])
+            return
+        if self.local is not None:
+            self.finish(text, self.local(text))
+            return
+        self.task = _QueryTask(self.signals, self.generation, text, self.query)
+        self._tasks[self.generation] = self.task
+        self.pool.start(self.task)
+
+    # 上一次的结果完整（没有被limit截断）并且新查询包含上一次的查询
+    def can_narrow(self, text):
+        if not self.last_text or self.last_text not in text:
+            return False
+        return self.limit is None or len(self.last_results) < self.limit
+
+    def on_done(self, generation, text, results):
+        self._tasks.pop(generation, None)
+        if generation != self.generation or results is None:
+            return
+        self.task = None
+        self.finish(text, results)
+
+    # 记录从开始查询到界面显示结果的时间
+    def finish(self, text, results):
+        self.last_text = text
+        self.last_results = results
+        self.results_ready.emit(text, results)
+        profiling.span('search', self.started, 'search', text=text, results=len(results))
+
+    # 数据变化后修改上一次的结果（用于缩小范围），record为None时删除
+    def patch(self, record_id, record=None):
+        for row, old in enumerate(self.last_results):
+            if old.id == record_id:
+                if record is None:
+                    del self.last_results[row]
+                else:
+                    self.last_results[row] = record
+                return
+        if record is not None and self.last_text is not None and self.matches(record, self.last_text):
+            self.last_results.append(record)
+
+    def cancel_task(self):
+        if self.task is not None:
+            self.task.cancel()
+            if self.pool.tryTake(self.task):
+                self._tasks.pop(self.task.generation, None)
+            self.task = None
+
+    # 停止所有未完成的工作（对话框关闭时）
+    def cancel(self):
+        self.timer.stop()
+        self.generation += 1
+        self.cancel_task()
@@ -0,0 +1,106 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QGuiApplication, QImage, QPainter, QColor, QFont
+
+# 生成任意规模的测试数据：场景数、每个场景的物品数、图片分辨率都可以指定
+# 会覆盖WHERE_DB指定的数据库（默认db.sqlite3）中的数据
+#
+# 用法：
+#   python seed.py --places 500 --items 100 --resolution 4000x3000
+#   WHERE_DB=bench.sqlite3 python seed.py --places 2000 --items 50
+
+# 没有QApplication时（命令行运行）创建的QGuiApplication，绘制文字需要它
+_app = None
+
+NAMES = ['手机', '毛巾', '打火机', '钱包', '书包', '港币', '钥匙', '充电器', '雨伞', '剪刀',
+         '护照', '耳机', '电池', '胶带', '药盒', '手电筒', '螺丝刀', '相机', '围巾', '账本']
+
+
+def parse_resolution(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+# 生成一张纯色背景加编号的图片
+def make_image(path, width, height, number):
+    image = QImage(width, height, QImage.Format_RGB32)
+    random.seed(number)
+    image.fill(QColor(random.randrange(256), random.randrange(256), random.randrange(256)))
+    painter = QPainter(image)
+    font = QFont()
+    font.setPixelSize(max(height // 8, 10))
+    painter.setFont(font)
+    painter.setPen(Qt.white)
+    painter.drawText(image.rect(), Qt.AlignCenter, str(number))
+    painter.end()
+    image.save(path, 'JPG', 85)
+
+
+# 生成图片（images个不同的图片，场景循环使用）并批量写入数据库
+def seed(places, items_per_place, resolution=(800, 800), images=20, image_dir='images/generated',
+         chunk_size=20000, out=sys.stderr):
+    # models在这里导入，调用前可以先设置WHERE_DB
+    from models import get_engine, Place, Item, COORD_SCALE
+
+    global _app
+    if QGuiApplication.instance() is None:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        _app = QGuiApplication([])
+
+    start = time.perf_counter()
+    os.makedirs(image_dir, exist_ok=True)
+    width, height = resolution
+    paths = []
+    for number in range(min(images, places) or 1):
+        path = os.path.join(image_dir, '{}_{}x{}.jpg'.format(number, width, height))
+        if not os.path.exists(path):
+            make_image(path, width, height, number)
+        paths.append(path)
+    out.write('生成 {} 张图片: {:.1f}秒\n'.format(len(paths), time.perf_counter() - start))
+
+    engine = get_engine()
+    with engine.begin() as connection:
+        connection.execute(Item.__table__.delete())
+        connection.execute(Place.__table__.delete())
+    random.seed(0)
+    item_rows = []
+    with engine.connect() as connection:
+        with connection.begin():
+            connection.execute(Place.__table__.insert(), [
+                {'id': place_id, 'name': '房间{}'.format(place_id), 'image': paths[place_id % len(paths)]}
+                for place_id in range(1, places + 1)])
+        for place_id in range(1, places + 1):
+            for number in range(items_per_place):
+                item_rows.append({'name': '{}{}'.format(random.choice(NAMES), number),
+                                  'description': '场景{}中的第{}件物品'.format(place_id, number),
+                                  'place_id': place_id,
+                                  'x': random.randrange(COORD_SCALE), 'y': random.randrange(COORD_SCALE)})
+                if len(item_rows) >= chunk_size:
+                    with connection.begin():
+                        connection.execute(Item.__table__.insert(), item_rows)
+                    item_rows = []
+        if item_rows:
+            with connection.begin():
+                connection.execute(Item.__table__.insert(), item_rows)
+    out.write('生成 {} 个场景, {} 个物品: {:.1f}秒\n'.format(
+        places, places * items_per_place, time.perf_counter() - start))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='生成测试数据')
+    parser.add_argument('--places', type=int, default=100)
+    parser.add_argument('--items', type=int, default=50, help='每个场景的物品数')
+    parser.add_argument('--resolution', type=parse_resolution, default=(800, 800), help='图片分辨率，如4000x3000')
+    parser.add_argument('--images', type=int, default=20, help='不同图片的个数')
+    parser.add_argument('--image-dir', default='images/generated')
+    args = parser.parse_args(argv)
+    seed(args.places, args.items, args.resolution, args.images, args.image_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+import argparse
+import asyncio
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+from sqlalchemy import func, select, and_, exists
+
+from models import open_engine, search_items, item_records, items_in_rect, items_near, Place, Item, \
+    place_paths_of, subtree_item_counts, COORD_SCALE
+
+# 本地查询服务（不需要PyQt），用HTTP/JSON回答"东西在哪里"：
+#   GET  /search?q=手机&limit=50          搜索物品，返回物品和所在场景
+#   GET  /search?q=手机&within=1          只搜索场景1及其子场景中的物品
+#   GET  /places?offset=0&limit=50        场景列表及物品个数
+#   GET  /places/<id>                     场景的路径（从顶层场景开始）、物品个数和包括子场景的物品个数
+#   GET  /places/<id>/items               场景中的物品
+#   GET  /places/<id>/items?x0=0&y0=0&x1=32768&y1=32768   场景中位于矩形内的物品（使用空间索引）
+#   GET  /places/<id>/items?x=32768&y=32768&radius=8192   场景中离(x, y)不超过radius的物品，由近到远
+#   POST /items/<id>/move                 移动物品，内容为 {"place_id": 1, "x": 16384, "y": 16384}
+#                                         （x、y是图片中的相对位置，0~65536，见models.COORD_SCALE）
+# 读取在多个线程中并行执行，每个线程保持一个自己的连接（WAL模式下读取不会被写入阻塞）；
+# 写入在单独的一个线程中按顺序执行，和界面同时写数据库时由SQLite的锁保证一致
+#
+# 用法：
+#   python server.py [--host 127.0.0.1] [--port 8765] [--readers 8]
+
+places = Place.__table__
+items = Item.__table__
+
+MAX_LIMIT = 1000
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+# 每个线程一个长期使用的数据库连接，关闭服务时统一关闭
+class ConnectionPool:
+    def __init__(self, engine):
+        self.engine = engine
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self.engine.connect()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            del self._connections[:]
+
+
+def int_param(query, name, default, minimum=0, maximum=None):
+    values = query.get(name)
+    if not values:
+        return default
+    try:
+        value = int(values[0])
+    except ValueError:
+        raise HTTPError(400, '{}必须是整数'.format(name))
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise HTTPError(400, '{}超出范围'.format(name))
+    return value
+
+
+def record_json(record):
+    return {'id': record.id, 'name': record.name, 'description': record.description,
+            'place_id': record.place_id, 'place_name': record.place_name}
+
+
+def item_json(row):
+    return {'id': row.id, 'name': row.name, 'description': row.description,
+            'place_id': row.place_id, 'x': row.x, 'y': row.y}
+
+
+# 以下函数在线程池中执行，参数connection是当前线程的连接
+
+def search(connection, text, limit, within=None):
+    records = item_records(connection, search_items(connection, text, limit, within))
+    return {'query': text, 'results': [record_json(record) for record in records]}
+
+
+# 只统计这一页场景的物品个数（使用place_id的索引），不扫描整个物品表
+def list_places(connection, offset, limit):
+    total = connection.execute(select([func.count()]).select_from(places)).scalar()
+    rows = connection.execute(
+        select([places.c.id, places.c.name, places.c.image, places.c.parent_id])
+        .order_by(places.c.id).offset(offset).limit(limit)).fetchall()
+    counts = {}
+    if rows:
+        counts = dict(connection.execute(
+            select([items.c.place_id, func.count(items.c.id)])
+            .where(items.c.place_id.in_([row.id for row in rows]))
+            .group_by(items.c.place_id)).fetchall())
+    return {'total': total, 'offset': offset,
+            'places': [{'id': row.id, 'name': row.name, 'image': row.image, 'parent_id': row.parent_id,
+                        'item_count': counts.get(row.id, 0)} for row in rows]}
+
+
+def place_detail(connection, place_id):
+    place = connection.execute(select([places]).where(places.c.id == place_id)).first()
+    if place is None:
+        raise HTTPError(404, '场景不存在: {}'.format(place_id))
+    item_count = connection.execute(
+        select([func.count()]).select_from(items).where(items.c.place_id == place_id)).scalar()
+    return {'id': place.id, 'name': place.name, 'image': place.image, 'parent_id': place.parent_id,
+            'path': [{'id': ancestor_id, 'name': name}
+                     for ancestor_id, name in place_paths_of(connection, [place_id])[place_id]],
+            'item_count': item_count,
+            'subtree_item_count': subtree_item_counts(connection, [place_id])[place_id]}
+
+
+# area为None时返回场景中所有物品，(x0, y0, x1, y1)为矩形，(x, y, radius)为圆
+def place_items(connection, place_id, area=None):
+    place = connection.execute(select([places.c.id, places.c.name]).where(places.c.id == place_id)).first()
+    if place is None:
+        raise HTTPError(404, '场景不存在: {}'.format(place_id))
+    if area is None:
+        rows = connection.execute(select([items]).where(items.c.place_id == place_id).order_by(items.c.id))
+    elif len(area) == 4:
+        rows = items_in_rect(connection, place_id, *area)
+    else:
+        rows = items_near(connection, place_id, *area)
+    return {'place': {'id': place.id, 'name': place.name}, 'items': [item_json(row) for row in rows]}
+
+
+# 一条UPDATE语句完成检查和修改，不会在事务中途从读锁升级为写锁
+def move_item(connection, item_id, place_id, x, y):
+    with connection.begin():
+        result = connection.execute(
+            items.update()
+            .where(and_(items.c.id == item_id,
+                        exists(select([places.c.id]).where(places.c.id == place_id))))
+            .values(place_id=place_id, x=x, y=y))
+    if result.rowcount == 0:
+        if connection.execute(select([items.c.id]).where(items.c.id == item_id)).first() is None:
+            raise HTTPError(404, '物品不存在: {}'.format(item_id))
+        raise HTTPError(404, '场景不存在: {}'.format(place_id))
+    return {'item': item_json(connection.execute(select([items]).where(items.c.id == item_id)).first())}
+
+
+class Server:
+    def __init__(self, engine=None, readers=8):
+        # 连接只在创建它的线程中使用，但关闭服务时在主线程中关闭
+        engine = engine or open_engine(connect_args={'check_same_thread': False})
+        self.pool = ConnectionPool(engine)
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='server-read')
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='server-write')
+        self.requests = 0
+
+    async def run_in(self, executor, function, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, lambda: function(self.pool.connection(), *args))
+
+    async def dispatch(self, method, target, body):
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part]
+        if parts == ['search']:
+            self.require(method, 'GET')
+            text = query.get('q', [''])[0].strip()
+            if not text:
+                raise HTTPError(400, '缺少参数q')
+            limit = int_param(query, 'limit', 50, 1, MAX_LIMIT)
+            within = int_param(query, 'within', None)
+            return await self.run_in(self.readers, search, text, limit, within)
+        if parts == ['places']:
+            self.require(method, 'GET')
+            offset = int_param(query, 'offset', 0)
+            limit = int_param(query, 'limit', 50, 1, MAX_LIMIT)
+            return await self.run_in(self.readers, list_places, offset, limit)
+        if len(parts) == 2 and parts[0] == 'places':
+            self.require(method, 'GET')
+            return await self.run_in(self.readers, place_detail, self.path_id(parts[1]))
+        if len(parts) == 3 and parts[0] == 'places' and parts[2] == 'items':
+            self.require(method, 'GET')
+            return await self.run_in(self.readers, place_items, self.path_id(parts[1]), self.area(query))
+        if len(parts) == 3 and parts[0] == 'items' and parts[2] == 'move':
+            self.require(method, 'POST')
+            try:
+                data = json.loads(body.decode('utf-8') or '{}')
+                place_id, x, y = int(data['place_id']), int(data['x']), int(data['y'])
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise HTTPError(400, '内容必须是 {"place_id": 整数, "x": 整数, "y": 整数}')
+            if not (0 <= x <= COORD_SCALE and 0 <= y <= COORD_SCALE):
+                raise HTTPError(400, 'x和y必须在0~{}之间'.format(COORD_SCALE))
+            return await self.run_in(self.writer, move_item, self.path_id(parts[1]), place_id, x, y)
+        raise HTTPError(404, '没有这个地址: {}'.format(url.path))
+
+    @staticmethod
+    def require(method, expected):
+        if method != expected:
+            raise HTTPError(405, '只支持{}'.format(expected))
+
+    # 空间查询的参数：矩形x0/y0/x1/y1或者圆x/y/radius，都没有时返回None
+    @staticmethod
+    def area(query):
+        if 'x0' in query or 'x1' in query:
+            return tuple(Server.required_int(query, name) for name in ('x0', 'y0', 'x1', 'y1'))
+        if 'radius' in query:
+            return (Server.required_int(query, 'x'), Server.required_int(query, 'y'),
+                    int_param(query, 'radius', 0))
+        return None
+
+    @staticmethod
+    def required_int(query, name):
+        if name not in query:
+            raise HTTPError(400, '缺少参数{}'.format(name))
+        return int_param(query, name, 0, minimum=None)
+
+    @staticmethod
+    def path_id(value):
+        try:
+            return int(value)
+        except ValueError:
+            raise HTTPError(404, '无效的id: {}'.format(value))
+
+    # 一个客户端连接，支持keep-alive
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length') or 0)
+                except ValueError:
+                    length = -1
+                keep_alive = (headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1')
+                # 长度无效时无法确定请求的边界，回答后关闭连接
+                if length < 0:
+                    status, payload = 400, {'error': '无效的Content-Length'}
+                    keep_alive = False
+                elif length > 1024 * 1024:
+                    status, payload = 413, {'error': '请求太大'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    try:
+                        status, payload = 200, await self.dispatch(method, target, body)
+                    except HTTPError as e:
+                        status, payload = e.status, {'error': e.message}
+                    except Exception as e:
+                        status, payload = 500, {'error': str(e)}
+                self.requests += 1
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json; charset=utf-8\r\n'
+                             'Content-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                                 status, REASONS.get(status, ''), len(data),
+                                 'keep-alive' if keep_alive else 'close').encode('latin-1'))
+                writer.write(data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port, ready=None):
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        address = server.sockets[0].getsockname()
+        sys.stderr.write('监听 http://{}:{}/\n'.format(address[0], address[1]))
+        sys.stderr.flush()
+        if ready is not None:
+            ready(address)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.readers.shutdown()
+        self.writer.shutdown()
+        self.pool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='本地查询服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--readers', type=int, default=8, help='读取线程数')
+    args = parser.parse_args(argv)
+    server = Server(readers=args.readers)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
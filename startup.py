@@ -0,0 +1,34 @@
+import sys
+import time
+
+# 冷启动各阶段的耗时（从导入本模块开始计时，main.py最先导入它）
+# 用 python main.py --startup-report 查看，数据库变大后首次绘制仍应在BUDGET_MS之内
+
+# 启动到窗口第一次绘制的预算（毫秒）
+BUDGET_MS = 500
+
+_start = time.perf_counter()
+# 阶段名 -> 距离开始的毫秒数，同一阶段只记录第一次
+phases = {}
+
+
+def mark(name):
+    phases.setdefault(name, (time.perf_counter() - _start) * 1000)
+
+
+def elapsed_ms(name):
+    return phases.get(name)
+
+
+# 输出各阶段的时间，第一次绘制超过预算时给出提示，返回是否在预算之内
+def report(out=sys.stderr, budget=BUDGET_MS):
+    previous = 0.0
+    out.write('{:<20}{:>12}{:>12}\n'.format('阶段', '时间(ms)', '间隔(ms)'))
+    for name, at in phases.items():
+        out.write('{:<20}{:>12.1f}{:>+12.1f}\n'.format(name, at, at - previous))
+        previous = at
+    first_paint = phases.get('first_paint')
+    if first_paint is not None and first_paint > budget:
+        out.write('首次绘制用了{:.0f}ms，超过预算{}ms\n'.format(first_paint, budget))
+        return False
+    return True
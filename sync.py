@@ -0,0 +1,472 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import time
+
+from migrations import configure_connection
+from models import DB_PATH, open_engine
+
+# 在多个数据库（副本，如两台电脑上的程序）之间增量同步场景和物品（不依赖Qt）：
+#   1.每次修改由触发器记录在变化日志changes中（见migrations.py），带有递增的序号seq和版本(stamp, origin)，
+#     场景、物品、父场景都用uid表示，不依赖每个数据库中各自分配的id
+#   2.导出只写出上次导出之后的变化（第一次导出整个数据库），写到共享目录中这个副本自己的子目录里：
+#       DIR/<副本id>/snapshot-<seq>.jsonl        第一次导出
+#       DIR/<副本id>/<开始seq>-<结束seq>.jsonl    之后每次导出的变化
+#       DIR/files/<图片路径>                     场景图片
+#     每个文件第一行是说明（副本、seq范围），之后每行一个变化；先写到.part文件再改名，读到的文件总是完整的
+#   3.导入读取其它副本上次导入之后的文件，每个文件在一个事务中应用；同步的开销和变化的个数成正比，和数据库大小无关
+#   4.冲突：同一个场景/物品在两边都被修改时，版本(stamp, origin)大的一边生效（stamp是毫秒时钟，
+#     相同时比较副本id），应用的顺序不影响结果；导入的变化也记录到日志中，继续转发给其它副本
+#       删除和修改冲突时同样按版本决定；物品所在的场景已经被删除时放到它的父场景中（顶层场景被删除时物品也删除）
+#       两边同时移动场景形成环时，环上版本最旧的一次移动不生效（那个场景移到顶层）
+#   5.导出之后，已经导出的旧变化（同一个场景/物品有更新的变化）从日志中删除，日志不会一直增长
+# 共享目录可以是网盘、U盘或任何两边都能访问的文件夹，不需要服务器
+#
+# 用法：
+#   python sync.py sync DIR        先导入再导出
+#   python sync.py export DIR      导出本地的变化（程序运行时也可以）
+#   python sync.py import DIR      导入其它副本的变化（需要先关闭程序）
+#   python sync.py status
+#   python sync.py new-replica     复制了数据库文件之后，在复制出的数据库上运行一次
+# 新的电脑：python sync.py import DIR（数据库不存在时会新建），之后和其它副本一样同步
+
+FILES_DIR = 'files'
+PART_SUFFIX = '.part'
+BUNDLE_PATTERN = re.compile(r'^(?:snapshot|(\d{12}))-(\d{12})\.jsonl$')
+# 变化日志中的entity对应的表
+TABLES = {'place': 'places', 'item': 'items'}
+# 沿着已删除场景的父场景查找时的最大层数
+MAX_DEPTH = 64
+
+
+class SyncError(Exception):
+    pass
+
+
+def bundle_name(start, end):
+    if start is None:
+        return 'snapshot-{:012d}.jsonl'.format(end)
+    return '{:012d}-{:012d}.jsonl'.format(start, end)
+
+
+# 目录中一个副本的导出文件[(开始seq, 结束seq, 路径)]，开始seq为None的是整个数据库，排在最前面
+def list_bundles(folder):
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return []
+    bundles = []
+    for name in names:
+        match = BUNDLE_PATTERN.match(name)
+        if match:
+            start = None if match.group(1) is None else int(match.group(1))
+            bundles.append((start, int(match.group(2)), os.path.join(folder, name)))
+    return sorted(bundles, key=lambda bundle: (bundle[0] is not None, bundle[0] or 0, bundle[1]))
+
+
+def read_header(path):
+    with open(path, encoding='utf-8') as f:
+        return json.loads(f.readline())
+
+
+# 图片路径只能是相对路径，不能指向目录之外（导入的文件来自共享目录，不一定可信）
+def safe_path(path):
+    if not path or os.path.isabs(path):
+        return None
+    path = os.path.normpath(path)
+    if path.split(os.sep)[0] == '..':
+        return None
+    return path
+
+
+def copy_file(source, target):
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    shutil.copyfile(source, target + PART_SUFFIX)
+    os.replace(target + PART_SUFFIX, target)
+
+
+class Replica:
+    def __init__(self, db_path=DB_PATH):
+        # 由engine执行结构迁移（数据库不存在时新建），之后直接用sqlite3
+        open_engine(db_path).dispose()
+        self.connection = sqlite3.connect(db_path, isolation_level=None)
+        configure_connection(self.connection)
+
+    def close(self):
+        self.connection.close()
+
+    def execute(self, sql, params=()):
+        return self.connection.execute(sql, params)
+
+    def state(self):
+        return self.execute('SELECT replica, clock, exported, logging FROM sync_state').fetchone()
+
+    # uid当前的版本(stamp, origin)：最新的一个变化；没有记录过变化时，本地有这一行为(0, 本副本)
+    # （和导出整个数据库时使用的版本相同，自己导出的数据转一圈回来时不会再应用一次），没有为(0, '')
+    def version(self, uid, table):
+        row = self.execute('SELECT stamp, origin FROM changes WHERE uid = ? ORDER BY seq DESC LIMIT 1',
+                           (uid,)).fetchone()
+        if row:
+            return tuple(row)
+        if self.row_id(table, uid) is not None:
+            return 0, self.state()[0]
+        return 0, ''
+
+    def row_id(self, table, uid):
+        row = self.execute('SELECT id FROM {} WHERE uid = ?'.format(table), (uid,)).fetchone()
+        return row[0] if row else None
+
+    # ---------- 导出 ----------
+
+    # 导出上次导出之后的变化，返回(文件路径, 变化个数)，没有新的变化时路径为None
+    def export_changes(self, directory):
+        replica, _, exported, logging = self.state()
+        folder = os.path.join(directory, replica)
+        os.makedirs(folder, exist_ok=True)
+        exported = self.check_exported(folder, exported)
+        if not logging:
+            self.execute('UPDATE sync_state SET logging = 1')
+
+        # 在一个读事务中读出变化，读的同时程序可以继续写入（之后的变化seq更大，下次导出）
+        self.execute('BEGIN')
+        try:
+            end = self.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+            end = end[0] if end else 0
+            if exported is None:
+                entries = self.snapshot(replica)
+            else:
+                if end <= exported:
+                    return None, 0
+                entries = self.changes_between(exported, end)
+            check = self.execute('SELECT stamp FROM changes WHERE seq = ?', (end,)).fetchone()
+            path = os.path.join(folder, bundle_name(exported, end))
+            count = self.write_bundle(path, directory, entries, {
+                'replica': replica, 'start': exported, 'end': end, 'check': check[0] if check else None})
+        finally:
+            self.execute('COMMIT')
+        self.finish_export(exported, end)
+        return path, count
+
+    # 目录中已经有比本地记录更新的导出文件时：如果是本地上次导出到一半（文件已经写出，数据库还没有更新）
+    # 就接着完成，否则是另一个数据库使用了相同的副本id
+    def check_exported(self, folder, exported):
+        bundles = [bundle for bundle in list_bundles(folder)
+                   if exported is None or (bundle[0] is not None and bundle[1] > exported)]
+        if not bundles:
+            return exported
+        start, end, path = bundles[-1]
+        check = self.execute('SELECT stamp FROM changes WHERE seq = ?', (end,)).fetchone()
+        if len(bundles) == 1 and start == exported and read_header(path).get('check') == (check and check[0]):
+            self.finish_export(exported, end)
+            return end
+        raise SyncError('{}中已经有这个副本没有导出过的文件，数据库可能是复制来的或者从备份中恢复的，'
+                        '请先运行 python sync.py new-replica'.format(folder))
+
+    # 记录导出到的seq，删除已经导出的旧变化（每个场景/物品保留最新的一个，用来比较版本），
+    # 保留的修改不再需要内容（删除的记录保留父场景，用来找到还存在的场景）
+    def finish_export(self, exported, end):
+        params = {'start': exported or 0, 'end': end}
+        self.execute('BEGIN IMMEDIATE')
+        try:
+            self.execute('UPDATE sync_state SET exported = ?', (end,))
+            self.execute("""DELETE FROM changes
+                WHERE seq <= :end AND uid IN (SELECT uid FROM changes WHERE seq > :start AND seq <= :end)
+                  AND seq < (SELECT MAX(seq) FROM changes AS latest WHERE latest.uid = changes.uid)""", params)
+            self.execute("""UPDATE changes SET data = NULL
+                WHERE seq > :start AND seq <= :end AND op = 'upsert' AND data IS NOT NULL""", params)
+        except BaseException:
+            self.execute('ROLLBACK')
+            raise
+        self.execute('COMMIT')
+
+    def changes_between(self, start, end):
+        for seq, entity, uid, op, stamp, origin, data in self.execute(
+                """SELECT seq, entity, uid, op, stamp, origin, data FROM changes
+                   WHERE seq > ? AND seq <= ? ORDER BY seq""", (start, end)):
+            yield {'seq': seq, 'entity': entity, 'uid': uid, 'op': op, 'stamp': stamp, 'origin': origin,
+                   'data': json.loads(data) if data is not None else None}
+
+    # 整个数据库：场景按层级从上到下，然后是物品，最后是删除的记录（对方可能还有这些场景/物品）
+    # 没有记录过变化的场景/物品版本为(0, 本副本)
+    def snapshot(self, replica):
+        latest = 'LEFT JOIN changes ON changes.seq = (SELECT MAX(seq) FROM changes AS latest WHERE latest.uid = {}.uid)'
+        for uid, name, image, parent, stamp, origin in self.execute(
+                """SELECT places.uid, places.name, places.image, parent.uid, changes.stamp, changes.origin
+                   FROM places LEFT JOIN places AS parent ON parent.id = places.parent_id {}
+                   ORDER BY (SELECT MAX(depth) FROM place_paths WHERE descendant_id = places.id), places.id
+                """.format(latest.format('places'))):
+            yield {'seq': None, 'entity': 'place', 'uid': uid, 'op': 'upsert',
+                   'stamp': stamp or 0, 'origin': origin or replica,
+                   'data': {'name': name, 'image': image, 'parent': parent}}
+        for uid, name, description, place, x, y, stamp, origin in self.execute(
+                """SELECT items.uid, items.name, items.description, places.uid, items.x, items.y,
+                          changes.stamp, changes.origin
+                   FROM items LEFT JOIN places ON places.id = items.place_id {}
+                   ORDER BY items.id""".format(latest.format('items'))):
+            yield {'seq': None, 'entity': 'item', 'uid': uid, 'op': 'upsert',
+                   'stamp': stamp or 0, 'origin': origin or replica,
+                   'data': {'name': name, 'description': description, 'place': place, 'x': x, 'y': y}}
+        for entity, uid, stamp, origin, data in self.execute(
+                """SELECT entity, uid, stamp, origin, data FROM changes
+                   WHERE op = 'delete' AND seq = (SELECT MAX(seq) FROM changes AS latest WHERE latest.uid = changes.uid)
+                   ORDER BY seq"""):
+            yield {'seq': None, 'entity': entity, 'uid': uid, 'op': 'delete', 'stamp': stamp, 'origin': origin,
+                   'data': json.loads(data) if data is not None else None}
+
+    # 写出导出文件，同时把用到的场景图片复制到共享目录中，返回变化的个数
+    def write_bundle(self, path, directory, entries, header):
+        count = 0
+        with open(path + PART_SUFFIX, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(header) + '\n')
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                count += 1
+                if entry['entity'] == 'place' and entry['op'] == 'upsert':
+                    self.export_file(directory, entry['data']['image'])
+        os.replace(path + PART_SUFFIX, path)
+        return count
+
+    def export_file(self, directory, image):
+        image = safe_path(image)
+        if image is None or not os.path.isfile(image):
+            return
+        target = os.path.join(directory, FILES_DIR, image)
+        if not os.path.exists(target) or os.path.getsize(target) != os.path.getsize(image):
+            copy_file(image, target)
+
+    # ---------- 导入 ----------
+
+    # 导入目录中其它副本的变化，返回(应用的变化个数, 跳过的变化个数)
+    def import_changes(self, directory, out=sys.stderr):
+        replica = self.state()[0]
+        peers = dict(self.execute('SELECT replica, last FROM sync_peers').fetchall())
+        applied = skipped = 0
+        for name in sorted(os.listdir(directory)):
+            folder = os.path.join(directory, name)
+            if name in (replica, FILES_DIR) or not os.path.isdir(folder):
+                continue
+            last = peers.get(name)
+            for start, end, path in list_bundles(folder):
+                if last is not None and (start is None or end <= last):
+                    continue
+                if (start is None) != (last is None) or (start is not None and start > last):
+                    # 缺少之前的文件（可能还没有复制到共享目录中），等下次再导入之后的文件
+                    out.write('副本{}缺少{}之前的变化，暂不导入\n'.format(name, os.path.basename(path)))
+                    break
+                counts = self.apply_bundle(path, directory, name, last)
+                applied += counts[0]
+                skipped += counts[1]
+                last = end
+        return applied, skipped
+
+    # 在一个事务中应用一个文件中seq大于last的变化，并记录从这个副本导入到的seq
+    def apply_bundle(self, path, directory, peer, last):
+        applied = skipped = 0
+        files = []
+        self.execute('BEGIN IMMEDIATE')
+        try:
+            self.execute('UPDATE sync_state SET logging = 0')
+            with open(path, encoding='utf-8') as f:
+                header = json.loads(f.readline())
+                for line in f:
+                    entry = json.loads(line)
+                    if entry['seq'] is not None and last is not None and entry['seq'] <= last:
+                        continue
+                    if self.apply(entry):
+                        applied += 1
+                        if entry['entity'] == 'place' and entry['op'] == 'upsert':
+                            files.append(entry['data']['image'])
+                    else:
+                        skipped += 1
+            self.execute('UPDATE sync_state SET logging = 1')
+            self.execute('INSERT OR REPLACE INTO sync_peers VALUES (?, ?)', (peer, header['end']))
+        except BaseException:
+            self.execute('ROLLBACK')
+            raise
+        self.execute('COMMIT')
+        for image in files:
+            self.import_file(directory, image)
+        return applied, skipped
+
+    def import_file(self, directory, image):
+        image = safe_path(image)
+        if image is None or os.path.exists(image):
+            return
+        source = os.path.join(directory, FILES_DIR, image)
+        if os.path.isfile(source):
+            copy_file(source, image)
+
+    # 应用一个变化，本地的版本更新时跳过（返回False）
+    # 应用的变化按原来的版本记录到日志中，这样之后的比较和转发给其它副本都使用原来的版本
+    def apply(self, entry):
+        uid, stamp, origin = entry['uid'], entry['stamp'], entry['origin']
+        if entry['entity'] not in TABLES:
+            raise SyncError('不认识的变化: {}'.format(entry['entity']))
+        if (stamp, origin) <= self.version(uid, TABLES[entry['entity']]):
+            return False
+        data = entry['data'] or {}
+        if entry['entity'] == 'place':
+            if entry['op'] == 'delete':
+                self.delete_place(uid)
+            else:
+                self.upsert_place(uid, data, (stamp, origin))
+        elif entry['op'] == 'delete':
+            self.execute('DELETE FROM items WHERE uid = ?', (uid,))
+        else:
+            self.upsert_item(uid, data)
+        self.execute('INSERT INTO changes (entity, uid, op, stamp, origin, data) VALUES (?, ?, ?, ?, ?, ?)',
+                     (entry['entity'], uid, entry['op'], stamp, origin,
+                      json.dumps(entry['data'], ensure_ascii=False) if entry['data'] is not None else None))
+        # 之后本地的修改的版本比导入的都大
+        self.execute('UPDATE sync_state SET clock = MAX(clock, ?)', (stamp,))
+        return True
+
+    # 场景uid在本地的id；场景已经被删除时沿着删除时的父场景向上找到还存在的场景
+    def resolve_place(self, uid):
+        for _ in range(MAX_DEPTH):
+            if uid is None:
+                return None
+            place_id = self.row_id('places', uid)
+            if place_id is not None:
+                return place_id
+            row = self.execute('SELECT op, data FROM changes WHERE uid = ? ORDER BY seq DESC LIMIT 1',
+                               (uid,)).fetchone()
+            if row is None or row[0] != 'delete' or row[1] is None:
+                return None
+            uid = json.loads(row[1]).get('parent')
+        return None
+
+    def upsert_place(self, uid, data, version):
+        place_id = self.row_id('places', uid)
+        parent_id = self.resolve_place(data.get('parent'))
+        if place_id is not None and parent_id is not None:
+            parent_id = self.break_cycle(place_id, parent_id, version)
+        if place_id is None:
+            self.execute('INSERT INTO places (uid, name, image, parent_id) VALUES (?, ?, ?, ?)',
+                         (uid, data.get('name'), data.get('image'), parent_id))
+        else:
+            self.execute('UPDATE places SET name = ?, image = ?, parent_id = ? WHERE id = ?',
+                         (data.get('name'), data.get('image'), parent_id, place_id))
+
+    # 把场景移到parent_id下面会形成环时（两边同时把两个场景移到对方下面），
+    # 环上版本最旧的一次移动不生效：是这次移动时返回None（场景移到顶层），否则把那个场景移到顶层
+    def break_cycle(self, place_id, parent_id, version):
+        if parent_id == place_id:
+            return None
+        # 从新的父场景向上到这个场景（不包括）的路径，这个场景不是新父场景的祖先时为空
+        path = self.execute("""SELECT places.id, places.uid FROM place_paths
+            JOIN places ON places.id = place_paths.ancestor_id
+            WHERE place_paths.descendant_id = :parent
+              AND place_paths.depth < (SELECT depth FROM place_paths
+                                       WHERE ancestor_id = :place AND descendant_id = :parent)""",
+                            {'place': place_id, 'parent': parent_id}).fetchall()
+        if not path:
+            return parent_id
+        oldest_version, oldest_id = min((self.version(uid, 'places'), node_id) for node_id, uid in path)
+        if version < oldest_version:
+            return None
+        self.execute('UPDATE places SET parent_id = NULL WHERE id = ?', (oldest_id,))
+        return parent_id
+
+    # 删除场景：其中的物品移到父场景中（顶层场景的物品一起删除），子场景由触发器移到父场景下面
+    def delete_place(self, uid):
+        row = self.execute('SELECT id, parent_id FROM places WHERE uid = ?', (uid,)).fetchone()
+        if row is None:
+            return
+        place_id, parent_id = row
+        if parent_id is None:
+            self.execute('DELETE FROM items WHERE place_id = ?', (place_id,))
+        else:
+            self.execute('UPDATE items SET place_id = ? WHERE place_id = ?', (parent_id, place_id))
+        self.execute('DELETE FROM places WHERE id = ?', (place_id,))
+
+    # 物品所在的场景已经被删除（找不到还存在的父场景）时，物品也删除
+    def upsert_item(self, uid, data):
+        item_id = self.row_id('items', uid)
+        place_id = self.resolve_place(data.get('place'))
+        if place_id is None:
+            if item_id is not None:
+                self.execute('DELETE FROM items WHERE id = ?', (item_id,))
+            return
+        values = (data.get('name'), data.get('description'), place_id, data.get('x'), data.get('y'))
+        if item_id is None:
+            self.execute('INSERT INTO items (uid, name, description, place_id, x, y) VALUES (?, ?, ?, ?, ?, ?)',
+                         (uid,) + values)
+        else:
+            self.execute('UPDATE items SET name = ?, description = ?, place_id = ?, x = ?, y = ? WHERE id = ?',
+                         values + (item_id,))
+
+    # ---------- 副本 ----------
+
+    # 换一个新的副本id（复制数据库文件之后，两个数据库不能使用同一个id）
+    # 原来的id导出过的变化已经包含在数据库中，记为已经导入；下次导出整个数据库
+    def new_replica(self):
+        self.execute('BEGIN IMMEDIATE')
+        try:
+            old, _, exported, _ = self.state()
+            if exported is not None:
+                self.execute('INSERT OR REPLACE INTO sync_peers VALUES (?, ?)', (old, exported))
+            self.execute('UPDATE sync_state SET replica = lower(hex(randomblob(8))), exported = NULL')
+        except BaseException:
+            self.execute('ROLLBACK')
+            raise
+        self.execute('COMMIT')
+        return self.state()[0]
+
+    def status(self):
+        replica, clock, exported, logging = self.state()
+        pending = None
+        if exported is not None:
+            pending = self.execute('SELECT count(*) FROM changes WHERE seq > ?', (exported,)).fetchone()[0]
+        peers = self.execute('SELECT replica, last FROM sync_peers ORDER BY replica').fetchall()
+        return {'replica': replica, 'exported': exported, 'pending': pending, 'logging': bool(logging),
+                'peers': peers}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='通过共享目录在多个数据库之间增量同步')
+    parser.add_argument('command', choices=['sync', 'export', 'import', 'status', 'new-replica'])
+    parser.add_argument('directory', nargs='?', help='共享目录')
+    parser.add_argument('--db', default=DB_PATH)
+    args = parser.parse_args(argv)
+    if args.command in ('sync', 'export', 'import'):
+        if not args.directory:
+            parser.error('{}需要指定共享目录'.format(args.command))
+        os.makedirs(args.directory, exist_ok=True)
+
+    replica = Replica(args.db)
+    try:
+        start = time.perf_counter()
+        if args.command in ('sync', 'import'):
+            applied, skipped = replica.import_changes(args.directory)
+            print('导入: 应用 {} 个变化, 跳过 {} 个（本地的版本更新）'.format(applied, skipped))
+        if args.command in ('sync', 'export'):
+            path, count = replica.export_changes(args.directory)
+            print('导出: {} 个变化 {}'.format(count, path) if path else '导出: 没有新的变化')
+        if args.command == 'new-replica':
+            print('新的副本id: {}'.format(replica.new_replica()))
+        elif args.command == 'status':
+            status = replica.status()
+            print('副本: {}'.format(status['replica']))
+            if status['exported'] is None:
+                print('还没有导出过（第一次导出整个数据库）')
+            else:
+                print('已导出到: {}, 未导出的变化: {}'.format(status['exported'], status['pending']))
+            for peer, last in status['peers']:
+                print('已从 {} 导入到: {}'.format(peer, last))
+        else:
+            print('{:.2f}秒'.format(time.perf_counter() - start))
+    except (SyncError, OSError, ValueError) as e:
+        sys.stderr.write('{}\n'.format(e))
+        return 1
+    finally:
+        replica.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
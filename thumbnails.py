@@ -0,0 +1,190 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QPixmap, QImage, QImageReader
+
+from media import rendition_for
+
+# 磁盘缓存目录（相对于运行目录，和db.sqlite3放在一起）
+CACHE_DIR = '.thumbnails'
+
+
+# 缩略图缓存：1.内存中用LRU保存最近使用的QPixmap
+#            2.磁盘上保存缩放后的图片，以 原图路径+修改时间+文件大小+目标尺寸 作为键，
+#              原图被修改后键随之改变，旧的缩略图最终会被淘汰
+#            3.记录命中/未命中次数，便于观察缓存效果
+class ThumbnailCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_memory_bytes=64 * 1024 * 1024,
+                 max_disk_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._pixmaps = OrderedDict()
+        self._memory_bytes = 0
+        # 磁盘占用在第一次写入时统计，之后增量维护
+        self._disk_bytes = None
+        self._disk_lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    # 计算缓存键，原图不存在时返回None
+    def key(self, path, width, height):
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError):
+            return None
+        raw = '{}|{}|{}|{}x{}'.format(os.path.abspath(path), stat.st_mtime_ns,
+                                      stat.st_size, width, height)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    # 获取缩放到width x height的图片（同步，在调用线程中解码）
+    def get(self, path, width, height):
+        key = self.key(path, width, height)
+        pixmap = self.lookup(key)
+        if pixmap is not None:
+            return pixmap
+        image = self.load_image(path, width, height, key)
+        if image.isNull():
+            return QPixmap()
+        pixmap = QPixmap.fromImage(image)
+        self.remember(key, pixmap)
+        return pixmap
+
+    # 只查内存缓存，未命中返回None
+    def lookup(self, key):
+        if key is None:
+            return None
+        pixmap = self._pixmaps.get(key)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(key)
+            self.hits += 1
+        return pixmap
+
+    # 从磁盘缓存或原图得到缩放后的QImage
+    # 只使用QImage，可以在工作线程中调用
+    def load_image(self, path, width, height, key=None):
+        if key is None:
+            key = self.key(path, width, height)
+        if key is None:
+            self.misses += 1
+            return QImage()
+        # 存储中的图片已经有这个尺寸，直接读取，不需要再写磁盘缓存
+        rendition = rendition_for(path, width, height)
+        if rendition is not None:
+            image = QImage(rendition)
+            if not image.isNull():
+                self.disk_hits += 1
+                return image
+        reader = QImageReader(path)
+        # 图片本身就是这个尺寸（如瓦片），直接读取，不需要再写磁盘缓存
+        if reader.size() == QSize(width, height):
+            image = reader.read()
+            if not image.isNull():
+                self.disk_hits += 1
+                return image
+            reader = QImageReader(path)
+        image = self.load_disk(key)
+        if not image.isNull():
+            self.disk_hits += 1
+            return image
+        self.misses += 1
+        # 让解码器直接输出目标尺寸，JPEG等格式可以跳过大部分解码工作
+        reader.setScaledSize(QSize(width, height))
+        image = reader.read()
+        if image.isNull():
+            return image
+        self.save_disk(key, image)
+        return image
+
+    # 放入内存LRU，超出限制时淘汰最久未使用的
+    def remember(self, key, pixmap):
+        self._pixmaps[key] = pixmap
+        self._memory_bytes += self.pixmap_bytes(pixmap)
+        while self._memory_bytes > self.max_memory_bytes and len(self._pixmaps) > 1:
+            _, old = self._pixmaps.popitem(last=False)
+            self._memory_bytes -= self.pixmap_bytes(old)
+
+    @staticmethod
+    def pixmap_bytes(pixmap):
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+    def disk_path(self, key):
+        return os.path.join(self.cache_dir, key + '.png')
+
+    def load_disk(self, key):
+        path = self.disk_path(key)
+        if not os.path.exists(path):
+            return QImage()
+        # 更新访问时间，磁盘淘汰按最近使用排序
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return QImage(path)
+
+    def save_disk(self, key, image):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.disk_path(key)
+        if not image.save(path, 'PNG'):
+            return
+        with self._disk_lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self.disk_usage()
+            else:
+                self._disk_bytes += os.path.getsize(path)
+            if self._disk_bytes > self.max_disk_bytes:
+                self.prune_disk()
+
+    def disk_entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def disk_usage(self):
+        return sum(size for _, size, _ in self.disk_entries())
+
+    # 删除最久未使用的缩略图，直到占用降到上限的90%
+    def prune_disk(self):
+        entries = sorted(self.disk_entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_disk_bytes * 9 // 10
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._disk_bytes = total
+
+    # 清空内存缓存（磁盘缓存保留）
+    def clear(self):
+        self._pixmaps.clear()
+        self._memory_bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'memory_items': len(self._pixmaps),
+            'memory_bytes': self._memory_bytes,
+        }
+
+
+# 全局共享的缩略图缓存，PlaceWidget/MovePlaceWidget/ImageLabel共用
+thumbnail_cache = ThumbnailCache()
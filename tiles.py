@@ -0,0 +1,106 @@
+import json
+import math
+import os
+
+# 场景图片的瓦片金字塔（不依赖Qt）：
+# 第0层是原图，之后每一层的宽高都是上一层的一半，直到整张图片可以放进一个瓦片；
+# 每一层切成TILE_SIZE x TILE_SIZE的瓦片（最右/最下的瓦片可能更小），
+# 显示时按当前的缩放比例选择一层，只读取可见的瓦片
+#
+# 瓦片保存在存储中图片旁边的目录里：
+#   media/ab/abcdef...._tiles/pyramid.json     原图尺寸、瓦片尺寸、层数
+#   media/ab/abcdef...._tiles/<层>/<列>_<行>.jpg
+# pyramid.json在所有瓦片写完之后才写入，没有它的目录视为没有生成完
+
+TILE_SIZE = 256
+INFO_FILE = 'pyramid.json'
+
+
+def tiles_dir(stored):
+    return os.path.splitext(stored)[0] + '_tiles'
+
+
+# width x height的图片需要的层数
+def level_count(width, height, tile_size=TILE_SIZE):
+    levels = 1
+    while max(width, height) > tile_size:
+        width = (width + 1) // 2
+        height = (height + 1) // 2
+        levels += 1
+    return levels
+
+
+class TilePyramid:
+    def __init__(self, directory, width, height, tile_size=TILE_SIZE, levels=None):
+        self.directory = directory
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.levels = levels or level_count(width, height, tile_size)
+
+    # 第level层的尺寸
+    def level_size(self, level):
+        scale = 2 ** level
+        return -(-self.width // scale), -(-self.height // scale)
+
+    def grid_size(self, level):
+        width, height = self.level_size(level)
+        return -(-width // self.tile_size), -(-height // self.tile_size)
+
+    # 瓦片在第level层中的位置和大小 (x, y, width, height)
+    def tile_rect(self, level, column, row):
+        width, height = self.level_size(level)
+        x = column * self.tile_size
+        y = row * self.tile_size
+        return x, y, min(self.tile_size, width - x), min(self.tile_size, height - y)
+
+    def tile_path(self, level, column, row):
+        return os.path.join(self.directory, str(level), '{}_{}.jpg'.format(column, row))
+
+    # 第level层的所有瓦片
+    def tiles(self, level):
+        columns, rows = self.grid_size(level)
+        for row in range(rows):
+            for column in range(columns):
+                yield column, row
+
+    # 显示比例为scale（屏幕像素/原图像素）时使用的层：分辨率不低于显示需要的最小的一层
+    def level_for(self, scale):
+        if scale <= 0:
+            return self.levels - 1
+        level = int(math.floor(math.log2(1 / scale))) if scale < 1 else 0
+        return max(0, min(level, self.levels - 1))
+
+    # 第level层中与原图矩形(x, y, width, height)相交的瓦片
+    def tiles_in(self, level, x, y, width, height):
+        scale = 2 ** level
+        size = self.tile_size * scale
+        columns, rows = self.grid_size(level)
+        left = max(0, int(x // size))
+        top = max(0, int(y // size))
+        right = min(columns - 1, int((x + width) // size))
+        bottom = min(rows - 1, int((y + height) // size))
+        for row in range(top, bottom + 1):
+            for column in range(left, right + 1):
+                yield column, row
+
+    def info_path(self):
+        return os.path.join(self.directory, INFO_FILE)
+
+    def save(self, path=None):
+        with open(path or self.info_path(), 'w') as f:
+            json.dump({'width': self.width, 'height': self.height,
+                       'tile_size': self.tile_size, 'levels': self.levels}, f)
+
+
+# 存储中的图片已经生成的金字塔，没有（或没有生成完）返回None
+def load_pyramid(stored):
+    if not stored:
+        return None
+    directory = tiles_dir(stored)
+    try:
+        with open(os.path.join(directory, INFO_FILE)) as f:
+            info = json.load(f)
+        return TilePyramid(directory, info['width'], info['height'], info['tile_size'], info['levels'])
+    except (OSError, ValueError, KeyError):
+        return None
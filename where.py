@@ -0,0 +1,207 @@
+import os
+import sqlite3
+import sys
+
+# 命令行查找物品（不导入PyQt5和SQLAlchemy，启动+查询在BUDGET_MS之内）：
+# 只读打开数据库，用和界面相同的搜索（全文索引/LIKE）找出物品，再用一次查询读出所在场景的路径
+#   $ python where.py 手机
+#   手机 → 卧室 > 柜子1 (32768, 16384)
+#   $ python where.py 手机 --json --limit 5 --within 3
+# 坐标是物品在场景图片中的相对位置（0~65536，见models.COORD_SCALE）
+# 没有找到物品时返回1，数据库不存在时返回2
+# 搜索在这里定义（search_ids），models.search_items也使用它；只有1、2个字的查询在这里只匹配名字
+
+# 数据库文件，和models.DB_PATH相同（这里不能导入models）
+DB_PATH = os.environ.get('WHERE_DB', 'db.sqlite3')
+# 启动+查询的预算（毫秒），benchmark.py检查
+BUDGET_MS = 50
+LIMIT = 20
+ARROW = '→'
+SEPARATOR = ' > '
+
+
+# 转义LIKE中的通配符
+def like_pattern(text):
+    text = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + text + '%'
+
+
+# 搜索物品，按相关度返回物品id列表；execute(sql, params)执行一条查询并返回行，
+# 命令行用sqlite3执行，models.search_items用SQLAlchemy的连接执行
+# trigram只能索引3个字及以上的查询，更短的查询直接在items表上做LIKE匹配（比在外部内容的
+# 索引表上匹配快，索引表的每一行都要回到items表读取），名字匹配的排在前面：
+# 先只匹配名字，已经够limit个时不再扫描介绍（介绍比名字长得多，匹配它占扫描的大部分时间）
+# names_only_short为True时短查询只匹配名字（只扫描名字的索引）：没有结果或结果很少时不再扫描整个表，
+# 命令行查找用它保证在BUDGET_MS之内；界面和server.py不使用，否则结果和输入的过程有关
+# （SearchPipeline从短查询的结果中缩小3个字的查询，而直接输入时全文索引会匹配介绍）
+# within为场景id时只搜索这个场景及其子场景中的物品（同一条查询中按闭包表筛选）
+def search_ids(execute, text, fts, limit=None, within=None, names_only_short=False):
+    text = text.strip()
+    if not text:
+        return []
+    params = {'pattern': like_pattern(text), 'limit': -1 if limit is None else limit, 'within': within}
+    scope = ''
+    if within is not None:
+        scope = 'AND items.place_id IN (SELECT descendant_id FROM place_paths WHERE ancestor_id = :within)'
+    if fts and len(text) >= 3:
+        params['query'] = '"' + text.replace('"', '""') + '"'
+        if within is None:
+            sql = """SELECT rowid FROM items_fts WHERE items_fts MATCH :query
+                     ORDER BY bm25(items_fts, 10.0, 1.0) LIMIT :limit"""
+        else:
+            sql = """SELECT items_fts.rowid FROM items_fts JOIN items ON items.id = items_fts.rowid
+                     WHERE items_fts MATCH :query {}
+                     ORDER BY bm25(items_fts, 10.0, 1.0) LIMIT :limit""".format(scope)
+        return [row[0] for row in execute(sql, params)]
+    sql = """SELECT id FROM items WHERE name LIKE :pattern ESCAPE '\\' {}
+             ORDER BY length(name), id LIMIT :limit""".format(scope)
+    ids = [row[0] for row in execute(sql, params)]
+    if names_only_short and len(text) < 3:
+        return ids
+    if limit is not None:
+        if len(ids) >= limit:
+            return ids
+        params['limit'] = limit - len(ids)
+    sql = """SELECT id FROM items
+             WHERE description LIKE :pattern ESCAPE '\\' AND NOT name LIKE :pattern ESCAPE '\\' {}
+             ORDER BY length(name), id LIMIT :limit""".format(scope)
+    return ids + [row[0] for row in execute(sql, params)]
+
+
+class Lookup:
+    def __init__(self, path=DB_PATH):
+        if not os.path.exists(path):
+            raise FileNotFoundError('数据库不存在: ' + path)
+        # 只读打开，不会执行迁移，也不会和正在运行的界面争用写锁
+        self.connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+        self.connection.execute('PRAGMA busy_timeout=5000')
+        tables = {row[0] for row in self.connection.execute(
+            "SELECT name FROM sqlite_master WHERE name IN ('items_fts', 'place_paths')")}
+        self.fts = 'items_fts' in tables
+        # 还没有升级到有场景层级的旧数据库，路径只有场景自己
+        self.hierarchy = 'place_paths' in tables
+
+    def close(self):
+        self.connection.close()
+
+    # 搜索物品，返回字典的列表（按相关度），path是所在场景从顶层开始的[(id, 名字)]
+    def find(self, text, limit=LIMIT, within=None):
+        if within is not None and not self.hierarchy:
+            return []
+        ids = search_ids(self.connection.execute, text, self.fts, limit, within, names_only_short=True)
+        if not ids:
+            return []
+        marks = ','.join('?' * len(ids))
+        rows = {row[0]: row for row in self.connection.execute(
+            'SELECT id, name, description, place_id, x, y FROM items WHERE id IN ({})'.format(marks), ids)}
+        paths = self.paths({row[3] for row in rows.values()})
+        return [{'id': row[0], 'name': row[1], 'description': row[2], 'place_id': row[3],
+                 'path': paths.get(row[3], []), 'x': row[4], 'y': row[5]}
+                for row in (rows[item_id] for item_id in ids if item_id in rows)]
+
+    # 场景id -> 从顶层开始的[(id, 名字)]，一次查询
+    def paths(self, place_ids):
+        place_ids = list(place_ids)
+        paths = {place_id: [] for place_id in place_ids}
+        marks = ','.join('?' * len(place_ids))
+        if self.hierarchy:
+            sql = """SELECT place_paths.descendant_id, places.id, places.name
+                     FROM place_paths JOIN places ON places.id = place_paths.ancestor_id
+                     WHERE place_paths.descendant_id IN ({})
+                     ORDER BY place_paths.descendant_id, place_paths.depth DESC""".format(marks)
+        else:
+            sql = 'SELECT id, id, name FROM places WHERE id IN ({})'.format(marks)
+        for place_id, ancestor_id, name in self.connection.execute(sql, place_ids):
+            paths[place_id].append((ancestor_id, name))
+        return paths
+
+
+def format_result(result):
+    path = SEPARATOR.join(name for _, name in result['path']) or '?'
+    return '{} {} {} ({}, {})'.format(result['name'], ARROW, path, result['x'], result['y'])
+
+
+def result_json(result):
+    return dict(result, path=[{'id': place_id, 'name': name} for place_id, name in result['path']])
+
+
+USAGE = """用法: python where.py 文字 [--json] [--limit N] [--within 场景id] [--db 数据库]
+查找物品在哪里（不启动界面）
+  --json          输出JSON（每个物品包含id、场景路径和坐标）
+  --limit N       最多显示的物品数，默认{}，0表示不限制
+  --within ID     只搜索这个场景及其子场景
+  --db PATH       数据库文件，默认{}
+""".format(LIMIT, DB_PATH)
+
+
+class UsageError(Exception):
+    pass
+
+
+# 解析命令行参数（不用argparse：导入它和它用到的re、locale、shutil占了启动时间的三分之一）
+def parse_args(argv):
+    args = {'text': [], 'json': False, 'limit': LIMIT, 'within': None, 'db': DB_PATH, 'help': False}
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        name, _, value = arg.partition('=')
+        if arg in ('-h', '--help'):
+            args['help'] = True
+        elif arg == '--json':
+            args['json'] = True
+        elif name in ('--limit', '--within', '--db'):
+            if not value:
+                if not argv:
+                    raise UsageError('{}需要一个值'.format(name))
+                value = argv.pop(0)
+            if name == '--db':
+                args['db'] = value
+                continue
+            try:
+                args[name[2:]] = int(value)
+            except ValueError:
+                raise UsageError('{}需要一个整数: {}'.format(name, value))
+        elif arg == '--':
+            args['text'].extend(argv)
+            break
+        elif arg.startswith('--'):
+            raise UsageError('不认识的参数: ' + arg)
+        else:
+            args['text'].append(arg)
+    if not args['text'] and not args['help']:
+        raise UsageError('需要指定要查找的文字')
+    return args
+
+
+def main(argv=None):
+    try:
+        args = parse_args(sys.argv[1:] if argv is None else argv)
+    except UsageError as e:
+        sys.stderr.write('{}\n{}'.format(e, USAGE))
+        return 2
+    if args['help']:
+        sys.stdout.write(USAGE)
+        return 0
+
+    try:
+        lookup = Lookup(args['db'])
+    except (FileNotFoundError, sqlite3.Error) as e:
+        sys.stderr.write('{}\n'.format(e))
+        return 2
+    try:
+        results = lookup.find(' '.join(args['text']), args['limit'] or None, args['within'])
+    finally:
+        lookup.close()
+
+    if args['json']:
+        import json
+        json.dump([result_json(result) for result in results], sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write('\n')
+    else:
+        for result in results:
+            sys.stdout.write(format_result(result) + '\n')
+    return 0 if results else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())